@@ -0,0 +1,131 @@
+"""Run test.py/test_nlsd.py jobs (config/checkpoint x sequence x sampler) in parallel.
+Finished jobs are recorded in a json manifest so that an interrupted run can be resumed."""
+import os
+import sys
+import json
+import time
+import yaml
+import glob
+import hashlib
+import argparse
+import threading
+import subprocess
+from pathlib import Path
+from queue import Queue
+from itertools import product
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from metrics import summarize
+
+def options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--script",type=str,default="test.py",choices=['test.py','test_nlsd.py'])
+    parser.add_argument("--python",type=str,default=sys.executable)
+    parser.add_argument("--configs",type=str,nargs='+',default=["experiments/kitti/lsd/calibnet/log/kitti_lsd_calibnet.yml"])
+    parser.add_argument("--checkpoints",type=str,nargs='+',default=None,help='checkpoints evaluated with every config, default: path.pretrain of each config')
+    parser.add_argument("--sampling_types",type=str,nargs='+',default=[None],help='default: diffuser.sampling_type of each config')
+    parser.add_argument("--names",type=str,nargs='+',default=None,help='sequences/scenes to test, default: all in the config')
+    parser.add_argument("--model_type",type=str,default=None,help='default: diffusion for test.py, nlsd for test_nlsd.py')
+    parser.add_argument("--devices",type=str,nargs='+',default=['cuda:0'])
+    parser.add_argument("--jobs_per_device",type=int,default=1)
+    parser.add_argument("--out_dir",type=str,default="experiments/parallel_test")
+    parser.add_argument("--manifest",type=str,default=None,help='default: {out_dir}/manifest.json')
+    parser.add_argument("--gt_dir",type=str,default=None,help='if set, merge finished results into {log_dir}/{tag}.json')
+    parser.add_argument("--log_dir",type=str,default="log/parallel_test")
+    return parser.parse_args()
+
+def test_names(config:Dict) -> List[str]:
+    dataset_argv = config['dataset']['test']['dataset']
+    if isinstance(dataset_argv, list):
+        return [argv['name'] for argv in dataset_argv]
+    # nuscenes: one perturbation file per scene
+    return sorted(Path(path).stem for path in glob.glob(dataset_argv['main']['file'].format(name='*')))
+
+class Manifest:
+    def __init__(self, path:str):
+        self.path = path
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            self.jobs:Dict[str, Dict] = json.load(open(path,'r'))
+        else:
+            self.jobs:Dict[str, Dict] = dict()
+
+    def update(self, job_id:str, **argv):
+        with self.lock:
+            self.jobs.setdefault(job_id, dict()).update(argv)
+            tmp_path = self.path + '.tmp'
+            json.dump(self.jobs, open(tmp_path,'w'), indent=2)
+            os.replace(tmp_path, self.path)  # atomic, an interrupted write never corrupts the manifest
+
+    def status(self, job_id:str) -> Optional[str]:
+        with self.lock:
+            return self.jobs.get(job_id, dict()).get('status', None)
+
+def job_tag(config_file:str, checkpoint:Optional[str], sampling_type:str) -> str:
+    """'{experiment}_{stem}_{hash}_{sampling_type}': checkpoints of different experiments are usually all named best_model.pth,
+    so the tag names the experiment directory (grandparent of the checkpoint/config) and hashes the full config and checkpoint paths"""
+    path = Path(checkpoint if checkpoint is not None else config_file).resolve()
+    key = "{}|{}".format(Path(config_file).resolve(), Path(checkpoint).resolve() if checkpoint is not None else '')
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:8]
+    return "{}_{}_{}_{}".format(path.parent.parent.name, path.stem, digest, sampling_type)
+
+def build_jobs(args) -> List[Dict]:
+    jobs = []
+    checkpoints = args.checkpoints if args.checkpoints is not None else [None]
+    for config_file, checkpoint, sampling_type in product(args.configs, checkpoints, args.sampling_types):
+        config = yaml.load(open(config_file,'r'), yaml.SafeLoader)
+        if sampling_type is None:
+            sampling_type = config['diffuser'].get('sampling_type', 'nlsd' if args.script == 'test_nlsd.py' else 'dpm')
+        tag = job_tag(config_file, checkpoint, sampling_type)
+        names = args.names if args.names is not None else test_names(config)
+        for name in names:
+            jobs.append(dict(job_id="{}/{}".format(tag, name), tag=tag, name=name, config=config_file,
+                checkpoint=checkpoint, sampling_type=sampling_type, res_dir=os.path.join(args.out_dir, tag)))
+    return jobs
+
+def run_job(job:Dict, args, manifest:Manifest, device_queue:Queue):
+    device = device_queue.get()
+    cmd = [args.python, args.script, '--config', job['config'], '--names', job['name'],
+        '--res_dir', job['res_dir'], '--sampling_type', job['sampling_type'], '--device', device]
+    if args.model_type is not None:
+        cmd += ['--model_type', args.model_type]
+    if job['checkpoint'] is not None:
+        cmd += ['--pretrain', job['checkpoint']]
+    log_file = os.path.join(args.out_dir, 'logs', job['job_id'].replace('/','_') + '.log')
+    manifest.update(job['job_id'], status='running', device=device, res_dir=job['res_dir'], log=log_file, cmd=' '.join(cmd))
+    tic = time.time()
+    returncode, error = None, None
+    try:
+        with open(log_file, 'w') as f:
+            process = subprocess.Popen(cmd, stdout=f, stderr=subprocess.STDOUT)
+            returncode = process.wait()
+    except Exception as e:  # the job fails, the other jobs keep running
+        error = repr(e)
+    finally:
+        device_queue.put(device)
+    status = 'done' if returncode == 0 else 'failed'
+    manifest.update(job['job_id'], status=status, returncode=returncode, error=error, elapsed=time.time() - tic)
+    print("[{}] {} ({:.1f}s)".format(status, job['job_id'], time.time() - tic))
+    return job, status
+
+if __name__ == "__main__":
+    args = options()
+    Path(args.out_dir).joinpath('logs').mkdir(parents=True, exist_ok=True)
+    manifest = Manifest(args.manifest if args.manifest is not None else os.path.join(args.out_dir, 'manifest.json'))
+    jobs = build_jobs(args)
+    pending = [job for job in jobs if manifest.status(job['job_id']) != 'done']  # failed/interrupted jobs are rerun
+    print("{} jobs, {} pending".format(len(jobs), len(pending)))
+    device_queue = Queue()
+    for _ in range(args.jobs_per_device):
+        for device in args.devices:
+            device_queue.put(device)
+    with ThreadPoolExecutor(max_workers=len(args.devices) * args.jobs_per_device) as executor:
+        list(executor.map(lambda job: run_job(job, args, manifest, device_queue), pending))
+    if args.gt_dir is not None:
+        tags = sorted(set(job['tag'] for job in jobs))
+        for tag in tags:
+            tag_jobs = [job for job in jobs if job['tag'] == tag]
+            if all(manifest.status(job['job_id']) == 'done' for job in tag_jobs):
+                summarize(tag_jobs[0]['res_dir'], args.gt_dir, os.path.join(args.log_dir, tag + '.json'), [job['name'] for job in tag_jobs])
+            else:
+                print("skip merging {}: not all jobs are done".format(tag))
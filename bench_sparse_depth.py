@@ -0,0 +1,77 @@
+"""Latency of the dense depth-image branch vs. the sparse-convolution branch (SparseDepthEncoder).
+e.g. python bench_sparse_depth.py --dense cfg/model/calibnet.yml --sparse cfg/model/calibnet_sparse.yml --num_points 4096 8192 16384"""
+import argparse
+import yaml
+import torch
+from typing import Callable, Dict
+from models.denoiser import __classdict__ as DenoiserDict, Surrogate
+from models.util import se3
+
+def options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dense",type=str,default="cfg/model/calibnet.yml")
+    parser.add_argument("--sparse",type=str,default="cfg/model/calibnet_sparse.yml")
+    parser.add_argument("--image_size",type=int,nargs=2,default=[256, 512])
+    parser.add_argument("--batch_size",type=int,default=8)
+    parser.add_argument("--num_points",type=int,nargs='+',default=[4096, 8192, 16384, 32768])
+    parser.add_argument("--max_depth",type=float,default=50.0)
+    parser.add_argument("--warmup",type=int,default=5)
+    parser.add_argument("--repeat",type=int,default=20)
+    parser.add_argument("--device",type=str,default='cuda:0')
+    return parser.parse_args()
+
+def build_surrogate(config_file:str, device:str) -> Surrogate:
+    config = yaml.load(open(config_file,'r'), yaml.SafeLoader)
+    return DenoiserDict[config['surrogate']['type']](**config['surrogate']['argv']).to(device).eval()
+
+def synthetic_batch(batch_size:int, num_points:int, image_size, max_depth:float, device:str):
+    """random points inside the camera frustum of a KITTI-like pinhole camera"""
+    H, W = image_size
+    fx = fy = 0.5 * W
+    intrinsic = torch.tensor([fx, fy, 0.5 * W, 0.5 * H]).repeat(batch_size, 1)
+    camera_info = dict(sensor_h=H, sensor_w=W, projection_mode='perspective', intrinsic=intrinsic)
+    for i, key in enumerate(['fx', 'fy', 'cx', 'cy']):
+        camera_info[key] = intrinsic[:, i]
+    z = 1.0 + (max_depth - 1.0) * torch.rand(batch_size, 1, num_points)
+    u = W * torch.rand(batch_size, 1, num_points)
+    v = H * torch.rand(batch_size, 1, num_points)
+    pcd = torch.cat([(u - 0.5 * W) / fx * z, (v - 0.5 * H) / fy * z, z], dim=1)
+    img = torch.rand(batch_size, 3, H, W)
+    extran = torch.eye(4).unsqueeze(0).repeat(batch_size, 1, 1)
+    return img.to(device), pcd.to(device), extran.to(device), camera_info
+
+@torch.inference_mode()
+def measure(func:Callable, warmup:int, repeat:int) -> float:
+    """mean latency (ms)"""
+    for _ in range(warmup):
+        func()
+    start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+    start.record()
+    for _ in range(repeat):
+        func()
+    end.record()
+    torch.cuda.synchronize()
+    return start.elapsed_time(end) / repeat
+
+def depth_branch(model:Surrogate, pcd:torch.Tensor, extran:torch.Tensor, camera_info:Dict) -> Callable:
+    """the part of forward that depends on the point cloud only"""
+    def dense():
+        depth_img = model.pcd2depth.project(se3.transform(extran, pcd), camera_info)
+        if hasattr(model.encoder, 'depth_resnet'):
+            return model.encoder.depth_resnet(depth_img)
+        return model.encoder.lidar_encoding(depth_img)
+    def sparse():
+        strides = [32] if not hasattr(model, 'sparse_levels') else [model.encoder.lidar_strides[k] for k in model.sparse_levels]
+        return model.sparse_depth(se3.transform(extran, pcd), camera_info, strides)
+    return sparse if getattr(model, 'sparse_depth', None) is not None else dense
+
+if __name__ == "__main__":
+    args = options()
+    models = dict(dense=build_surrogate(args.dense, args.device), sparse=build_surrogate(args.sparse, args.device))
+    print("{:>10s} | {:>8s} | {:>12s} | {:>12s}".format('points', 'branch', 'lidar (ms)', 'forward (ms)'))
+    for num_points in args.num_points:
+        img, pcd, extran, camera_info = synthetic_batch(args.batch_size, num_points, args.image_size, args.max_depth, args.device)
+        for branch, model in models.items():
+            t_lidar = measure(depth_branch(model, pcd, extran, camera_info), args.warmup, args.repeat)
+            t_forward = measure(lambda: model(img, pcd, extran, camera_info), args.warmup, args.repeat)
+            print("{:>10d} | {:>8s} | {:>12.2f} | {:>12.2f}".format(num_points, branch, t_lidar, t_forward))
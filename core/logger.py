@@ -3,10 +3,10 @@ import os
 # import importlib
 # from datetime import datetime
 import logging
-import pandas as pd
+import numpy as np
 
 # from . import tools as Util
-from typing import Optional
+from typing import Optional, Dict, Sequence, Iterable
 import json
 from time import strftime, localtime
 
@@ -101,29 +101,122 @@ class VisualWriter():
         return os.path.join(self.result_dir, self.phase, str(self.epoch))
 
 
+class StreamingQuantile:
+    """
+    P^2 estimator (Jain & Chlamtac, 1985) of one quantile in O(1) memory and time per observation.
+    """
+    def __init__(self, q:float):
+        assert 0 < q < 1, 'quantile must be in (0, 1), got {}'.format(q)
+        self.q = q
+        self.heights = []  # marker heights, the first 5 observations are kept exactly
+        self.pos = [0, 1, 2, 3, 4]  # actual marker positions
+        self.desired = [0, 2*q, 4*q, 2+2*q, 4]  # desired marker positions
+        self.increment = [0, q/2, q, (1+q)/2, 1]
+
+    def update(self, x:float):
+        h = self.heights
+        if len(h) < 5:
+            h.append(x)
+            h.sort()
+            return
+        if x < h[0]:
+            h[0] = x
+            k = 0
+        elif x >= h[4]:
+            h[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= h[k+1]:
+                k += 1
+        n = self.pos
+        for i in range(k+1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increment[i]
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i+1] - n[i] > 1) or (d <= -1 and n[i-1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                qp = h[i] + d / (n[i+1] - n[i-1]) * ((n[i] - n[i-1] + d) * (h[i+1] - h[i]) / (n[i+1] - n[i])
+                    + (n[i+1] - n[i] - d) * (h[i] - h[i-1]) / (n[i] - n[i-1]))
+                if not h[i-1] < qp < h[i+1]:  # parabolic prediction out of order, use linear
+                    qp = h[i] + d * (h[i+d] - h[i]) / (n[i+d] - n[i])
+                h[i] = qp
+                n[i] += d
+
+    def value(self) -> float:
+        h = self.heights
+        if len(h) == 0:
+            return 0.0
+        if len(h) < 5 or self.pos[4] == 4:  # exact (linear interpolation) up to 5 observations, before any marker moves
+            rank = self.q * (len(h) - 1)
+            lo = int(rank)
+            hi = min(lo + 1, len(h) - 1)
+            return h[lo] + (rank - lo) * (h[hi] - h[lo])
+        return h[2]
+
 class LogTracker:
     """
     record training numerical indicators.
+    running sums are kept in preallocated arrays, `quantiles` maps a key to the quantiles streamed for it,
+    e.g. LogTracker('R', 't', 'time', quantiles={'time':[0.5, 0.95]}) also reports time_p50 and time_p95.
     """
-    def __init__(self, *keys, phase:Optional[str]=None):
+    def __init__(self, *keys, phase:Optional[str]=None, quantiles:Optional[Dict[str, Sequence[float]]]=None):
         self.phase = phase
-        self._data = pd.DataFrame(index=keys, columns=['total', 'counts', 'average'])
+        self.keys = list(keys)
+        self.index = {key:i for i, key in enumerate(self.keys)}
+        self.total = np.zeros(len(self.keys), dtype=np.float64)
+        self.counts = np.zeros(len(self.keys), dtype=np.float64)
+        self.quantiles = dict() if quantiles is None else {key:list(qs) for key, qs in quantiles.items()}
         self.reset()
 
     def reset(self):
-        for col in self._data.columns:
-            self._data[col].values[:] = 0
+        self.total[:] = 0
+        self.counts[:] = 0
+        self.estimators = {key:[StreamingQuantile(q) for q in qs] for key, qs in self.quantiles.items()}
+        self._snapshot = None
 
     def update(self, key, value, n=1):
-        self._data.total[key] += value * n
-        self._data.counts[key] += n
-        self._data.average[key] = self._data.total[key] / self._data.counts[key]
+        i = self.index[key]
+        self.total[i] += value * n
+        self.counts[i] += n
+        if key in self.estimators:
+            for estimator in self.estimators[key]:
+                estimator.update(value)
+        self._snapshot = None
+
+    def observe(self, key, values:Iterable[float]):
+        """update with per-sample values (e.g. per-frame errors), each one also feeds the quantile estimators"""
+        values = np.asarray(values, dtype=np.float64).reshape(-1)
+        i = self.index[key]
+        self.total[i] += values.sum()
+        self.counts[i] += len(values)
+        if key in self.estimators:
+            for estimator in self.estimators[key]:
+                for value in values.tolist():
+                    estimator.update(value)
+        self._snapshot = None
 
     def avg(self, key):
-        return self._data.average[key]
+        i = self.index[key]
+        return self.total[i] / self.counts[i] if self.counts[i] > 0 else 0.0
+
+    def quantile(self, key, q:float) -> float:
+        for estimator in self.estimators[key]:
+            if estimator.q == q:
+                return estimator.value()
+        raise KeyError('quantile {} of {} is not tracked'.format(q, key))
 
     def result(self):
-        if self.phase is not None:
-            return {'{}/{}'.format(self.phase, k):v for k, v in dict(self._data.average).items()}
-        else:
-            return dict(self._data.average)
+        """averages (and tracked quantiles), cached until the next update so it is cheap to call per iteration"""
+        if self._snapshot is None:
+            average = np.divide(self.total, self.counts, out=np.zeros_like(self.total), where=self.counts > 0)
+            res = dict(zip(self.keys, average.tolist()))
+            for key, estimators in self.estimators.items():
+                for estimator in estimators:
+                    res['{}_p{:g}'.format(key, estimator.q * 100)] = estimator.value()
+            if self.phase is not None:
+                res = {'{}/{}'.format(self.phase, k):v for k, v in res.items()}
+            self._snapshot = res
+        return dict(self._snapshot)
@@ -0,0 +1,197 @@
+import io
+import os
+import json
+import time
+import socket
+import threading
+import numpy as np
+from collections import deque, OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from typing import Callable, Dict, Hashable, List, Optional
+from .logger import LogTracker
+
+SERVING_QUANTILES = {'latency':[0.5, 0.95, 0.99], 'queue_wait':[0.5, 0.95]}
+
+class DynamicBatcher:
+    def __init__(self, run_batch:Callable[[List[Dict]], List], max_batch_size:int=16, max_wait:float=0.02):
+        """queue single requests and run them in batches on one worker thread.
+        Requests are grouped by a compatibility key (e.g. image size), a group is run once it is full
+        or once its oldest request has waited `max_wait` seconds; the oldest group goes first.
+
+        Args:
+            run_batch (Callable[[List[Dict]], List]): runs the requests of one group, returns one result per request
+            max_batch_size (int, optional): largest batch. Defaults to 16.
+            max_wait (float, optional): latency deadline of batch formation in seconds. Defaults to 0.02.
+        """
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.groups:Dict[Hashable, deque] = OrderedDict()
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.tracker = LogTracker('latency', 'queue_wait', 'batch_size', quantiles=SERVING_QUANTILES)
+        self.num_frames = 0
+        self.num_batches = 0
+        self.start_time = time.time()
+        self.worker = threading.Thread(target=self.loop, daemon=True)
+        self.worker.start()
+
+    def submit(self, request:Dict, key:Hashable) -> Future:
+        """queue one request, the future resolves to its result"""
+        future = Future()
+        with self.cond:
+            assert not self.stopped, "the batcher is stopped"
+            self.groups.setdefault(key, deque()).append((time.time(), request, future))
+            self.cond.notify()
+        return future
+
+    def queue_depth(self) -> int:
+        with self.cond:
+            return sum(len(group) for group in self.groups.values())
+
+    def next_batch(self) -> Optional[List]:
+        """pop the next due batch, blocks until there is one (None once stopped)"""
+        with self.cond:
+            while True:
+                if self.stopped:
+                    return None
+                if len(self.groups) == 0:
+                    self.cond.wait()
+                    continue
+                full = [key for key, group in self.groups.items() if len(group) >= self.max_batch_size]
+                if len(full) > 0:
+                    key = full[0]
+                else:
+                    key, group = min(self.groups.items(), key=lambda item: item[1][0][0])  # oldest request first
+                    wait = group[0][0] + self.max_wait - time.time()
+                    if wait > 0:
+                        self.cond.wait(timeout=wait)
+                        continue
+                group = self.groups[key]
+                batch = [group.popleft() for _ in range(min(len(group), self.max_batch_size))]
+                if len(group) == 0:
+                    del self.groups[key]
+                return batch
+
+    def loop(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            start = time.time()
+            try:
+                results = self.run_batch([request for _, request, _ in batch])
+                for (_, _, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:  # the worker keeps serving the other requests
+                for _, _, future in batch:
+                    future.set_exception(e)
+            end = time.time()
+            with self.cond:
+                self.num_frames += len(batch)
+                self.num_batches += 1
+                self.tracker.update('batch_size', len(batch))
+                for arrival, _, _ in batch:
+                    self.tracker.update('queue_wait', start - arrival)
+                    self.tracker.update('latency', end - arrival)
+
+    def metrics(self) -> Dict:
+        """throughput (frames/s since start), queue depth, batch size and latency statistics (seconds)"""
+        depth = self.queue_depth()
+        with self.cond:
+            res = self.tracker.result()
+            res.update(frames=self.num_frames, batches=self.num_batches, queue_depth=depth,
+                throughput=self.num_frames / max(time.time() - self.start_time, 1e-6))
+        return res
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self.worker.join()
+
+def decode_arrays(body:bytes) -> Dict[str, np.ndarray]:
+    with np.load(io.BytesIO(body), allow_pickle=False) as data:
+        return {key:data[key] for key in data.files}
+
+def encode_arrays(**arrays:np.ndarray) -> bytes:
+    """npz body of a client request"""
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+class BatchingRequestHandler(BaseHTTPRequestHandler):
+    """POST /calibrate: npz body, see `serve.py`; GET /metrics: json of `DynamicBatcher.metrics`"""
+    batcher:DynamicBatcher
+    parse_request_fn:Callable[[Dict[str, np.ndarray]], tuple]  # arrays -> (request, key)
+    timeout_s:float = 60.0
+
+    def send_json(self, code:int, obj:Dict):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send_json(200, self.batcher.metrics())
+        else:
+            self.send_json(404, dict(error='unknown path {}'.format(self.path)))
+
+    def do_POST(self):
+        if self.path != '/calibrate':
+            self.send_json(404, dict(error='unknown path {}'.format(self.path)))
+            return
+        try:
+            arrays = decode_arrays(self.rfile.read(int(self.headers['Content-Length'])))
+            request, key = self.parse_request_fn(arrays)
+        except Exception as e:
+            self.send_json(400, dict(error=repr(e)))
+            return
+        try:
+            result = self.batcher.submit(request, key).result(timeout=self.timeout_s)
+        except Exception as e:
+            self.send_json(500, dict(error=repr(e)))
+            return
+        self.send_json(200, result)
+
+    def address_string(self) -> str:
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('unix', 0)
+
+def build_http_server(batcher:DynamicBatcher, parse_request_fn:Callable[[Dict[str, np.ndarray]], tuple],
+        host:str='127.0.0.1', port:int=8000, unix_socket:Optional[str]=None):
+    """HTTP front-end of `batcher`, on host:port or on a local unix socket if `unix_socket` is given"""
+    handler = type('Handler', (BatchingRequestHandler,), dict(batcher=batcher, parse_request_fn=staticmethod(parse_request_fn)))
+    if unix_socket is None:
+        return ThreadingHTTPServer((host, port), handler)
+    if os.path.exists(unix_socket):
+        os.remove(unix_socket)
+    return ThreadingUnixHTTPServer(unix_socket, handler)
+
+def unix_http_request(unix_socket:str, method:str, path:str, body:bytes=b'') -> bytes:
+    """minimal HTTP/1.0 client over a unix socket (for local clients and smoke tests), returns the response body"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(unix_socket)
+        sock.sendall("{} {} HTTP/1.0\r\nContent-Length: {}\r\n\r\n".format(method, path, len(body)).encode('ascii') + body)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    response = b''.join(chunks)
+    return response.split(b'\r\n\r\n', 1)[1]
@@ -6,6 +6,7 @@ import torch.nn as nn
 from torchvision.utils import make_grid
 from typing import Iterable, List, Tuple, Union
 from models.util.constant import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
+from models.util.weights import save_weights, load_model_state
 import time
 class CudaTimer:
     def __init__(self):
@@ -149,6 +150,10 @@ def save_checkpoint(checkpoint:str, epoch:int, best_loss:float,
 		checkpoint)
 	
 def load_checkpoint_model_only(checkpoint:str, model:nn.Module):
-    chkpt = torch.load(checkpoint, map_location='cpu')
-    model.load_state_dict(chkpt['model'])
-    return
\ No newline at end of file
+    """load model weights from a training checkpoint (.pth) or a weight-only file (.weights, see export_weights)"""
+    model.load_state_dict(load_model_state(checkpoint))
+    return
+
+def export_weights(checkpoint:str, file:str, half:bool=False):
+    """write the model weights of a training checkpoint as a memory-mappable weight-only file"""
+    save_weights(file, load_model_state(checkpoint), half)
\ No newline at end of file
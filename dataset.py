@@ -1,6 +1,9 @@
 import os
+import io
 import json
+import hashlib
 import torch
+import torch.nn.functional as F
 from PIL import Image
 from torchvision.transforms import transforms as Tf
 import numpy as np
@@ -16,8 +19,8 @@ import time
 import open3d as o3d
 from PIL import Image
 from torch import Generator, randperm
-from torch.utils.data import Dataset, Subset, BatchSampler
-from typing import Iterable, List, Dict, Union, Optional, Tuple, Sequence, Literal, TypeVar, Generator
+from torch.utils.data import Dataset, IterableDataset, Subset, BatchSampler, DataLoader, RandomSampler, SequentialSampler, get_worker_info, default_collate
+from typing import Iterable, List, Dict, Union, Optional, Tuple, Sequence, Literal, TypeVar, Generator, Callable
 from functools import partial
 from models.tools.csrc import furthest_point_sampling
 from models.util import transform, se3
@@ -25,6 +28,8 @@ from models.util.transform import nptran, inv_pose_np
 from models.util.constant import IMAGENET_DEFAULT_MEAN as IMAGENET_MEAN
 from models.util.constant import IMAGENET_DEFAULT_STD as IMAGENET_STD
 import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 def subset_split(dataset:Dataset, lengths:Sequence[int], seed:Optional[int]=None):
@@ -55,6 +60,13 @@ def check_length(root:str,save_name='data_len.json'):
     with open(os.path.join(root,save_name),'w')as f:
         json.dump(dict_len,f)
         
+def read_file(file:str) -> bytes:
+    """read a whole file with one unbuffered read, hinting the kernel to read ahead sequentially"""
+    with open(file, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        return f.readall()
+
 class KITTIFilter:
     def __init__(self, voxel_size:Optional[float]=None, positive_x:bool=False, min_dist:float=0.15, skip_point:int=1):
         """KITTIFilter
@@ -88,12 +100,14 @@ class KITTIFilter:
 
 class Resampler:
     """ [N, D] -> [M, D]\n
-    used for training
+    used for training, num=None keeps the raw point cloud (collated as a ragged batch)
     """
-    def __init__(self, num):
+    def __init__(self, num:Optional[int]):
         self.num = num
 
     def __call__(self, x: np.ndarray):
+        if self.num is None:
+            return x
         num_points = x.shape[0]
         idx = np.random.permutation(num_points)
         if self.num < 0:
@@ -128,6 +142,71 @@ class ToTensor:
         return torch.from_numpy(x).type(self.tensor_type)
 
 
+class FrustumIndexCache:
+    def __init__(self, cache_dir:str, params:Dict):
+        """per-frame indices of the points kept by the `extend_ratio` frustum crop, computed once and stored as one .npy per frame.
+        The crop only depends on the ground-truth extrinsic, the intrinsic and the point filter, so later epochs skip
+        the transform and projection of the full scan.
+
+        Args:
+            cache_dir (str): root directory, shared by all splits of a dataset
+            params (Dict): everything the crop depends on, selects a subdirectory so that other settings never reuse stale indices
+        """
+        tag = hashlib.md5(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[:8]
+        self.cache_dir = os.path.join(cache_dir, tag)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get(self, key:str, num_points:int, crop_fn:Callable[[], np.ndarray]) -> np.ndarray:
+        """sorted int32 indices of the kept points of frame `key`; `crop_fn` returns the boolean mask if they are not cached yet"""
+        file = os.path.join(self.cache_dir, '{}.npy'.format(key))
+        if os.path.isfile(file):
+            index = np.load(file)
+            if len(index) == 0 or index[-1] < num_points:  # otherwise written for another cloud
+                return index
+        index = np.flatnonzero(crop_fn()).astype(np.int32)
+        tmp_file = '{}.{}.tmp'.format(file, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            np.save(f, index)
+        os.replace(tmp_file, file)  # DataLoader workers never read a partial file
+        return index
+
+def collate_camera_info(camera_info_list:List[Dict]) -> Dict:
+    """batch camera_info dicts without mutating the samples.
+    'intrinsic' (B,4) packs [fx, fy, cx, cy]; 'fx', 'fy', 'cx', 'cy' are (B,) views of it."""
+    camera_info = dict(camera_info_list[0])
+    intrinsic = torch.tensor([[info['fx'], info['fy'], info['cx'], info['cy']] for info in camera_info_list], dtype=torch.float32)
+    camera_info['intrinsic'] = intrinsic
+    for i, key in enumerate(['fx', 'fy', 'cx', 'cy']):
+        camera_info[key] = intrinsic[:, i]
+    return camera_info
+
+def collate_pcd(pcd_list:List[torch.Tensor]) -> Dict[str, torch.Tensor]:
+    """stack (3,N) point clouds into 'pcd' (B,3,N).
+    Clouds of different sizes (pcd_sample_num=None) are concatenated into 'pcd' (3,M) with 'pcd_offsets' (B+1,),
+    see models.tools.utils.ragged_to_padded"""
+    lengths = [pcd.shape[-1] for pcd in pcd_list]
+    if all(length == lengths[0] for length in lengths):
+        return dict(pcd=torch.stack(pcd_list))
+    offsets = torch.zeros(len(lengths) + 1, dtype=torch.long)
+    offsets[1:] = torch.cumsum(torch.tensor(lengths), dim=0)
+    return dict(pcd=torch.cat(pcd_list, dim=-1), pcd_offsets=offsets)
+
+def collate_img(img_list:List[torch.Tensor]) -> Dict[str, torch.Tensor]:
+    """stack (3,H,W) images into 'img' (B,3,H,W).
+    uint8 images of different sizes (`uint8_img` across sequences) are zero-padded to the largest one, with their sizes in 'img_sizes' (B,2)"""
+    sizes = [tuple(img.shape[-2:]) for img in img_list]
+    if img_list[0].dtype != torch.uint8 or all(size == sizes[0] for size in sizes):
+        return dict(img=torch.stack(img_list))
+    H, W = max(size[0] for size in sizes), max(size[1] for size in sizes)
+    img = torch.zeros((len(img_list), 3, H, W), dtype=torch.uint8)
+    for i, (img_i, (h, w)) in enumerate(zip(img_list, sizes)):
+        img[i, :, :h, :w] = img_i
+    return dict(img=img, img_sizes=torch.tensor(sizes, dtype=torch.long))
+
+def img_to_uint8(img:Image.Image) -> torch.Tensor:
+    """PIL image -> (3,H,W) uint8 tensor, see `img_to_device`"""
+    return torch.from_numpy(np.array(img.convert('RGB'))).permute(2,0,1)
+
 class SeqBatchSampler(BatchSampler):
     def __init__(self, num_sequences:int, len_of_sequences:Sequence[int], dataset_len:int, num_samples:int=4):
         # Batch sampler with a dynamic number of sequences
@@ -148,12 +227,18 @@ class SeqBatchSampler(BatchSampler):
     def __len__(self):
         return self.dataset_len
 
+    @property
+    def batch_size(self) -> int:
+        return self.num_samples
+
 class BaseKITTIDataset(Dataset):
     def __init__(self,basedir:str,
                  seqs:List[str]=['09','10'], cam_id:int=2,
                  meta_json:str='data_len.json', skip_frame:int=1, skip_point:int=1,
-                 voxel_size:Optional[float]=None, min_dist=0.1, pcd_sample_num=8192,
+                 voxel_size:Optional[float]=None, min_dist=0.1, pcd_sample_num:Optional[int]=8192,
                  resize_size:Optional[Tuple[int,int]]=None, extend_ratio=(2.5,2.5),
+                 uint8_img:bool=False,  # (3,H,W) uint8 images at their original size, resized and normalized by img_to_device
+                 frustum_cache:Optional[str]=None,  # directory of the per-frame extend_ratio crop indices (FrustumIndexCache)
                  ):
         if not os.path.exists(os.path.join(basedir,meta_json)):
             check_length(basedir,meta_json)
@@ -174,16 +259,34 @@ class BaseKITTIDataset(Dataset):
             self.check(obj,cam_id,seq)
         self.sep = [len(data) for data in self.kitti_datalist]
         self.sumsep = np.cumsum(self.sep)
+        # calibration constants, looked up once per sequence instead of per item
+        self.calib_list = [dict(T_cam2velo=getattr(data.calib,'T_cam%d_velo'%cam_id), K_cam=getattr(data.calib,'K_cam%d'%cam_id)) for data in self.kitti_datalist]
         self.resample_tran = Resampler(pcd_sample_num)
         self.tensor_tran = lambda x:torch.from_numpy(x).to(torch.float32)
         self.img_tran = Tf.Compose([Tf.ToTensor(),
                                     Tf.Normalize(IMAGENET_MEAN, IMAGENET_STD)])
         self.pcd_tran = KITTIFilter(voxel_size, min_dist, skip_point)
         self.extend_ratio = extend_ratio
+        self.uint8_img = uint8_img
+        self.frustum_cache = None
+        if frustum_cache is not None and extend_ratio is not None:
+            self.frustum_cache = FrustumIndexCache(frustum_cache, dict(dataset='kitti', cam_id=cam_id, voxel_size=voxel_size, min_dist=min_dist,
+                skip_point=skip_point, resize_size=resize_size, extend_ratio=extend_ratio))
         
     def __len__(self):
         return self.sumsep[-1]
     
+    def max_img_size(self) -> Tuple[int,int]:
+        """largest (H, W) of the returned images; raw KITTI sizes differ between sequences (`uint8_img`) but not within one,
+        so only the header of the first image of every sequence is read"""
+        if not self.uint8_img and self.resize_size is not None:
+            return tuple(self.resize_size)
+        sizes = []
+        for data in self.kitti_datalist:
+            with Image.open(getattr(data,'cam%d_files'%self.cam_id)[0]) as img:
+                sizes.append((img.height, img.width))
+        return max(size[0] for size in sizes), max(size[1] for size in sizes)
+
     def get_seq_params(self) -> Tuple[int, List[int]]:
         """Get num_seqs, num_data_per_seq
 
@@ -205,20 +308,58 @@ class BaseKITTIDataset(Dataset):
     def __getitem__(self, index:Union[int, Tuple[int,int]]):
         if isinstance(index, Tuple):
             return self.group_sub_item(index)
+        return self.group_sub_item(self.split_index(index))
+
+    def split_index(self, index:int) -> Tuple[int,int]:
         group_id = np.digitize(index,self.sumsep,right=False)
         if group_id > 0:
             sub_idx = index - self.sumsep[group_id-1]
         else:
             sub_idx = index
-        return self.group_sub_item((group_id, sub_idx))
-        
+        return group_id, sub_idx
+
     def group_sub_item(self, tuple_index:Tuple[int,int]):
         group_idx, sub_idx = tuple_index
         data = self.kitti_datalist[group_idx]
-        T_cam2velo = getattr(data.calib,'T_cam%d_velo'%self.cam_id)  
         raw_img:Image.Image = getattr(data,'get_cam%d'%self.cam_id)(sub_idx)  # PIL Image
+        return self.process_frame(group_idx, sub_idx, raw_img, data.get_velo(sub_idx))
+
+    def read_frame(self, group_idx:int, sub_idx:int) -> Tuple[Image.Image, np.ndarray]:
+        """read the image and the velodyne scan of a frame, each file with one large sequential read"""
+        data = self.kitti_datalist[group_idx]
+        img_file = getattr(data,'cam%d_files'%self.cam_id)[sub_idx]
+        raw_img = Image.open(io.BytesIO(read_file(img_file)))
+        raw_img = raw_img.convert('L' if self.cam_id < 2 else 'RGB')  # same as pykitti
+        velo = np.frombuffer(read_file(data.velo_files[sub_idx]), dtype=np.float32).reshape(-1,4)
+        return raw_img, velo
+
+    def stream(self, indices:Iterable[int], read_ahead:int=8, num_threads:int=4) -> Generator[Tuple[int, Dict], None, None]:
+        """yield (index, item) in the order of `indices`, the files of the next `read_ahead` frames are read and decoded by a thread pool
+
+        Args:
+            indices (Iterable[int]): global indices, e.g. range(len(self))
+            read_ahead (int, optional): number of frames read in advance. Defaults to 8.
+            num_threads (int, optional): reading threads. Defaults to 4.
+        """
+        pending = deque()
+        indices = iter(indices)
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            for index in indices:
+                pending.append((index, executor.submit(self.read_frame, *self.split_index(index))))
+                if len(pending) >= read_ahead:
+                    break
+            while len(pending) > 0:
+                index, future = pending.popleft()
+                next_index = next(indices, None)
+                if next_index is not None:
+                    pending.append((next_index, executor.submit(self.read_frame, *self.split_index(next_index))))
+                raw_img, velo = future.result()
+                yield index, self.process_frame(*self.split_index(index), raw_img, velo)
+
+    def process_frame(self, group_idx:int, sub_idx:int, raw_img:Image.Image, velo:np.ndarray):
+        T_cam2velo = self.calib_list[group_idx]['T_cam2velo']
         H,W = raw_img.height, raw_img.width
-        K_cam:np.ndarray = getattr(data.calib,'K_cam%d'%self.cam_id)  
+        K_cam:np.ndarray = self.calib_list[group_idx]['K_cam']
         if self.resize_size is not None:
             RH, RW = self.resize_size
             K_cam = np.diag([RW / W, RH / H, 1.0]) @ K_cam
@@ -226,17 +367,27 @@ class BaseKITTIDataset(Dataset):
             RH = H
             RW = W
        
-        raw_img = raw_img.resize([RW,RH],Image.Resampling.BILINEAR)
-        _img = self.img_tran(raw_img)  # raw img input (3,H,W)
-        pcd:np.ndarray = data.get_velo(sub_idx)[:,:3]
+        if self.uint8_img:
+            _img = img_to_uint8(raw_img)  # resized and normalized on the device
+        else:
+            raw_img = raw_img.resize([RW,RH],Image.Resampling.BILINEAR)
+            _img = self.img_tran(raw_img)  # raw img input (3,H,W)
+        pcd:np.ndarray = velo[:,:3]
         pcd = self.pcd_tran(pcd)
         if self.extend_ratio is not None:
-            calibed_pcd = nptran(pcd, T_cam2velo).T
-            REVH,REVW = self.extend_ratio[0]*RH,self.extend_ratio[1] * RW
-            K_cam_extend = K_cam.copy()  # K_cam_extend for dilated projection
-            K_cam_extend[0,-1] *= self.extend_ratio[0]
-            K_cam_extend[1,-1] *= self.extend_ratio[1]
-            *_,rev = transform.binary_projection((REVH,REVW), K_cam_extend, calibed_pcd)
+            def crop_fn():
+                calibed_pcd = nptran(pcd, T_cam2velo).T
+                REVH,REVW = self.extend_ratio[0]*RH,self.extend_ratio[1] * RW
+                K_cam_extend = K_cam.copy()  # K_cam_extend for dilated projection
+                K_cam_extend[0,-1] *= self.extend_ratio[0]
+                K_cam_extend[1,-1] *= self.extend_ratio[1]
+                *_,rev = transform.binary_projection((REVH,REVW), K_cam_extend, calibed_pcd)
+                return rev
+            if self.frustum_cache is None:
+                rev = crop_fn()
+            else:
+                data = self.kitti_datalist[group_idx]
+                rev = self.frustum_cache.get('{}_{:06d}'.format(data.sequence, data.frames[sub_idx]), len(pcd), crop_fn)
             pcd = pcd[rev,:]
         pcd = self.resample_tran(pcd) # (n,3)
         _pcd = self.tensor_tran(pcd.T)
@@ -255,36 +406,86 @@ class BaseKITTIDataset(Dataset):
     @staticmethod
     def collate_fn(zipped_x:Iterable[Dict[str, Union[torch.Tensor, Dict]]]):
         batch = dict()
-        batch['img'] = torch.stack([x['img'] for x in zipped_x])
-        batch['pcd'] = torch.stack([x['pcd'] for x in zipped_x])
+        batch.update(collate_img([x['img'] for x in zipped_x]))
+        batch.update(collate_pcd([x['pcd'] for x in zipped_x]))
         batch['extran'] = torch.stack([x['extran'] for x in zipped_x])
         batch['group_idx'] = [x['group_idx'] for x in zipped_x]
         batch['sub_idx'] = [x['sub_idx'] for x in zipped_x]
-        batch['camera_info'] = zipped_x[0]['camera_info']
-        batch['camera_info']['fx'] = torch.tensor([x['camera_info']['fx'] for x in zipped_x], dtype=torch.float32)
-        batch['camera_info']['fy'] = torch.tensor([x['camera_info']['fy'] for x in zipped_x], dtype=torch.float32)
-        batch['camera_info']['cx'] = torch.tensor([x['camera_info']['cx'] for x in zipped_x], dtype=torch.float32)
-        batch['camera_info']['cy'] = torch.tensor([x['camera_info']['cy'] for x in zipped_x], dtype=torch.float32)
+        batch['camera_info'] = collate_camera_info([x['camera_info'] for x in zipped_x])
         return batch
         
+class PerturbStore:
+    """perturbations saved as a (N,22) float32 .npy file: twist (6) + flattened igt (16).
+    The file is memory-mapped, so every worker reads the same rows with O(1) random access and no se3.exp."""
+    def __init__(self, file:str):
+        self.data = np.load(file, mmap_mode='r')  # (N,22)
+
+    def __len__(self):
+        return len(self.data)
+
+    def twist(self, index:int) -> torch.Tensor:
+        return torch.from_numpy(np.array(self.data[index, :6]))  # (6,)
+
+    def igt(self, index:int) -> torch.Tensor:
+        return torch.from_numpy(np.array(self.data[index, 6:])).reshape(4,4)  # (4,4)
+
+    @staticmethod
+    def save(file:str, perturb:torch.Tensor):
+        """perturb: (N,6) twists"""
+        igt = se3.exp(perturb).reshape(-1,16)
+        np.save(file, torch.cat([perturb, igt], dim=1).cpu().numpy().astype(np.float32))
+
+    @staticmethod
+    def from_txt(txt_file:str, file:str):
+        """convert a perturbation file saved by np.savetxt into a PerturbStore file"""
+        PerturbStore.save(file, torch.from_numpy(np.loadtxt(txt_file, dtype=np.float32)).reshape(-1,6))
+        return PerturbStore(file)
+
 class PerturbDataset(Dataset):
     def __init__(self,dataset:BaseKITTIDataset,
                  max_deg:float,
                  max_tran:float,
                  mag_randomly=True,
-                 file:Optional[str]=None):
+                 file:Optional[str]=None,
+                 seed:Optional[int]=None,
+                 on_device:bool=False):
+        """wrap a base dataset with perturbed extrinsics
+
+        Args:
+            dataset (BaseKITTIDataset): base dataset
+            max_deg (float): max rotation perturbation (degree)
+            max_tran (float): max translation perturbation (m)
+            mag_randomly (bool, optional): random magnitude. Defaults to True.
+            file (Optional[str], optional): fixed perturbations, `.txt` (np.savetxt) or `.npy` (PerturbStore). Generated if not exist. Defaults to None.
+            seed (Optional[int], optional): if set, perturbations are keyed by (seed, epoch, global index) instead of the worker RNG. Defaults to None.
+            on_device (bool, optional): if neither `file` nor `seed` is set, leave the extrinsics unperturbed in the workers
+                and draw the perturbations of the whole batch on the device by `perturb_batch`. Defaults to False.
+        """
         self.dataset = dataset
         self.file = file
+        self.seed = seed
+        self.on_device = on_device and file is None and seed is None
+        self.epoch = 0
+        self.transform = transform.UniformTransformSE3(max_deg, max_tran, mag_randomly)
         if self.file is not None:
-            if os.path.isfile(self.file):
-                self.perturb = torch.from_numpy(np.loadtxt(self.file, dtype=np.float32))[None,...]  # (1,N,6)
+            if not os.path.isfile(self.file):
+                if seed is not None:
+                    perturb = self.transform.generate_indexed_transform(range(len(dataset)), seed)
+                else:
+                    perturb = self.transform.generate_transform(len(dataset))
+                if self.file.endswith('.npy'):
+                    PerturbStore.save(self.file, perturb)
+                else:
+                    np.savetxt(self.file, perturb.cpu().detach().numpy(), fmt='%0.6f')
+            if self.file.endswith('.npy'):
+                self.store = PerturbStore(self.file)
             else:
-                random_transform = transform.UniformTransformSE3(max_deg, max_tran, mag_randomly)
-                perturb = random_transform.generate_transform(len(dataset))
-                np.savetxt(self.file, perturb.cpu().detach().numpy(), fmt='%0.6f')
-                self.perturb = perturb.unsqueeze(0)  # (1,N,6)
-        else:
-            self.transform = transform.UniformTransformSE3(max_deg, max_tran, mag_randomly)
+                perturb = torch.from_numpy(np.loadtxt(self.file, dtype=np.float32)).reshape(-1,6)  # (N,6)
+                self.igt = se3.exp(perturb)  # (N,4,4), computed once instead of per item
+
+    def set_epoch(self, epoch:int):
+        """draw a new set of seeded perturbations (only used if `seed` is set and `file` is None)"""
+        self.epoch = epoch
 
     def __len__(self):
         return len(self.dataset)
@@ -296,14 +497,24 @@ class PerturbDataset(Dataset):
             total_index = self.dataset.sumsep[group_idx] + sub_idx
         else:
             total_index = index
+        return self.apply_perturbation(data, total_index)
+
+    def apply_perturbation(self, data:Dict, total_index:int) -> Dict:
+        """apply the perturbation of `total_index` to an item of the base dataset"""
         extran = data['extran']  # (4,4)
-        if self.file is None:  # randomly generate igt
-            igt_x = self.transform.generate_transform(1)
-            igt = se3.exp(igt_x).squeeze(0)
-            gt = transform.inv_pose(igt)
+        if self.on_device:  # perturbed after collate, see perturb_batch
+            return dict(img=data['img'],pcd=data['pcd'], extran=extran, camera_info=data['camera_info'],
+                        group_idx=data['group_idx'], sub_idx=data['sub_idx'], perturb=self.transform)
+        if self.file is None:
+            if self.seed is None:  # randomly generate igt
+                igt = self.transform.generate_transform(1, return_se3=True).squeeze(0)
+            else:
+                igt = self.transform.generate_indexed_transform([total_index], self.seed, self.epoch, return_se3=True).squeeze(0)
+        elif self.file.endswith('.npy'):
+            igt = self.store.igt(total_index)
         else:
-            igt = se3.exp(self.perturb[:,total_index,:]).squeeze(0)  # (1,6) -> (1,4,4)
-            gt = transform.inv_pose(igt).squeeze(0)
+            igt = self.igt[total_index]
+        gt = transform.inv_pose(igt)
         extran = igt @ extran
         new_data = dict(img=data['img'],pcd=data['pcd'], gt=gt, extran=extran, camera_info=data['camera_info'],
                         group_idx=data['group_idx'], sub_idx=data['sub_idx'])
@@ -312,19 +523,364 @@ class PerturbDataset(Dataset):
     @staticmethod
     def collate_fn(zipped_x:Iterable[Dict[str, Union[torch.Tensor, Dict]]]):
         batch = dict()
-        batch['img'] = torch.stack([x['img'] for x in zipped_x])
-        batch['pcd'] = torch.stack([x['pcd'] for x in zipped_x])
+        batch.update(collate_img([x['img'] for x in zipped_x]))
+        batch.update(collate_pcd([x['pcd'] for x in zipped_x]))
         batch['group_idx'] = [x['group_idx'] for x in zipped_x]
         batch['sub_idx'] = [x['sub_idx'] for x in zipped_x]
         batch['extran'] = torch.stack([x['extran'] for x in zipped_x])
-        batch['gt'] = torch.stack([x['gt'] for x in zipped_x])
-        batch['camera_info'] = zipped_x[0]['camera_info']
-        batch['camera_info']['fx'] = torch.tensor([x['camera_info']['fx'] for x in zipped_x], dtype=torch.float32)
-        batch['camera_info']['fy'] = torch.tensor([x['camera_info']['fy'] for x in zipped_x], dtype=torch.float32)
-        batch['camera_info']['cx'] = torch.tensor([x['camera_info']['cx'] for x in zipped_x], dtype=torch.float32)
-        batch['camera_info']['cy'] = torch.tensor([x['camera_info']['cy'] for x in zipped_x], dtype=torch.float32)
+        if 'perturb' in zipped_x[0]:
+            batch['perturb'] = zipped_x[0]['perturb']
+        else:
+            batch['gt'] = torch.stack([x['gt'] for x in zipped_x])
+        batch['camera_info'] = collate_camera_info([x['camera_info'] for x in zipped_x])
+        return batch
+
+def perturb_batch(batch:Dict, device:Union[str, torch.device]) -> Dict:
+    """draw the perturbations of a batch collated without them (PerturbDataset with `on_device`) in one call on `device`:
+    'extran' becomes igt @ extran and 'gt' = igt^-1. Batches that already have 'gt' are returned unchanged."""
+    if 'perturb' not in batch:
+        return batch
+    perturb = batch.pop('perturb')
+    if isinstance(perturb, list):  # collated by SharedMemoryDataset.collate_fn
+        perturb = perturb[0]
+    extran = batch['extran'].to(device, non_blocking=True)
+    igt = perturb.generate_transform(extran.shape[0], return_se3=True, device=extran.device)
+    batch['extran'] = igt @ extran
+    batch['gt'] = transform.inv_pose(igt)
+    return batch
+
+def img_to_device(batch:Dict, device:Union[str, torch.device]) -> torch.Tensor:
+    """'img' of a batch on `device`, as the normalized float (B,3,H,W) the models take.
+    uint8 images (`uint8_img` datasets) are copied as uint8, then resized to (sensor_h, sensor_w) of 'camera_info'
+    (antialiased bilinear, like the PIL resize) and normalized in one batched op per image size."""
+    img = batch['img'].to(device, non_blocking=True)
+    if img.dtype != torch.uint8:
+        return img
+    camera_info = batch['camera_info']
+    size = (int(camera_info['sensor_h']), int(camera_info['sensor_w']))
+    resize = lambda x: x if tuple(x.shape[-2:]) == size else F.interpolate(x, size=size, mode='bilinear', align_corners=False, antialias=True)
+    img = img.float()
+    if 'img_sizes' in batch:  # padded images of different sizes
+        sizes = [tuple(hw) for hw in batch['img_sizes'].tolist()]
+        out = img.new_empty((img.shape[0], 3, *size))
+        for h, w in set(sizes):
+            index = torch.tensor([i for i, hw in enumerate(sizes) if hw == (h, w)], device=img.device)
+            out[index] = resize(img[index, :, :h, :w])
+        img = out
+    else:
+        img = resize(img)
+    mean = torch.tensor(IMAGENET_MEAN, device=img.device).view(1, 3, 1, 1) * 255
+    std = torch.tensor(IMAGENET_STD, device=img.device).view(1, 3, 1, 1) * 255
+    return (img - mean) / std
+
+class KITTIStreamDataset(IterableDataset):
+    def __init__(self, dataset:Union[BaseKITTIDataset, PerturbDataset], block_size:int=1, read_ahead:int=8, num_threads:int=4):
+        """stream a KITTI dataset in index order with read-ahead threads (sequential evaluation)
+
+        Args:
+            dataset (Union[BaseKITTIDataset, PerturbDataset]): KITTI dataset, optionally wrapped by PerturbDataset
+            block_size (int, optional): with several DataLoader workers, worker w streams the blocks k % num_workers == w,
+                so that the round-robin order of the DataLoader keeps the index order if block_size == batch_size. Defaults to 1.
+            read_ahead (int, optional): number of frames read in advance by each worker. Defaults to 8.
+            num_threads (int, optional): reading threads of each worker. Defaults to 4.
+        """
+        self.dataset = dataset
+        self.base_dataset:BaseKITTIDataset = dataset.dataset if isinstance(dataset, PerturbDataset) else dataset
+        assert isinstance(self.base_dataset, BaseKITTIDataset), "only KITTI datasets can be streamed"
+        self.block_size = block_size
+        self.read_ahead = read_ahead
+        self.num_threads = num_threads
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def worker_indices(self) -> Iterable[int]:
+        worker_info = get_worker_info()
+        if worker_info is None:
+            return range(len(self.dataset))
+        return (index for start in range(worker_info.id * self.block_size, len(self.dataset), worker_info.num_workers * self.block_size)
+            for index in range(start, min(start + self.block_size, len(self.dataset))))
+
+    def __iter__(self):
+        for index, data in self.base_dataset.stream(self.worker_indices(), self.read_ahead, self.num_threads):
+            if isinstance(self.dataset, PerturbDataset):
+                data = self.dataset.apply_perturbation(data, index)
+            yield data
+
+    @property
+    def collate_fn(self):
+        return self.dataset.collate_fn
+
+class SharedRing:
+    def __init__(self, num_slots:int, img_shape:Sequence[int], max_points:int, pin:bool=True, img_dtype:torch.dtype=torch.float32):
+        """preallocated shared-memory buffers for the images and point clouds of in-flight samples.
+        DataLoader workers write samples into slots; the main process takes batches as views of consecutive slots.
+
+        Args:
+            num_slots (int): number of samples that can be in flight
+            img_shape (Sequence[int]): (3, H, W) capacity of an image slot, smaller images are written to its top-left corner
+            max_points (int): capacity of a point cloud slot
+            pin (bool, optional): page-lock the buffers (cudaHostRegister) so that batches can be copied with non_blocking=True. Defaults to True.
+            img_dtype (torch.dtype, optional): torch.uint8 for `uint8_img` datasets. Defaults to torch.float32.
+        """
+        self.img = torch.empty((num_slots, *img_shape), dtype=img_dtype).share_memory_()
+        self.pcd = torch.empty((num_slots, 3, max_points), dtype=torch.float32).share_memory_()
+        self.num_points = torch.zeros(num_slots, dtype=torch.long).share_memory_()
+        self.img_sizes = torch.zeros((num_slots, 2), dtype=torch.long).share_memory_()
+        self.owner_pid = os.getpid()
+        self.pinned = pin and torch.cuda.is_available()
+        if self.pinned:
+            for buffer in (self.img, self.pcd):
+                torch.cuda.cudart().cudaHostRegister(buffer.data_ptr(), buffer.numel() * buffer.element_size(), 0)
+
+    def __del__(self):
+        if getattr(self, 'pinned', False) and os.getpid() == self.owner_pid:  # workers never touch CUDA
+            for buffer in (self.img, self.pcd):
+                torch.cuda.cudart().cudaHostUnregister(buffer.data_ptr())
+
+    def write(self, slot:int, img:torch.Tensor, pcd:torch.Tensor):
+        num_points = pcd.shape[-1]
+        assert num_points <= self.pcd.shape[-1], "point cloud ({}) exceeds the slot capacity ({})".format(num_points, self.pcd.shape[-1])
+        H, W = img.shape[-2:]
+        assert H <= self.img.shape[-2] and W <= self.img.shape[-1], "image ({}, {}) exceeds the slot capacity {}, set `max_img_size`".format(H, W, tuple(self.img.shape[-2:]))
+        self.img[slot, :, :H, :W].copy_(img)
+        self.img_sizes[slot, 0], self.img_sizes[slot, 1] = H, W
+        self.pcd[slot, :, :num_points].copy_(pcd)  # also casts, no intermediate float32 copy
+        self.num_points[slot] = num_points
+
+    def read(self, start:int, count:int) -> Dict[str, torch.Tensor]:
+        """'img' (B,3,H,W) and 'pcd' (B,3,N) are views of the buffers; clouds of different sizes are collated by `collate_pcd`,
+        images of different sizes keep the slot size with their sizes in 'img_sizes' (B,2), like `collate_img`"""
+        num_points = self.num_points[start:start+count].tolist()
+        img_sizes = self.img_sizes[start:start+count]
+        if bool((img_sizes == img_sizes[0]).all()):
+            H, W = img_sizes[0].tolist()
+            batch = dict(img=self.img[start:start+count, :, :H, :W])  # contiguous if the images fill the slots
+        else:
+            batch = dict(img=self.img[start:start+count], img_sizes=img_sizes.clone())
+        if all(num == num_points[0] for num in num_points):
+            batch['pcd'] = self.pcd[start:start+count, :, :num_points[0]]  # contiguous if the clouds fill the slots
+        else:
+            batch.update(collate_pcd([self.pcd[start+i, :, :num] for i, num in enumerate(num_points)]))
+        return batch
+
+class RingBatchSampler:
+    def __init__(self, batch_sampler:Iterable[List], batch_size:int, num_batches:int):
+        """assign every sample of the k-th batch to slot (k % num_batches) * batch_size + i"""
+        self.batch_sampler = batch_sampler
+        self.batch_size = batch_size
+        self.num_batches = num_batches
+
+    def __iter__(self):
+        for k, indices in enumerate(self.batch_sampler):
+            start = (k % self.num_batches) * self.batch_size
+            yield [(index, start + i) for i, index in enumerate(indices)]
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+class SharedMemoryDataset(Dataset):
+    def __init__(self, dataset:Dataset, ring:SharedRing):
+        """write 'img' and 'pcd' of each sample into its ring slot, only small entries go through the worker queues"""
+        self.dataset = dataset
+        self.ring = ring
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index_slot:Tuple[Union[int, Tuple[int,int]], int]):
+        index, slot = index_slot
+        data = dict(self.dataset[index])
+        self.ring.write(slot, data.pop('img'), data.pop('pcd'))
+        data['slot'] = slot
+        return data
+
+    @staticmethod
+    def collate_fn(zipped_x:Iterable[Dict[str, Union[torch.Tensor, Dict]]]):
+        batch = dict()
+        for key, value in zipped_x[0].items():
+            if key == 'camera_info':
+                batch[key] = collate_camera_info([x[key] for x in zipped_x])
+            elif isinstance(value, torch.Tensor):
+                batch[key] = torch.stack([x[key] for x in zipped_x])
+            elif key == 'slot':
+                batch['slots'] = [x[key] for x in zipped_x]
+            else:
+                batch[key] = [x[key] for x in zipped_x]
+        return batch
+
+class SharedMemoryLoader:
+    def __init__(self, dataset:Dataset, batch_size:Optional[int]=None, shuffle:bool=False, drop_last:bool=False, batch_sampler:Optional[Iterable[List]]=None,
+            num_workers:int=0, prefetch_factor:Optional[int]=None, pin_memory:bool=False, max_points:Optional[int]=None,
+            max_img_size:Optional[Sequence[int]]=None, **dataloader_argv):
+        """DataLoader whose workers write images and point clouds into a `SharedRing` instead of pickling them.
+        The ring holds `num_workers * prefetch_factor + 2` batches: every batch the DataLoader may prefetch,
+        the batch held by the caller and the previous one (whose non_blocking copy may still be running).
+        A yielded batch is only valid until the caller fetches the second next batch (the DataLoader then issues a batch into its slots),
+        copy it (e.g. to the device) before that if it is kept longer.
+
+        Args:
+            dataset (Dataset): returns dicts with fixed-size 'img' (3,H,W) and 'pcd' (3,N) tensors
+            batch_size, shuffle, drop_last, batch_sampler, num_workers, prefetch_factor: same as DataLoader
+            pin_memory (bool, optional): pin the ring instead of copying every batch into pinned memory. Defaults to False.
+            max_points (Optional[int], optional): capacity of a point cloud slot, required if `pcd_sample_num` is None. Defaults to the size of the first sample.
+            max_img_size (Optional[Sequence[int]], optional): (H, W) capacity of an image slot, required if `uint8_img` images differ in size.
+                Defaults to `max_img_size()` of the dataset (also through wrappers such as PerturbDataset), else the size of the first sample.
+            dataloader_argv: other DataLoader arguments, `collate_fn` is replaced
+        """
+        if batch_sampler is None:
+            sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+            batch_sampler = BatchSampler(sampler, batch_size, drop_last)
+        if num_workers > 0 and prefetch_factor is None:
+            prefetch_factor = 2
+        self.num_batches = (num_workers * prefetch_factor if num_workers > 0 else 0) + 2
+        max_batch_size = batch_sampler.batch_size
+        sample = dataset[0]
+        if max_points is None:
+            max_points = sample['pcd'].shape[-1]
+        if max_img_size is None:
+            base = dataset
+            while not hasattr(base, 'max_img_size') and hasattr(base, 'dataset'):  # e.g. PerturbDataset(BaseKITTIDataset)
+                base = base.dataset
+            max_img_size = base.max_img_size() if hasattr(base, 'max_img_size') else sample['img'].shape[-2:]
+        self.ring = SharedRing(self.num_batches * max_batch_size, (3, *max_img_size), max_points, pin_memory, sample['img'].dtype)
+        dataloader_argv['collate_fn'] = SharedMemoryDataset.collate_fn
+        if num_workers > 0:
+            dataloader_argv['prefetch_factor'] = prefetch_factor
+        self.dataset = dataset
+        self.loader = DataLoader(SharedMemoryDataset(dataset, self.ring), batch_sampler=RingBatchSampler(batch_sampler, max_batch_size, self.num_batches),
+            num_workers=num_workers, pin_memory=False, **dataloader_argv)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        for batch in self.loader:
+            slots = batch.pop('slots')
+            batch.update(self.ring.read(slots[0], len(slots)))
+            yield batch
+
+def build_dataloader(dataset:Dataset, dataloader_argv:Dict) -> Union[DataLoader, SharedMemoryLoader]:
+    """DataLoader, or SharedMemoryLoader if `shared_ring: true` is set in the dataloader arguments.
+    `stream: {read_ahead, num_threads}` reads a KITTI dataset in order through KITTIStreamDataset (no shuffling)"""
+    dataloader_argv = dict(dataloader_argv)
+    stream_argv = dataloader_argv.pop('stream', None)
+    if stream_argv is not None:
+        assert not dataloader_argv.pop('shuffle', False), "a streamed dataset cannot be shuffled"
+        dataset = KITTIStreamDataset(dataset, block_size=dataloader_argv.get('batch_size', 1), **stream_argv)
+        dataloader_argv.pop('shared_ring', None)
+    if dataloader_argv.pop('shared_ring', False):
+        return SharedMemoryLoader(dataset, **dataloader_argv)
+    dataloader_argv.pop('max_points', None)
+    dataloader_argv.pop('max_img_size', None)
+    return DataLoader(dataset, **dataloader_argv)
+
+class SceneConcatDataset(Dataset):
+    def __init__(self, datasets:List[Dataset]):
+        """concatenation of per-scene datasets, samples are tagged with 'scene_idx' (position in `datasets`)
+
+        Args:
+            datasets (List[Dataset]): one dataset per scene, e.g. PerturbDataset over NusceneDatasetSeqWrapper
+        """
+        self.datasets = datasets
+        self.scene_lengths = [len(dataset) for dataset in datasets]
+        self.offsets = np.cumsum([0] + self.scene_lengths)
+
+    def __len__(self):
+        return self.offsets[-1].item()
+
+    def __getitem__(self, index:Union[int, Tuple[int,int]]):
+        if isinstance(index, Tuple):
+            scene_idx, sub_idx = index
+        else:
+            scene_idx = np.searchsorted(self.offsets, index, side='right').item() - 1
+            sub_idx = index - self.offsets[scene_idx].item()
+        data = dict(self.datasets[scene_idx][sub_idx])
+        data['scene_idx'] = scene_idx
+        return data
+
+    @property
+    def collate_fn(self):
+        return partial(SceneConcatDataset.collate_scene, collate_fn=getattr(self.datasets[0], 'collate_fn', None))
+
+    @staticmethod
+    def collate_scene(zipped_x:Iterable[Dict[str, Union[torch.Tensor, Dict]]], collate_fn:Optional[Callable]=None):
+        batch = collate_fn(zipped_x) if collate_fn is not None else default_collate([{key:value for key, value in x.items() if key != 'scene_idx'} for x in zipped_x])
+        batch['scene_idx'] = [x['scene_idx'] for x in zipped_x]
         return batch
 
+class SceneBatchSampler(BatchSampler):
+    def __init__(self, scene_lengths:Sequence[int], batch_size:int, drop_last:bool=False):
+        """sequential batches of (scene_idx, sub_idx) that never cross a scene boundary,
+        so that the batches of a scene are exactly those a per-scene DataLoader would produce"""
+        self.scene_lengths = scene_lengths
+        self._batch_size = batch_size
+        self.drop_last = drop_last
+        if drop_last:
+            self.scene_batches = [length // batch_size for length in scene_lengths]
+        else:
+            self.scene_batches = [(length + batch_size - 1) // batch_size for length in scene_lengths]
+
+    def __iter__(self):
+        for scene_idx, (length, num_batches) in enumerate(zip(self.scene_lengths, self.scene_batches)):
+            for k in range(num_batches):
+                yield [(scene_idx, sub_idx) for sub_idx in range(k * self._batch_size, min((k + 1) * self._batch_size, length))]
+
+    def __len__(self):
+        return sum(self.scene_batches)
+
+    @property
+    def batch_size(self) -> int:
+        return self._batch_size
+
+class SceneLoaderView:
+    def __init__(self, loader:'SceneSplitLoader', scene_idx:int):
+        """batches of one scene, drawn from the loader shared by all scenes"""
+        self.loader = loader
+        self.scene_idx = scene_idx
+        self.dataset = loader.dataset.datasets[scene_idx]
+
+    def __len__(self):
+        return self.loader.batch_sampler.scene_batches[self.scene_idx]
+
+    def __iter__(self):
+        return self.loader.iter_scene(self.scene_idx)
+
+class SceneSplitLoader:
+    def __init__(self, datasets:List[Dataset], dataloader_argv:Dict):
+        """one loader over all scenes whose workers live across scene boundaries, split back into per-scene loaders by `scenes()`.
+        Workers fork once and the next scene is prefetched while the current one finishes, instead of one DataLoader per scene.
+        The scenes have to be iterated in order, each one completely.
+
+        Args:
+            datasets (List[Dataset]): one dataset per scene
+            dataloader_argv (Dict): arguments of `build_dataloader`, `batch_size` and `drop_last` go to SceneBatchSampler, `shuffle` must be false
+        """
+        dataloader_argv = dict(dataloader_argv)
+        assert not dataloader_argv.pop('shuffle', False), "scenes are read in order"
+        assert dataloader_argv.pop('stream', None) is None, "stream is only supported for a single KITTI dataset"
+        self.dataset = SceneConcatDataset(datasets)
+        self.batch_sampler = SceneBatchSampler(self.dataset.scene_lengths, dataloader_argv.pop('batch_size', 1), dataloader_argv.pop('drop_last', False))
+        dataloader_argv['collate_fn'] = self.dataset.collate_fn
+        self.loader = build_dataloader(self.dataset, dict(dataloader_argv, batch_sampler=self.batch_sampler))
+        self.iterator = None
+        self.next_scene = 0
+
+    def scenes(self) -> List[SceneLoaderView]:
+        return [SceneLoaderView(self, scene_idx) for scene_idx in range(len(self.dataset.datasets))]
+
+    def iter_scene(self, scene_idx:int):
+        assert scene_idx == self.next_scene, "scene {} requested, but the shared loader is at scene {}".format(scene_idx, self.next_scene)
+        if self.iterator is None:
+            self.iterator = iter(self.loader)
+        for _ in range(self.batch_sampler.scene_batches[scene_idx]):
+            batch = next(self.iterator)
+            batch.pop('scene_idx')
+            yield batch
+        self.next_scene += 1
+        if self.next_scene == len(self.dataset.datasets):  # release the workers
+            self.iterator = None
+
 class LightNuscenes(NuScenes):
     "Light Copy of Nuscenes for Calibration. Data unrelated to calibration are omitted. Decrease loading time from 30.0s to 4.0s."
     def __init__(self, version = 'v1.0-mini', dataroot = '/data/sets/nuscenes', verbose = True, map_resolution = 0.1):
@@ -472,8 +1028,10 @@ class NuSceneDataset(Dataset):
             scene_names:Optional[Union[str,List[str]]]=None, daylight:bool=True,
             cam_sensor_name:Literal['CAM_FRONT','CAM_FRONT_RIGHT','CAM_BACK_RIGHT','CAM_BACK','CAM_BACK_LEFT','CAM_FRONT_LEFT']='CAM_FRONT',
             point_sensor_name:str='LIDAR_TOP', skip_point:int=1,
-            voxel_size:Optional[float]=None, min_dist=0.15, pcd_sample_num=8192,
-            resize_size:Optional[Tuple[int,int]]=None, extend_ratio:Optional[Tuple[float,float]]=None) -> None:
+            voxel_size:Optional[float]=None, min_dist=0.15, pcd_sample_num:Optional[int]=8192,
+            resize_size:Optional[Tuple[int,int]]=None, extend_ratio:Optional[Tuple[float,float]]=None,
+            uint8_img:bool=False,  # (3,H,W) uint8 images decoded at a reduced JPEG scale, resized and normalized by img_to_device
+            frustum_cache:Optional[str]=None) -> None:  # directory of the per-frame extend_ratio crop indices (FrustumIndexCache)
         self.nusc = LightNuscenes(version=version, dataroot=dataroot, verbose=True)
         self.cam_sensor_name = cam_sensor_name
         self.point_sensor_name = point_sensor_name
@@ -513,6 +1071,11 @@ class NuSceneDataset(Dataset):
         self.resample_tran = Resampler(pcd_sample_num)
         self.resize_size = resize_size
         self.extend_ratio = extend_ratio
+        self.uint8_img = uint8_img
+        self.frustum_cache = None
+        if frustum_cache is not None and extend_ratio is not None:
+            self.frustum_cache = FrustumIndexCache(frustum_cache, dict(dataset='nuscenes', cam=cam_sensor_name, lidar=point_sensor_name,
+                resize_size=resize_size, extend_ratio=extend_ratio))
         
     def __len__(self):
         return self.sumsep[-1]
@@ -539,16 +1102,17 @@ class NuSceneDataset(Dataset):
         token = self.sample_tokens_by_scene[group_idx][sub_idx]
         sample = self.nusc.get('sample', token)
         img, pcd, extran, intran = self.get_data(sample, self.cam_sensor_name, self.point_sensor_name)
+        RH, RW = self.resize_size if self.resize_size is not None else (img.height, img.width)
         camera_info = {
             "fx": intran[0,0].item(),
             "fy": intran[1,1].item(),
             "cx": intran[0,2].item(),
             "cy": intran[1,2].item(),
-            "sensor_h": img.height,
-            "sensor_w": img.width,
+            "sensor_h": RH,
+            "sensor_w": RW,
             "projection_mode": "perspective"
         }
-        _img = self.img_tran(img)
+        _img = img_to_uint8(img) if self.uint8_img else self.img_tran(img)
         _pcd = self.tensor_tran(pcd.T)  # (3,N)
         extran = self.tensor_tran(extran)
         return dict(img=_img,pcd=_pcd, camera_info=camera_info, extran=extran, group_idx=group_idx, sub_idx=sub_idx)
@@ -588,31 +1152,33 @@ class NuSceneDataset(Dataset):
         intran[0,:] *= kx
         intran[1,:] *= ky
         if self.extend_ratio is not None:
-            REVH,REVW = self.extend_ratio[0]*RH,self.extend_ratio[1] * RW
-            K_cam_extend = intran.copy()  # K_cam_extend for dilated projection
-            K_cam_extend[0,-1] *= self.extend_ratio[0]
-            K_cam_extend[1,-1] *= self.extend_ratio[1]
-            calibed_pcd = nptran(pcd, extran)
-            *_,rev = transform.binary_projection((REVH,REVW), K_cam_extend, calibed_pcd.T)  # input pcd is (3, N)
+            def crop_fn():
+                REVH,REVW = self.extend_ratio[0]*RH,self.extend_ratio[1] * RW
+                K_cam_extend = intran.copy()  # K_cam_extend for dilated projection
+                K_cam_extend[0,-1] *= self.extend_ratio[0]
+                K_cam_extend[1,-1] *= self.extend_ratio[1]
+                calibed_pcd = nptran(pcd, extran)
+                *_,rev = transform.binary_projection((REVH,REVW), K_cam_extend, calibed_pcd.T)  # input pcd is (3, N)
+                return rev
+            rev = crop_fn() if self.frustum_cache is None else self.frustum_cache.get(camera_token, len(pcd), crop_fn)
             pcd = pcd[rev,:]
         pcd = self.resample_tran(pcd) # (n,3)
-        img = img.resize([RW,RH],Image.Resampling.BILINEAR)
+        if self.uint8_img:
+            img.draft('RGB', (RW, RH))  # reduced-size JPEG decoding, the rest of the resize runs on the device
+        else:
+            img = img.resize([RW,RH],Image.Resampling.BILINEAR)
         # _img = self.img_tran(img)  # raw img input (3,H,W)
         return img, pcd, extran, intran
 
     @staticmethod
     def collate_fn(zipped_x:Iterable[Dict[str, Union[torch.Tensor, Dict]]]):
         batch = dict()
-        batch['img'] = torch.stack([x['img'] for x in zipped_x])
-        batch['pcd'] = torch.stack([x['pcd'] for x in zipped_x])
+        batch.update(collate_img([x['img'] for x in zipped_x]))
+        batch.update(collate_pcd([x['pcd'] for x in zipped_x]))
         batch['extran'] = torch.stack([x['extran'] for x in zipped_x])
         batch['group_idx'] = [x['group_idx'] for x in zipped_x]
         batch['sub_idx'] = [x['sub_idx'] for x in zipped_x]
-        batch['camera_info'] = zipped_x[0]['camera_info']
-        batch['camera_info']['fx'] = torch.tensor([x['camera_info']['fx'] for x in zipped_x], dtype=torch.float32)
-        batch['camera_info']['fy'] = torch.tensor([x['camera_info']['fy'] for x in zipped_x], dtype=torch.float32)
-        batch['camera_info']['cx'] = torch.tensor([x['camera_info']['cx'] for x in zipped_x], dtype=torch.float32)
-        batch['camera_info']['cy'] = torch.tensor([x['camera_info']['cy'] for x in zipped_x], dtype=torch.float32)
+        batch['camera_info'] = collate_camera_info([x['camera_info'] for x in zipped_x])
         return batch
     
 class NusceneDatasetSeqWrapper(Dataset):
@@ -0,0 +1,20 @@
+"""Export the model weights of training checkpoints as weight-only files for testing,
+e.g. python export_weights.py experiments/kitti/lsd/calibnet/checkpoint/best_model.pth --half
+writes experiments/kitti/lsd/calibnet/checkpoint/best_model.weights, which can be used as path.pretrain (or --pretrain)"""
+import argparse
+from pathlib import Path
+from core.tools import export_weights
+from models.util.weights import WEIGHTS_SUFFIX
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("checkpoints",type=str,nargs='+')
+    parser.add_argument("--out_dir",type=str,default=None,help='default: next to each checkpoint')
+    parser.add_argument("--half",action='store_true',help='store floating weights as float16')
+    args = parser.parse_args()
+    for checkpoint in args.checkpoints:
+        out_dir = Path(args.out_dir) if args.out_dir is not None else Path(checkpoint).parent
+        out_dir.mkdir(parents=True, exist_ok=True)
+        file = str(out_dir.joinpath(Path(checkpoint).stem + WEIGHTS_SUFFIX))
+        export_weights(checkpoint, file, args.half)
+        print("{} -> {}".format(checkpoint, file))
@@ -1,9 +1,11 @@
 import os
 import numpy as np
+import torch
 from models.util.nptrans import toMatw
+from models.util import se3, se3_stats
 from scipy.spatial.transform import Rotation
 import argparse
-from typing import Tuple
+from typing import Tuple, List, Optional
 from functools import partial
 from models.util.transform import inv_pose_np
 from collections import OrderedDict
@@ -24,64 +26,126 @@ def rmse_func(pred_x:np.ndarray, gt_se3:np.ndarray) -> Tuple[float, float]:
     return se3_rmse(rot_err).item(), se3_rmse(tsl_err).item()
 
 
-def options():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--pred_dir_root",type=str,default="experiments/kitti/lsd/calibnet/results/unipc_10_2025-02-02-08-04-07")
-    parser.add_argument("--gt_dir",type=str,default="cache/kitti_gt")
-    parser.add_argument("--log_file",type=str,default="log/kitti/main_calibnet.json")
-    return parser.parse_args()
+def fuse_sequence(pred_x:np.ndarray, fusion:str='median', trim:float=0.1) -> Tuple[np.ndarray, np.ndarray]:
+    """sequence-level extrinsic from the per-frame predictions of one sequence
 
+    Args:
+        pred_x (np.ndarray): (N, 6) per-frame twists
+        fusion (str, optional): 'mean' (Karcher), 'median' (geodesic) or 'trimmed' (trimmed Karcher mean). Defaults to 'median'.
+        trim (float, optional): fraction of frames discarded by 'trimmed'. Defaults to 0.1.
 
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (4, 4) fused extrinsic, (6,) std of the frames in the tangent space at it
+    """
+    H = se3.exp(torch.from_numpy(pred_x).to(torch.float64))
+    if fusion == 'mean':
+        mu = se3_stats.karcher_mean(H)
+    elif fusion == 'median':
+        mu = se3_stats.geodesic_median(H)
+    elif fusion == 'trimmed':
+        mu = se3_stats.trimmed_mean(H, trim)
+    else:
+        raise NotImplementedError("Unknown fusion: {}".format(fusion))
+    _, cov = se3_stats.tangent_covariance(H, mu)
+    return mu.numpy(), torch.sqrt(torch.diagonal(cov)).numpy()
 
-if __name__ == "__main__":
-    args = options()
-    gt_files = sorted(os.listdir(args.gt_dir))
-    pred_dirs = sorted(os.listdir(args.pred_dir_root))
-    assert len(gt_files) == len(pred_dirs), "number of gt files ({}) != number of pred subdirs ({})".format(len(gt_files), len(pred_dirs))
+def dir_metrics(name:str, pred_dir:str, gt_se3:np.ndarray, fusion:Optional[str]=None, trim:float=0.1) -> OrderedDict:
+    """metrics of one result dir (one txt file per frame, last row is the final prediction),
+    with `fusion`, also the errors of the sequence-level extrinsic fused from all frames (see `fuse_sequence`)"""
+    pred_files = sorted(os.listdir(pred_dir))
+    R_err = np.zeros([len(pred_files), 3])
+    t_err = np.zeros([len(pred_files), 3])
+    final_x = np.zeros([len(pred_files), 6])
+    decreasing = np.ones(len(pred_files), dtype=np.bool_)
+    for i, pred_file in enumerate(pred_files):
+        pred_se3_i = np.loadtxt(os.path.join(pred_dir, pred_file))
+        if np.ndim(pred_se3_i) == 2:
+            if len(pred_se3_i) >= 10:
+                err_s2, err_s5, err_s10 = map(partial(rmse_func, gt_se3=gt_se3), [pred_se3_i[2], pred_se3_i[5], pred_se3_i[10]])
+                decreasing[i] = (err_s10[0] <= err_s5[0] <= err_s2[0]) and (err_s10[1] <= err_s5[1] <= err_s2[1])
+            pred_se3_i = pred_se3_i[-1]  # sequences of prediction
+        final_x[i] = pred_se3_i
+        R_err_i, t_err_i = se3_err(toMatw(pred_se3_i), gt_se3)
+        R_err[i, :] = R_err_i
+        t_err[i, :] = t_err_i
+    dir_metric = OrderedDict(name=name)
+    dir_metric['Rx'] = np.mean(R_err[:,0])
+    dir_metric['Ry'] = np.mean(R_err[:,1])
+    dir_metric['Rz'] = np.mean(R_err[:,2])
+    dir_metric['tx'] = np.mean(t_err[:,0])
+    dir_metric['ty'] = np.mean(t_err[:,1])
+    dir_metric['tz'] = np.mean(t_err[:,2])
+    R_rmse = np.linalg.norm(R_err, axis=1)
+    t_rmse = np.linalg.norm(t_err, axis=1)
+    dir_metric['R'] = np.mean(R_rmse)
+    dir_metric['t'] = np.mean(t_rmse)
+    dir_metric['3d3c'] = np.sum(np.logical_and(R_rmse < 3, t_rmse < 0.03)) / len(R_rmse)
+    dir_metric['5d5c'] = np.sum(np.logical_and(R_rmse < 5, t_rmse < 0.05)) / len(R_rmse)
+    dir_metric['decreasing_value'] = np.sum(decreasing) / len(decreasing)
+    if fusion is not None:
+        fused_se3, _ = fuse_sequence(final_x, fusion, trim)
+        seq_R_err, seq_t_err = se3_err(fused_se3, gt_se3)
+        dir_metric['seq_R'] = se3_rmse(seq_R_err).item()
+        dir_metric['seq_t'] = se3_rmse(seq_t_err).item()
+    return dir_metric
+
+def gt_file_of(name:str, gt_files:List[str]) -> str:
+    """gt file of a sequence/scene: '{name}.txt' (e.g. nuScenes scenes), else the file keyed by the sequence id of the name
+    ('seq_13' -> '13_gt.txt' or '13.txt')"""
+    by_stem = {Path(gt_file).stem:gt_file for gt_file in gt_files}
+    if name in by_stem:
+        return by_stem[name]
+    by_id = {stem.split('_')[0]:gt_file for stem, gt_file in by_stem.items()}
+    seq_id = name.split('_')[-1]
+    if seq_id in by_id:
+        return by_id[seq_id]
+    raise FileNotFoundError("no gt file of {} in {}".format(name, gt_files))
+
+def summarize(pred_dir_root:str, gt_dir:str, log_file:str, names:Optional[List[str]]=None, fusion:Optional[str]=None, trim:float=0.1):
+    """write [per-dir metrics..., mean metrics] to `log_file` (the summary format read by transfer_table_*.py).
+    Without `names`, all pred subdirs are paired with the gt files in sorted order;
+    with `names` (a subset of the sequences/scenes), the gt file of each name is looked up by `gt_file_of`."""
+    gt_files = sorted(os.listdir(gt_dir))
+    if names is None:
+        pred_dirs = sorted(os.listdir(pred_dir_root))
+        assert len(gt_files) == len(pred_dirs), "number of gt files ({}) != number of pred subdirs ({})".format(len(gt_files), len(pred_dirs))
+    else:
+        pred_dirs = sorted(names)
+        gt_files = [gt_file_of(name, gt_files) for name in pred_dirs]
     names = pred_dirs
     metrics = OrderedDict({"Rx":[], "Ry":[], "Rz":[], "tx":[], "ty":[], "tz":[],"R":[],"t":[], "3d3c":[],"5d5c":[], "decreasing_value":[]})
+    if fusion is not None:
+        metrics.update(seq_R=[], seq_t=[])
     print("Compute metrics on {}".format(names))
     metric_list = []
-    log_path = os.path.dirname(args.log_file)
+    log_path = os.path.dirname(log_file)
     Path(log_path).mkdir(parents=True, exist_ok=True)
-    if os.path.exists(args.log_file):
-        os.remove(args.log_file)
+    if os.path.exists(log_file):
+        os.remove(log_file)
     for name, gt_file, pred_subdir in zip(names, gt_files, pred_dirs):
-        gt_se3 = np.loadtxt(os.path.join(args.gt_dir, gt_file))
-        pred_dir = os.path.join(args.pred_dir_root, pred_subdir)
-        pred_files = sorted(os.listdir(pred_dir))
-        R_err = np.zeros([len(pred_files), 3])
-        t_err = np.zeros([len(pred_files), 3])
-        decreasing = np.ones(len(pred_files), dtype=np.bool_)
-        for i, pred_file in enumerate(pred_files):
-            pred_se3_i = np.loadtxt(os.path.join(pred_dir, pred_file))
-            if np.ndim(pred_se3_i) == 2:
-                if len(pred_se3_i) >= 10:
-                    err_s2, err_s5, err_s10 = map(partial(rmse_func, gt_se3=gt_se3), [pred_se3_i[2], pred_se3_i[5], pred_se3_i[10]])
-                    decreasing[i] = (err_s10[0] <= err_s5[0] <= err_s2[0]) and (err_s10[1] <= err_s5[1] <= err_s2[1])
-                pred_se3_i = pred_se3_i[-1]  # sequences of prediction
-            R_err_i, t_err_i = se3_err(toMatw(pred_se3_i), gt_se3)
-            R_err[i, :] = R_err_i
-            t_err[i, :] = t_err_i
-        dir_metric = OrderedDict(name=name)
-        dir_metric['Rx'] = np.mean(R_err[:,0])
-        dir_metric['Ry'] = np.mean(R_err[:,1])
-        dir_metric['Rz'] = np.mean(R_err[:,2])
-        dir_metric['tx'] = np.mean(t_err[:,0])
-        dir_metric['ty'] = np.mean(t_err[:,1])
-        dir_metric['tz'] = np.mean(t_err[:,2])
-        R_rmse = np.linalg.norm(R_err, axis=1)
-        t_rmse = np.linalg.norm(t_err, axis=1)
-        dir_metric['R'] = np.mean(R_rmse)
-        dir_metric['t'] = np.mean(t_rmse)
-        dir_metric['3d3c'] = np.sum(np.logical_and(R_rmse < 3, t_rmse < 0.03)) / len(R_rmse)
-        dir_metric['5d5c'] = np.sum(np.logical_and(R_rmse < 5, t_rmse < 0.05)) / len(R_rmse)
-        dir_metric['decreasing_value'] = np.sum(decreasing) / len(decreasing)
+        gt_se3 = np.loadtxt(os.path.join(gt_dir, gt_file))
+        dir_metric = dir_metrics(name, os.path.join(pred_dir_root, pred_subdir), gt_se3, fusion, trim)
         metric_list.append(dir_metric)
         for metric in metrics.keys():
             metrics[metric].append(dir_metric[metric])
     for metric in metrics.keys():
         metrics[metric] = sum(metrics[metric]) / len(metrics[metric])
     metric_list.append(metrics)
-    json.dump(metric_list, open(args.log_file,'w'),indent=2)
-    print('log file saved to {}'.format(args.log_file))
\ No newline at end of file
+    json.dump(metric_list, open(log_file,'w'),indent=2)
+    print('log file saved to {}'.format(log_file))
+    return metric_list
+
+def options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pred_dir_root",type=str,default="experiments/kitti/lsd/calibnet/results/unipc_10_2025-02-02-08-04-07")
+    parser.add_argument("--gt_dir",type=str,default="cache/kitti_gt")
+    parser.add_argument("--log_file",type=str,default="log/kitti/main_calibnet.json")
+    parser.add_argument("--fusion",type=str,choices=['mean','median','trimmed'],default=None,help='also evaluate the sequence-level extrinsic fused from all frames')
+    parser.add_argument("--trim",type=float,default=0.1,help='fraction of frames discarded by --fusion trimmed')
+    return parser.parse_args()
+
+
+
+if __name__ == "__main__":
+    args = options()
+    summarize(args.pred_dir_root, args.gt_dir, args.log_file, fusion=args.fusion, trim=args.trim)
@@ -1,6 +1,6 @@
 import torch.nn as nn
 import torch
-from typing import Literal, Dict
+from typing import Literal, Dict, Optional
 import numpy as np
 from ..Modules import resnet18 as custom_resnet18
 from ..tools.core import ResnetEncoder
@@ -52,21 +52,27 @@ class Aggregation(nn.Module):
         return x_rot, x_tr
 
 class CalibNet(nn.Module):
-    def __init__(self, resnet_argv:Dict, depth_resnet_argv:Dict, aggregation_argv:Dict):
+    def __init__(self, resnet_argv:Dict, depth_resnet_argv:Optional[Dict], aggregation_argv:Dict, depth_feat_dim:int=256):
         super(CalibNet,self).__init__()
         self.rgb_resnet = ResnetEncoder(**resnet_argv)  # outplanes = 512
-        self.depth_resnet = custom_resnet18(**depth_resnet_argv)
-        self.aggregation = Aggregation(inplanes=512+256, **aggregation_argv)
+        if depth_resnet_argv is not None:
+            self.depth_resnet = custom_resnet18(**depth_resnet_argv)
+            depth_feat_dim = self.depth_resnet.out_chans[-1]
+        else:  # depth features are given to forward (e.g. by a sparse encoder)
+            self.depth_resnet = None
+        self.depth_feat_dim = depth_feat_dim
+        self.aggregation = Aggregation(inplanes=512+depth_feat_dim, **aggregation_argv)
         self.buffer = dict()
         
-    def forward(self,rgb:torch.Tensor,depth:torch.Tensor):
+    def forward(self,rgb:torch.Tensor,depth:Optional[torch.Tensor],depth_feat:Optional[torch.Tensor]=None):
         # rgb: [B,3,H,W]
         # depth: [B,1,H,W]
+        # depth_feat: [B,C2,H/32,W/32], replaces depth_resnet(depth) if given
         if len(self.buffer.keys()) == 0:
             x1 = self.img_encoding(rgb)
         else:
             x1 = self.get_buffer()
-        x2 = self.depth_resnet(depth)[-1]
+        x2 = self.depth_resnet(depth)[-1] if depth_feat is None else depth_feat
         feat = torch.cat((x1, x2),dim=1)  # [B,C1+C2,H,W]
         x_rot, x_tr = self.aggregation(feat)
         return torch.cat([x_rot, x_tr], dim=1)
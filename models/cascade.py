@@ -0,0 +1,117 @@
+import time
+import torch
+from contextlib import nullcontext
+from typing import Dict, List, Optional
+from .denoiser import Surrogate
+from .util import se3
+
+
+def same_image_encoder(model_a:Surrogate, model_b:Surrogate) -> bool:
+    """whether two surrogates produce the same `restore_buffer` features (same class and identical image-encoder weights)"""
+    encoder_a, encoder_b = model_a.image_encoder(), model_b.image_encoder()
+    if encoder_a is None or encoder_b is None or type(model_a) is not type(model_b):
+        return False
+    state_a, state_b = encoder_a.state_dict(), encoder_b.state_dict()
+    if state_a.keys() != state_b.keys():
+        return False
+    return all(torch.equal(state_a[key], state_b[key].to(state_a[key].device)) for key in state_a.keys())
+
+def slice_camera_info(camera_info:Dict, index:slice) -> Dict:
+    return {key:value[index] if isinstance(value, torch.Tensor) and value.ndim > 0 else value for key, value in camera_info.items()}
+
+class SurrogateCascade:
+    def __init__(self, model_list:List[Surrogate], micro_batch_size:Optional[int]=None):
+        """multi-range cascade, stage k refines the extrinsic predicted by stage k-1
+
+        Args:
+            model_list (List[Surrogate]): stage models, from the largest perturbation range to the smallest
+            micro_batch_size (Optional[int], optional): split a batch into micro-batches so that, on CUDA, stage k of micro-batch i
+                runs on its own stream concurrently with stage k+1 of micro-batch i-1. Defaults to None (no split).
+        """
+        self.model_list = model_list
+        self.micro_batch_size = micro_batch_size
+        # stages sharing image-encoder weights encode the image once (group id = first stage of the group)
+        self.group_idx = []
+        for k, model in enumerate(model_list):
+            group = k
+            for j in range(k):
+                if self.group_idx[j] == j and same_image_encoder(model_list[j], model):
+                    group = j
+                    break
+            self.group_idx.append(group)
+        self.stage_time = [0.0 for _ in model_list]  # latency of each stage in the last call (s)
+
+    @property
+    def num_groups(self) -> int:
+        return len(set(self.group_idx))
+
+    @torch.inference_mode()
+    def __call__(self, img:torch.Tensor, pcd:torch.Tensor, init_extran:torch.Tensor, camera_info:Dict) -> List[torch.Tensor]:
+        """run all stages
+
+        Args:
+            img (torch.Tensor): (B, 3, H, W)
+            pcd (torch.Tensor): (B, 3, N)
+            init_extran (torch.Tensor): (B, 4, 4)
+            camera_info (Dict): batched camera info
+
+        Returns:
+            List[torch.Tensor]: accumulated correction H0 (B, 4, 4) after each stage
+        """
+        batch_size = img.shape[0]
+        micro_batch_size = self.micro_batch_size if self.micro_batch_size is not None else batch_size
+        chunks = [slice(i, min(i + micro_batch_size, batch_size)) for i in range(0, batch_size, micro_batch_size)]
+        n_stage, n_chunk = len(self.model_list), len(chunks)
+        use_cuda = img.is_cuda
+        if use_cuda:
+            streams = [torch.cuda.Stream(device=img.device) for _ in range(n_stage)]
+            for stream in streams:
+                stream.wait_stream(torch.cuda.current_stream(img.device))  # inputs are produced on the default stream
+            start_events = [[torch.cuda.Event(enable_timing=True) for _ in range(n_stage)] for _ in range(n_chunk)]
+            end_events = [[torch.cuda.Event(enable_timing=True) for _ in range(n_stage)] for _ in range(n_chunk)]
+        stage_time = [0.0 for _ in range(n_stage)]
+        H_list = [[None for _ in range(n_stage)] for _ in range(n_chunk)]  # H_list[i][k]: H0 of chunk i after stage k
+        buffers = [dict() for _ in range(n_chunk)]  # buffers[i][group]: cached image features of chunk i
+        # wavefront schedule: at tick t, stage k processes chunk t-k
+        for tick in range(n_chunk + n_stage - 1):
+            for k in range(n_stage):
+                i = tick - k
+                if not 0 <= i < n_chunk:
+                    continue
+                model, group, chunk = self.model_list[k], self.group_idx[k], chunks[i]
+                with torch.cuda.stream(streams[k]) if use_cuda else nullcontext():
+                    if use_cuda:
+                        if k > 0:
+                            streams[k].wait_event(end_events[i][k-1])
+                        start_events[i][k].record(streams[k])
+                    else:
+                        tic = time.perf_counter()
+                    img_i, pcd_i, extran_i = img[chunk], pcd[chunk], init_extran[chunk]
+                    if model.image_encoder() is not None:
+                        if group not in buffers[i]:
+                            buffers[i][group] = dict()
+                            model.swap_buffer(buffers[i][group])
+                            model.restore_buffer(img_i, pcd_i)
+                        else:
+                            model.swap_buffer(buffers[i][group])
+                    H0 = H_list[i][k-1] if k > 0 else torch.eye(4).unsqueeze(0).to(extran_i).expand(len(extran_i), 4, 4)
+                    delta_x = model.forward(img_i, pcd_i, H0 @ extran_i, slice_camera_info(camera_info, chunk))
+                    if not isinstance(delta_x, torch.Tensor):
+                        delta_x = delta_x[-1]
+                    H_list[i][k] = se3.exp(delta_x) @ H0
+                    if use_cuda:
+                        end_events[i][k].record(streams[k])
+                    else:
+                        stage_time[k] += time.perf_counter() - tic
+        if use_cuda:
+            for stream in streams:
+                torch.cuda.current_stream(img.device).wait_stream(stream)
+            torch.cuda.synchronize(img.device)
+            for i in range(n_chunk):
+                for k in range(n_stage):
+                    stage_time[k] += start_events[i][k].elapsed_time(end_events[i][k]) / 1000  # ms -> s
+        for model in self.model_list:
+            if model.image_encoder() is not None:
+                model.swap_buffer(dict())
+        self.stage_time = stage_time
+        return [torch.cat([H_list[i][k] for i in range(n_chunk)], dim=0) for k in range(n_stage)]
@@ -130,16 +130,26 @@ def pair_id_to_image_ids(pair_id):
 
 def array_to_blob(array):
     if IS_PYTHON3:
-        return array.tostring()
+        return array.tobytes()
     else:
         return np.getbuffer(array)
 
 
 def blob_to_array(blob, dtype, shape=(-1,)):
-    if IS_PYTHON3:
-        return np.fromstring(blob, dtype=dtype).reshape(*shape)
-    else:
-        return np.frombuffer(blob, dtype=dtype).reshape(*shape)
+    return np.frombuffer(blob, dtype=dtype).reshape(*shape)
+
+
+# SQLITE_MAX_VARIABLE_NUMBER of older sqlite builds
+MAX_QUERY_PARAMS = 999
+
+
+def concat_with_offsets(arrays, cols, dtype):
+    """concatenate (n_i, cols) arrays into (sum n_i, cols) with (len + 1,) offsets"""
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(array) for array in arrays])
+    if len(arrays) == 0:
+        return np.zeros((0, cols), dtype=dtype), offsets
+    return np.concatenate(arrays, axis=0).astype(dtype, copy=False), offsets
 
 
 class COLMAPDatabase(sqlite3.Connection):
@@ -198,8 +208,8 @@ class COLMAPDatabase(sqlite3.Connection):
         self,
         name,
         camera_id,
-        prior_q=np.full(4, np.NaN),
-        prior_t=np.full(3, np.NaN),
+        prior_q=np.full(4, np.nan),
+        prior_t=np.full(3, np.nan),
         image_id=None,
     ):
         cursor = self.execute(
@@ -290,6 +300,130 @@ class COLMAPDatabase(sqlite3.Connection):
             ),
         )
 
+    def enable_wal(self):
+        """write-ahead logging: writers no longer rewrite a rollback journal per transaction"""
+        self.execute("PRAGMA journal_mode=WAL")
+        self.execute("PRAGMA synchronous=NORMAL")
+
+    def add_images_batch(self, names, camera_ids, image_ids=None):
+        """insert many images in one transaction, returns the image ids"""
+        if image_ids is None:
+            image_ids = [None] * len(names)
+        nan = float("nan")
+        with self:
+            self.executemany(
+                "INSERT INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (image_id, name, camera_id) + (nan,) * 7
+                    for image_id, name, camera_id in zip(
+                        image_ids, names, camera_ids
+                    )
+                ),
+            )
+        return self.read_image_ids(names)
+
+    def add_keypoints_batch(self, image_ids, keypoints_list):
+        """insert the keypoints of many images in one transaction"""
+        rows = []
+        for image_id, keypoints in zip(image_ids, keypoints_list):
+            assert len(keypoints.shape) == 2
+            assert keypoints.shape[1] in [2, 4, 6]
+            keypoints = np.asarray(keypoints, np.float32)
+            rows.append(
+                (image_id,) + keypoints.shape + (array_to_blob(keypoints),)
+            )
+        with self:
+            self.executemany("INSERT INTO keypoints VALUES (?, ?, ?, ?)", rows)
+
+    def add_descriptors_batch(self, image_ids, descriptors_list):
+        """insert the descriptors of many images in one transaction"""
+        rows = []
+        for image_id, descriptors in zip(image_ids, descriptors_list):
+            descriptors = np.ascontiguousarray(descriptors, np.uint8)
+            rows.append(
+                (image_id,) + descriptors.shape + (array_to_blob(descriptors),)
+            )
+        with self:
+            self.executemany(
+                "INSERT INTO descriptors VALUES (?, ?, ?, ?)", rows
+            )
+
+    def add_matches_batch(self, image_pairs, matches_list):
+        """insert the matches of many image pairs in one transaction"""
+        rows = []
+        for (image_id1, image_id2), matches in zip(image_pairs, matches_list):
+            assert len(matches.shape) == 2
+            assert matches.shape[1] == 2
+            if image_id1 > image_id2:
+                matches = matches[:, ::-1]
+            pair_id = image_ids_to_pair_id(image_id1, image_id2)
+            matches = np.ascontiguousarray(matches, np.uint32)
+            rows.append((pair_id,) + matches.shape + (array_to_blob(matches),))
+        with self:
+            self.executemany("INSERT INTO matches VALUES (?, ?, ?, ?)", rows)
+
+    def _select_in(self, query, keys):
+        """run `query` (with a single IN (...) placeholder) over chunks of keys"""
+        keys = list(keys)
+        for i in range(0, len(keys), MAX_QUERY_PARAMS):
+            chunk = keys[i : i + MAX_QUERY_PARAMS]
+            placeholders = ", ".join(["?"] * len(chunk))
+            yield from self.execute(query.format(placeholders), chunk)
+
+    def read_image_ids(self, names):
+        """image ids of the given image names (in the same order)"""
+        name_to_id = dict(
+            self._select_in(
+                "SELECT name, image_id FROM images WHERE name IN ({})", names
+            )
+        )
+        return [name_to_id[name] for name in names]
+
+    def read_keypoints_batch(self, image_ids, cols=2):
+        """keypoints of the given images
+
+        Returns:
+            keypoints (N, cols) float32, concatenated in the order of image_ids
+            offsets (len(image_ids) + 1,): keypoints of image_ids[i] are keypoints[offsets[i]:offsets[i+1]]
+        """
+        data = {
+            image_id: blob_to_array(blob, np.float32, (rows, num_cols))[:, :cols]
+            for image_id, rows, num_cols, blob in self._select_in(
+                "SELECT image_id, rows, cols, data FROM keypoints WHERE image_id IN ({})",
+                set(image_ids),
+            )
+        }
+        empty = np.zeros((0, cols), dtype=np.float32)
+        return concat_with_offsets(
+            [data.get(image_id, empty) for image_id in image_ids],
+            cols,
+            np.float32,
+        )
+
+    def read_matches_batch(self, image_pairs):
+        """matches of the given image pairs
+
+        Returns:
+            matches (M, 2) uint32, columns follow the order of each queried pair
+            offsets (len(image_pairs) + 1,): matches of image_pairs[i] are matches[offsets[i]:offsets[i+1]]
+        """
+        pair_ids = [image_ids_to_pair_id(*pair) for pair in image_pairs]
+        data = {
+            pair_id: blob_to_array(blob, np.uint32, (rows, cols))
+            for pair_id, rows, cols, blob in self._select_in(
+                "SELECT pair_id, rows, cols, data FROM matches WHERE pair_id IN ({})",
+                set(pair_ids),
+            )
+        }
+        empty = np.zeros((0, 2), dtype=np.uint32)
+        matches_list = []
+        for (image_id1, image_id2), pair_id in zip(image_pairs, pair_ids):
+            matches = data.get(pair_id, empty)
+            if image_id1 > image_id2:
+                matches = matches[:, ::-1]
+            matches_list.append(matches)
+        return concat_with_offsets(matches_list, 2, np.uint32)
+
 
 def example_usage():
     import os
@@ -4,6 +4,7 @@ Preprocess script.
 """
 
 import collections
+import json
 import struct
 import numpy as np
 import os
@@ -157,32 +158,14 @@ def read_images_binary(path_to_model_file:str) -> Dict[int, Image]:
         void Reconstruction::ReadImagesBinary(const std::string& path)
         void Reconstruction::WriteImagesBinary(const std::string& path)
     """
+    table = read_images_binary_columnar(path_to_model_file)
     images = {}
-    with open(path_to_model_file, "rb") as fid:
-        num_reg_images = read_next_bytes(fid, 8, "Q")[0]
-        for _ in range(num_reg_images):
-            binary_image_properties = read_next_bytes(
-                fid, num_bytes=64, format_char_sequence="idddddddi")
-            image_id = binary_image_properties[0]
-            qvec = np.array(binary_image_properties[1:5])
-            tvec = np.array(binary_image_properties[5:8])
-            camera_id = binary_image_properties[8]
-            image_name = ""
-            current_char = read_next_bytes(fid, 1, "c")[0]
-            while current_char != b"\x00":   # look for the ASCII 0 entry
-                image_name += current_char.decode("utf-8")
-                current_char = read_next_bytes(fid, 1, "c")[0]
-            num_points2D = read_next_bytes(fid, num_bytes=8,
-                                           format_char_sequence="Q")[0]
-            x_y_id_s = read_next_bytes(fid, num_bytes=24*num_points2D,
-                                       format_char_sequence="ddq"*num_points2D)
-            xys = np.column_stack([tuple(map(float, x_y_id_s[0::3])),
-                                   tuple(map(float, x_y_id_s[1::3]))])
-            point3D_ids = np.array(tuple(map(int, x_y_id_s[2::3])))
-            images[image_id] = Image(
-                id=image_id, qvec=qvec, tvec=tvec,
-                camera_id=camera_id, name=image_name,
-                xys=xys, point3D_ids=point3D_ids)
+    for i, image_id in enumerate(table.ids.tolist()):
+        start, end = table.offsets[i], table.offsets[i+1]
+        images[image_id] = Image(
+            id=image_id, qvec=table.qvecs[i], tvec=table.tvecs[i],
+            camera_id=int(table.camera_ids[i]), name=str(table.names[i]),
+            xys=table.xys[start:end], point3D_ids=table.point3D_ids[start:end])
     return images
 
 
@@ -219,30 +202,154 @@ def read_points3d_binary(path_to_model_file:str) -> Dict[int, Point3D]:
         void Reconstruction::ReadPoints3DBinary(const std::string& path)
         void Reconstruction::WritePoints3DBinary(const std::string& path)
     """
+    table = read_points3d_binary_columnar(path_to_model_file)
     points3D = {}
-    with open(path_to_model_file, "rb") as fid:
-        num_points = read_next_bytes(fid, 8, "Q")[0]
-        for _ in range(num_points):
-            binary_point_line_properties = read_next_bytes(
-                fid, num_bytes=43, format_char_sequence="QdddBBBd")
-            point3D_id = binary_point_line_properties[0]
-            xyz = np.array(binary_point_line_properties[1:4])
-            rgb = np.array(binary_point_line_properties[4:7])
-            error = np.array(binary_point_line_properties[7])
-            track_length = read_next_bytes(
-                fid, num_bytes=8, format_char_sequence="Q")[0]
-            track_elems = read_next_bytes(
-                fid, num_bytes=8*track_length,
-                format_char_sequence="ii"*track_length)
-            image_ids = np.array(tuple(map(int, track_elems[0::2])))
-            point2D_idxs = np.array(tuple(map(int, track_elems[1::2])))
-            points3D[point3D_id] = Point3D(
-                id=point3D_id, xyz=xyz, rgb=rgb,
-                error=error, image_ids=image_ids,
-                point2D_idxs=point2D_idxs)
+    for i, point3D_id in enumerate(table.ids.tolist()):
+        start, end = table.offsets[i], table.offsets[i+1]
+        points3D[point3D_id] = Point3D(
+            id=point3D_id, xyz=table.xyz[i], rgb=table.rgb[i],
+            error=table.error[i], image_ids=table.image_ids[start:end],
+            point2D_idxs=table.point2D_idxs[start:end])
     return points3D
 
 
+#============================ columnar reader ============================#
+ImageTable = collections.namedtuple(
+    "ImageTable", ["ids", "qvecs", "tvecs", "camera_ids", "names", "xys", "point3D_ids", "offsets"])
+Point3DTable = collections.namedtuple(
+    "Point3DTable", ["ids", "xyz", "rgb", "error", "image_ids", "point2D_idxs", "offsets"])
+# offsets: (N+1,) int64, observations of row i are [offsets[i], offsets[i+1]) of the variable-length columns
+
+IMAGE_HEADER_DTYPE = np.dtype([("id", "<i4"), ("qvec", "<f8", 4), ("tvec", "<f8", 3), ("camera_id", "<i4")])  # 64 bytes
+POINT2D_DTYPE = np.dtype([("xy", "<f8", 2), ("point3D_id", "<i8")])  # 24 bytes
+POINT3D_HEADER_DTYPE = np.dtype([("id", "<u8"), ("xyz", "<f8", 3), ("rgb", "u1", 3), ("error", "<f8")])  # 43 bytes
+TRACK_DTYPE = np.dtype([("image_id", "<i4"), ("point2D_idx", "<i4")])  # 8 bytes
+
+
+def gather_ranges(buffer:np.ndarray, starts:np.ndarray, ends:np.ndarray, dtype:np.dtype) -> np.ndarray:
+    """concatenate buffer[starts[i]:ends[i]] of sorted, non-overlapping ranges in one pass and view them as `dtype`"""
+    delta = np.zeros(len(buffer) + 1, dtype=np.int8)
+    delta[starts] += 1
+    delta[ends] -= 1
+    mask = np.cumsum(delta[:-1], dtype=np.int8).astype(np.bool_)
+    return buffer[mask].view(dtype)
+
+
+def read_images_binary_columnar(path_to_model_file:str) -> ImageTable:
+    """read images.bin into columnar arrays.
+    Only the record boundaries are scanned in Python (one step per image, each record starts after the
+    variable-length name and points of the previous one), all fields are decoded by numpy."""
+    with open(path_to_model_file, "rb") as fid:
+        raw = fid.read()
+    buffer = np.frombuffer(raw, dtype=np.uint8)
+    num_reg_images, = struct.unpack_from("<Q", raw, 0)
+    header_starts = [0] * num_reg_images
+    name_ends = [0] * num_reg_images
+    num_points2D = [0] * num_reg_images
+    pos = 8
+    for i in range(num_reg_images):
+        header_starts[i] = pos
+        name_ends[i] = name_end = raw.index(b"\x00", pos + 64)  # look for the ASCII 0 entry
+        num_points2D[i], = struct.unpack_from("<Q", raw, name_end + 1)
+        pos = name_end + 9 + 24 * num_points2D[i]
+    names = [raw[start+64:end].decode("utf-8") for start, end in zip(header_starts, name_ends)]
+    header_starts = np.array(header_starts, dtype=np.int64)
+    point_starts = np.array(name_ends, dtype=np.int64) + 9
+    num_points2D = np.array(num_points2D, dtype=np.int64)
+    headers = gather_ranges(buffer, header_starts, header_starts + 64, IMAGE_HEADER_DTYPE)
+    points2D = gather_ranges(buffer, point_starts, point_starts + 24 * num_points2D, POINT2D_DTYPE)
+    offsets = np.zeros(num_reg_images + 1, dtype=np.int64)
+    np.cumsum(num_points2D, out=offsets[1:])
+    return ImageTable(ids=headers["id"].copy(), qvecs=headers["qvec"].copy(), tvecs=headers["tvec"].copy(),
+                      camera_ids=headers["camera_id"].copy(), names=np.array(names),
+                      xys=points2D["xy"].copy(), point3D_ids=points2D["point3D_id"].copy(), offsets=offsets)
+
+
+def read_points3d_binary_columnar(path_to_model_file:str) -> Point3DTable:
+    """read points3D.bin into columnar arrays.
+    Only the record boundaries are scanned in Python (one step per point, each record starts after the
+    variable-length track of the previous one), all fields are decoded by numpy."""
+    with open(path_to_model_file, "rb") as fid:
+        raw = fid.read()
+    buffer = np.frombuffer(raw, dtype=np.uint8)
+    num_points, = struct.unpack_from("<Q", raw, 0)
+    header_starts = [0] * num_points
+    track_lengths = [0] * num_points
+    unpack_length = struct.Struct("<Q").unpack_from
+    pos = 8
+    for i in range(num_points):
+        header_starts[i] = pos
+        track_lengths[i], = unpack_length(raw, pos + 43)
+        pos += 51 + 8 * track_lengths[i]
+    header_starts = np.array(header_starts, dtype=np.int64)
+    track_lengths = np.array(track_lengths, dtype=np.int64)
+    headers = gather_ranges(buffer, header_starts, header_starts + 43, POINT3D_HEADER_DTYPE)
+    track_starts = header_starts + 51
+    tracks = gather_ranges(buffer, track_starts, track_starts + 8 * track_lengths, TRACK_DTYPE)
+    offsets = np.zeros(num_points + 1, dtype=np.int64)
+    np.cumsum(track_lengths, out=offsets[1:])
+    return Point3DTable(ids=headers["id"].copy(), xyz=headers["xyz"].copy(), rgb=headers["rgb"].copy(),
+                        error=headers["error"].copy(), image_ids=tracks["image_id"].copy(),
+                        point2D_idxs=tracks["point2D_idx"].copy(), offsets=offsets)
+
+
+def source_stamp(path:str) -> Dict[str, int]:
+    """size and modification time of a source file, the cache of its table is rebuilt when they change"""
+    stat = os.stat(path)
+    return dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+
+def save_table(table:tuple, cache_dir:str, stamp:Dict[str, int]=None):
+    """save a columnar table as one .npy per column (loaded memory-mapped by `load_table`),
+    `stamp` of the source file is written last so that an interrupted save is never reused"""
+    os.makedirs(cache_dir, exist_ok=True)
+    stamp_file = os.path.join(cache_dir, "source.json")
+    if os.path.isfile(stamp_file):
+        os.remove(stamp_file)
+    for field, value in zip(table._fields, table):
+        np.save(os.path.join(cache_dir, field + ".npy"), value)
+    if stamp is not None:
+        with open(stamp_file, "w") as f:
+            json.dump(stamp, f)
+
+
+def is_table_cached(table_class:type, cache_dir:str, stamp:Dict[str, int]) -> bool:
+    """all columns exist and were built from a source file with the same `stamp`"""
+    stamp_file = os.path.join(cache_dir, "source.json")
+    if not os.path.isfile(stamp_file) or not all(os.path.isfile(os.path.join(cache_dir, field + ".npy")) for field in table_class._fields):
+        return False
+    with open(stamp_file, "r") as f:
+        return json.load(f) == stamp
+
+
+def load_table(table_class:type, cache_dir:str, mmap:bool=True):
+    mmap_mode = "r" if mmap else None
+    return table_class(*[np.load(os.path.join(cache_dir, field + ".npy"), mmap_mode=mmap_mode) for field in table_class._fields])
+
+
+def read_model_columnar(path:str, cache_dir:str=None, mmap:bool=True):
+    """read cameras/images/points3D (.bin) with the columnar reader.
+    If `cache_dir` is given, the tables are cached there as .npy files and memory-mapped on later calls,
+    a table is rebuilt once the size or modification time of its .bin file changes."""
+    cameras = read_cameras_binary(os.path.join(path, "cameras.bin"))
+    tables = []
+    for table_class, name, reader in [(ImageTable, "images", read_images_binary_columnar),
+                                      (Point3DTable, "points3D", read_points3d_binary_columnar)]:
+        source = os.path.join(path, name + ".bin")
+        table_dir = os.path.join(cache_dir, name) if cache_dir is not None else None
+        stamp = source_stamp(source) if table_dir is not None else None
+        if table_dir is not None and is_table_cached(table_class, table_dir, stamp):
+            tables.append(load_table(table_class, table_dir, mmap))
+            continue
+        table = reader(source)
+        if table_dir is not None:
+            save_table(table, table_dir, stamp)
+            table = load_table(table_class, table_dir, mmap)
+        tables.append(table)
+    images, points3D = tables
+    return cameras, images, points3D
+
+
 def read_model(path:str, ext:str):
     if ext == ".txt":
         cameras = read_cameras_text(os.path.join(path, "cameras" + ext))
@@ -8,12 +8,15 @@ from typing import Dict, Callable, List, Tuple, Literal, Optional, TypeVar
 from abc import abstractmethod
 from .calibnet.CalibNet import CalibNet as VanillaCalibNet
 from .rggnet.rggnet import RGGNet as VanillaRGGNet
+from .rggnet.cache import GTDepthCache
 from .lccnet.LCCNet import LCCNet as VanillaLCCNet
 from .lccraft.convgru import LCCRAFT as VanillaLCCRAFT
 from .tools.core import DepthImgGenerator, BasicBlock, MLPNet
 from functools import partial
 
 class Surrogate(nn.Module):
+    multi_resolution:bool = True  # whether the model accepts images of any size (see Diffuser resolution_schedule)
+
     def __init__(self) -> None:
         super().__init__()
 
@@ -29,15 +32,59 @@ class Surrogate(nn.Module):
     def clear_buffer(self):
         pass
 
+    def image_encoder(self) -> Optional[nn.Module]:
+        """submodule whose output is cached by `restore_buffer`, None if the cache also depends on the point cloud"""
+        return None
+
+    def swap_buffer(self, buffer:Dict) -> Dict:
+        """replace the features cached by `restore_buffer` and return the previous ones"""
+        old_buffer = self.encoder.buffer
+        self.encoder.buffer = buffer
+        return old_buffer
+
+    def repeat_buffer(self, repeats:int):
+        """repeat the features cached by `restore_buffer` along the batch (repeat_interleave),
+        so that each encoded image is shared by `repeats` consecutive samples"""
+        buffer = self.encoder.buffer
+        for key, value in buffer.items():
+            buffer[key] = value.repeat_interleave(repeats, dim=0)
+
+    def select_buffer(self, index:torch.Tensor):
+        """keep the features cached by `restore_buffer` of the samples `index` only (compacts the batch)"""
+        buffer = self.encoder.buffer
+        for key, value in buffer.items():
+            buffer[key] = value.index_select(0, index)
+
+def build_sparse_depth(sparse_depth_argv:Dict, out_chans:List[int], max_depth:float) -> nn.Module:
+    from .tools.scn import SparseDepthEncoder  # spconv is only required by the sparse lidar branch
+    return SparseDepthEncoder(out_chans=out_chans, max_depth=max_depth, **sparse_depth_argv)
+
 class CalibNet(Surrogate):
-    def __init__(self, calibnet_argv:Dict, pcd2depth_argv:Dict):
+    def __init__(self, calibnet_argv:Dict, pcd2depth_argv:Dict, sparse_depth_argv:Optional[Dict]=None):
+        """CalibNet surrogate
+
+        Args:
+            calibnet_argv (Dict): arguments of the vanilla CalibNet
+            pcd2depth_argv (Dict): arguments of DepthImgGenerator
+            sparse_depth_argv (Optional[Dict], optional): if given, replace depth_resnet with a SparseDepthEncoder
+                (voxel_size, layers, strides) on the transformed point cloud. Defaults to None.
+        """
         super().__init__()
-        self.encoder = VanillaCalibNet(**calibnet_argv)
         self.pcd2depth = DepthImgGenerator(**pcd2depth_argv)
+        if sparse_depth_argv is not None:
+            calibnet_argv = dict(calibnet_argv, depth_resnet_argv=None)
+        self.encoder = VanillaCalibNet(**calibnet_argv)
+        if sparse_depth_argv is not None:
+            self.sparse_depth = build_sparse_depth(sparse_depth_argv, [self.encoder.depth_feat_dim], self.pcd2depth.max_depth)
+        else:
+            self.sparse_depth = None
 
     def forward(self, img:torch.Tensor, pcd:torch.Tensor, Tcl:torch.Tensor, camera_info:Dict):
         # pcd_norm = torch.linalg.norm(pcd, dim=1)  # (B, N)
         pcd_tf = se3.transform(Tcl, pcd)
+        if self.sparse_depth is not None:
+            depth_feat = self.sparse_depth(pcd_tf, camera_info, [32])[0]  # aligned with the stride-32 rgb features
+            return self.encoder(img, None, depth_feat)
         depth_img = self.pcd2depth.project(pcd_tf, camera_info)
         x0 = self.encoder(img, depth_img)  # (B, D)
         return x0  # (B, x_dim)
@@ -48,6 +95,9 @@ class CalibNet(Surrogate):
     def clear_buffer(self):
         self.encoder.clear_buffer()
 
+    def image_encoder(self) -> nn.Module:
+        return self.encoder.rgb_resnet
+
 class RGGNet(Surrogate):
     def __init__(self, rggnet_argv:Dict, pcd2depth_argv:Dict, kld_weight:float, ELBO_weight:float):
         super().__init__()
@@ -73,20 +123,47 @@ class RGGNet(Surrogate):
 
     def clear_buffer(self):
         self.encoder.clear_buffer()
+
+    def image_encoder(self) -> nn.Module:
+        return self.encoder.img_encoder
     
     def loss(self, rgb:torch.Tensor, depth:torch.Tensor):
         ELBO = self.encoder.compute_ELBO(rgb, depth, kld_weight=self.kld_weight)
         return ELBO * self.elbo_weight
 
 class LCCNet(Surrogate):
-    def __init__(self, lccnet_argv:Dict, pcd2depth_argv:Dict):
+    multi_resolution = False  # fc1 is sized by lccnet_argv['image_size']
+
+    def __init__(self, lccnet_argv:Dict, pcd2depth_argv:Dict, sparse_depth_argv:Optional[Dict]=None):
+        """LCCNet surrogate
+
+        Args:
+            lccnet_argv (Dict): arguments of the vanilla LCCNet
+            pcd2depth_argv (Dict): arguments of DepthImgGenerator
+            sparse_depth_argv (Optional[Dict], optional): if given, replace the lidar-image resnet with a SparseDepthEncoder
+                (voxel_size, layers, strides) that splats one feature grid per pyramid level used by `use_feat_from`. Defaults to None.
+        """
         super().__init__()
-        self.encoder = VanillaLCCNet(**lccnet_argv)
         self.pcd2depth = DepthImgGenerator(**pcd2depth_argv)
-    
+        if sparse_depth_argv is not None:
+            self.encoder = VanillaLCCNet(**dict(lccnet_argv, dense_lidar=False))
+            # coarse to fine: c26, c25, ... as consumed by the flow decoder
+            self.sparse_levels = list(range(4, 4 - min(self.encoder.use_feat_from, 5), -1))
+            self.sparse_depth = build_sparse_depth(sparse_depth_argv,
+                [self.encoder.lidar_chans[k] for k in self.sparse_levels], self.pcd2depth.max_depth)
+        else:
+            self.encoder = VanillaLCCNet(**lccnet_argv)
+            self.sparse_depth = None
+
     def forward(self, img:torch.Tensor, pcd:torch.Tensor, Tcl:torch.Tensor, camera_info:Dict):
         # pcd_norm = torch.linalg.norm(pcd, dim=1)  # (B, N)
         pcd_tf = se3.transform(Tcl, pcd)
+        if self.sparse_depth is not None:
+            feats = self.sparse_depth(pcd_tf, camera_info, [self.encoder.lidar_strides[k] for k in self.sparse_levels])
+            lidar_feats = [None] * len(self.encoder.lidar_chans)
+            for k, feat in zip(self.sparse_levels, feats):
+                lidar_feats[k] = feat
+            return self.encoder(img, None, lidar_feats)
         depth_img = self.pcd2depth.project(pcd_tf, camera_info)
         x0 = self.encoder(img, depth_img)  # (B, D)
         return x0  # (B, x_dim)
@@ -97,6 +174,9 @@ class LCCNet(Surrogate):
     def clear_buffer(self):
         self.encoder.clear_buffer()
 
+    def image_encoder(self) -> nn.Module:
+        return self.encoder.net_encoder
+
 class LCCRAFT(Surrogate):
     def __init__(self, lccraft_argv:Dict, num_iters:int) -> None:
         super().__init__()
@@ -115,6 +195,9 @@ class LCCRAFT(Surrogate):
     def clear_buffer(self):
         self.encoder.clear_buffer()
 
+    def image_encoder(self) -> nn.Module:
+        return self.encoder.img_feature_encoder
+
     def sequence_loss(self, pred_list:List[torch.Tensor], gt:torch.Tensor, loss_fn:Callable):
         loss = 0
         gamma_prod = 1.0
@@ -306,12 +389,13 @@ class Denoiser(nn.Module):
         self.model.clear_buffer()
 
     def forward(self, x_t:torch.Tensor, x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]):
+        return se3.log(self.forward_se3(se3.exp(x_t), x_cond))
+
+    def forward_se3(self, H_t:torch.Tensor, x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]):
+        """group-valued x0 predictor used by manifold samplers: (B, 4, 4) -> (B, 4, 4)"""
         img, pcd, Tcl, camera_info = x_cond
-        se3_x_t = se3.exp(x_t)
-        Tcl = se3_x_t @ Tcl
-        delta_x0 = self.model(img, pcd, Tcl, camera_info)
-        x0 = se3.exp(delta_x0) @ se3_x_t  # sequentially transformed by se3_x_t and x0
-        return se3.log(x0)
+        delta_x0 = self.model(img, pcd, H_t @ Tcl, camera_info)
+        return se3.exp(delta_x0) @ H_t  # sequentially transformed by H_t and x0
 
 class RGGDenoiser(nn.Module):
     def __init__(self, model:RGGNet):
@@ -326,12 +410,13 @@ class RGGDenoiser(nn.Module):
         self.model.clear_buffer()
 
     def forward(self, x_t:torch.Tensor, x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]):
+        return se3.log(self.forward_se3(se3.exp(x_t), x_cond))
+
+    def forward_se3(self, H_t:torch.Tensor, x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]):
+        """group-valued x0 predictor used by manifold samplers: (B, 4, 4) -> (B, 4, 4)"""
         img, pcd, Tcl, camera_info = x_cond
-        se3_x_t = se3.exp(x_t)
-        Tcl = se3_x_t @ Tcl
-        delta_x0 = self.model(img, pcd, Tcl, camera_info)
-        x0 = se3.exp(delta_x0) @ se3_x_t  # sequentially transformed by se3_x_t and x0
-        return se3.log(x0)
+        delta_x0 = self.model(img, pcd, H_t @ Tcl, camera_info)
+        return se3.exp(delta_x0) @ H_t  # sequentially transformed by H_t and x0
     
     def loss(self, x0_hat:torch.Tensor, x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]):
         img, pcd, Tcl, camera_info = x_cond
@@ -339,6 +424,21 @@ class RGGDenoiser(nn.Module):
         depth = self.model.pcd2depth.project(pcd, camera_info)
         return self.model.loss(img, depth)
 
+    def cached_loss(self, x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor], gt_extran:torch.Tensor, keys:List[str], cache:GTDepthCache):
+        """ELBO on the ground-truth depth, with the depth images and the VAE encoder statistics cached per frame
+
+        Args:
+            x_cond (Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]): img, pcd, init_Tcl, camera_info
+            gt_extran (torch.Tensor): (B, 4, 4) ground-truth extrinsic
+            keys (List[str]): frame keys, see `models.rggnet.cache.frame_keys`
+            cache (GTDepthCache): cache of the training split
+        """
+        img, pcd, Tcl, camera_info = x_cond
+        depth = cache.depth(keys, pcd, gt_extran, camera_info)
+        mu, log_var = cache.vae_stats(keys, self.model.encoder.vae, img, depth)
+        ELBO = self.model.encoder.compute_ELBO_from_stats(depth, mu, log_var, kld_weight=self.model.kld_weight)
+        return ELBO * self.model.elbo_weight
+
 class RAFTDenoiser(nn.Module):
     def __init__(self, model:LCCRAFT):
         super().__init__()
@@ -358,6 +458,12 @@ class RAFTDenoiser(nn.Module):
         x0_list = self.model(img, pcd, Tcl, camera_info)
         x0_list = [se3.log(se3.exp(x0) @ se3_x_t) for x0 in x0_list]  # sequentially transformed by se3_x_t and x0
         return x0_list
+
+    def forward_se3(self, H_t:torch.Tensor, x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]):
+        """group-valued x0 predictor of the final refinement: (B, 4, 4) -> (B, 4, 4)"""
+        img, pcd, Tcl, camera_info = x_cond
+        x0_list = self.model(img, pcd, H_t @ Tcl, camera_info)
+        return se3.exp(x0_list[-1]) @ H_t
     
     def loss(self, loss_fn:Callable):
         return partial(self.model.sequence_loss, loss_fn=loss_fn)
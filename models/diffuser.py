@@ -1,17 +1,18 @@
 import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from inspect import isfunction
 from functools import partial
 import numpy as np
 from tqdm import tqdm
-from typing import Union, Tuple, Literal, Iterable, Dict, Callable, Optional
-from .util import se3
+from typing import Union, Tuple, Literal, Iterable, Dict, Callable, Optional, List
+from .util import se3, se3_stats
 from .denoiser import Denoiser, RAFTDenoiser, RGGDenoiser, Surrogate, LCCRAFT
 from .diffusion_scheduler import DiffusionScheduler
-from .dpm import NoiseScheduleVP, DPM_Solver, model_wrapper
-from .unipc import UniPC
-from .tools.cmsc import CBABatchCorr, CABatchCorr
+from .dpm import NoiseScheduleVP
+from .sampler import BaseSampler, get_sampler
+from .tools.cmsc import CBABatchCorr, CABatchCorr, FrameGeometry
 from .util.transform import inv_pose
 from .loss import geodesic_loss
 from .tools.utils import timer
@@ -102,6 +103,74 @@ def make_beta_schedule(schedule:Literal['quad','linear','warmup10','warmup50','c
 		raise NotImplementedError(schedule)
 	return betas
 
+def scale_camera_info(camera_info:Dict, size:Tuple[int,int]) -> Dict:
+	"""camera_info of the image resized to `size` (h, w) with align_corners=False"""
+	H, W = camera_info['sensor_h'], camera_info['sensor_w']
+	h, w = size
+	sx, sy = w / W, h / H
+	scaled = dict(camera_info, sensor_h=h, sensor_w=w)
+	for key, s, shift in (('fx', sx, False), ('fy', sy, False), ('cx', sx, True), ('cy', sy, True)):
+		scaled[key] = (camera_info[key] + 0.5) * s - 0.5 if shift else camera_info[key] * s
+	if 'intrinsic' in camera_info:  # keep fx/fy/cx/cy as views of the packed intrinsic
+		scaled['intrinsic'] = torch.stack([scaled[key] for key in ('fx', 'fy', 'cx', 'cy')], dim=1)
+		for i, key in enumerate(('fx', 'fy', 'cx', 'cy')):
+			scaled[key] = scaled['intrinsic'][:, i]
+	return scaled
+
+def downscale_condition(x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Dict], scale:float) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Dict]:
+	"""image resized by `scale`, every round(1/scale)-th point and the matching camera_info
+
+	Args:
+		x_cond (Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Dict]): img (B,3,H,W), pcd (B,3,N), Tcl (B,4,4), camera_info
+		scale (float): resolution scale, e.g. 0.5 or 0.25
+
+	Returns:
+		Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Dict]: downscaled condition
+	"""
+	if scale == 1:
+		return x_cond
+	img, pcd, Tcl, camera_info = x_cond
+	size = (max(1, round(camera_info['sensor_h'] * scale)), max(1, round(camera_info['sensor_w'] * scale)))
+	img = F.interpolate(img, size=size, mode='bilinear', align_corners=False, antialias=True)
+	pcd = pcd[..., ::max(1, round(1 / scale))]  # the resamplers shuffle the points, so a stride keeps a uniform subset
+	return img, pcd, Tcl, scale_camera_info(camera_info, size)
+
+def repeat_condition(x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Dict], repeats:int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Dict]:
+	"""repeat every frame of the condition `repeats` times (repeat_interleave along the batch)"""
+	img, pcd, Tcl, camera_info = x_cond
+	repeated = {key:value.repeat_interleave(repeats, dim=0) if isinstance(value, torch.Tensor) and value.ndim > 0 else value for key, value in camera_info.items()}
+	if 'intrinsic' in camera_info:  # keep fx/fy/cx/cy as views of the packed intrinsic
+		for i, key in enumerate(('fx', 'fy', 'cx', 'cy')):
+			repeated[key] = repeated['intrinsic'][:, i]
+	return img.repeat_interleave(repeats, dim=0), pcd.repeat_interleave(repeats, dim=0), Tcl.repeat_interleave(repeats, dim=0), repeated
+
+def select_condition(x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Dict], index:torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Dict]:
+	"""frames `index` of the condition (compacted batch)"""
+	img, pcd, Tcl, camera_info = x_cond
+	selected = {key:value.index_select(0, index.to(value.device)) if isinstance(value, torch.Tensor) and value.ndim > 0 else value for key, value in camera_info.items()}
+	if 'intrinsic' in camera_info:  # keep fx/fy/cx/cy as views of the packed intrinsic
+		for i, key in enumerate(('fx', 'fy', 'cx', 'cy')):
+			selected[key] = selected['intrinsic'][:, i]
+	return img.index_select(0, index), pcd.index_select(0, index), Tcl.index_select(0, index), selected
+
+def trajectory_spread(x0_list:List[torch.Tensor], window:int, scale:Optional[torch.Tensor]=None) -> torch.Tensor:
+	"""per-frame uncertainty: rms geodesic spread of the last `window` intermediate estimates around the final one
+
+	Args:
+		x0_list (List[torch.Tensor]): intermediate twists of a sampler, each (B, 6)
+		window (int): number of trailing estimates
+		scale (Optional[torch.Tensor], optional): (6,) weights of the twist components (rad, m). Defaults to None (all ones).
+
+	Returns:
+		torch.Tensor: (B,)
+	"""
+	H = se3.exp(torch.stack(x0_list[-window:], dim=1))  # (B, W, 4, 4)
+	_, cov = se3_stats.tangent_covariance(H, H[:, -1])
+	var = torch.diagonal(cov, dim1=-2, dim2=-1)  # (B, 6)
+	if scale is not None:
+		var = var * scale.to(var) ** 2
+	return torch.sqrt(var.sum(dim=-1))
+
 class BaseNetwork(nn.Module):
 	def __init__(self, init_type='kaiming', gain=0.02):
 		super(BaseNetwork, self).__init__()
@@ -147,24 +216,44 @@ class BaseNetwork(nn.Module):
 					m.init_weights(self.init_type, self.gain)
 
 class Diffuser(nn.Module):
-	def __init__(self, denoiser:Union[Denoiser,RAFTDenoiser,RGGDenoiser], beta_schedule:Dict, sampling_argv:Dict, sampling_type:Literal['dpm','unipc'], **kwargs):
+	def __init__(self, denoiser:Union[Denoiser,RAFTDenoiser,RGGDenoiser], beta_schedule:Dict, sampling_argv:Dict, sampling_type:Literal['dpm','unipc','se3_multistep'],
+			resolution_schedule:Optional[List[Tuple[float,int]]]=None, num_perturbations:int=1, adaptive_sampling:Optional[Dict]=None, **kwargs):
 		"""Diffuser
 
 		Args:
 			denoiser (Denoiser): Denoiser D(I, P, T_CL)
 			beta_schedule (Dict): _description_
-			sampling_argv (Dict): _description_
+			sampling_argv (Dict): arguments of the sampler
+			sampling_type (str): key of `models.sampler.__classdict__`
+			resolution_schedule (Optional[List[Tuple[float,int]]], optional): coarse-to-fine sampling, [[scale, number of model evaluations], ...]
+				from coarse to fine; the remaining evaluations run at full resolution. Defaults to None (full resolution only).
+			num_perturbations (int, optional): training only, number of noise levels drawn per frame and step.
+				The image of each frame is encoded once and its features are shared by all of them. Defaults to 1.
+			adaptive_sampling (Optional[Dict], optional): uncertainty-driven sampling, see `adaptive_sampling`:
+				coarse_steps, window, threshold, max_ratio (optional), scale (optional). Defaults to None (same steps for every frame).
 		"""
 		super(Diffuser, self).__init__(**kwargs)
 		self.beta_schedule = beta_schedule
 		self.sampling_argv = sampling_argv
 		self.sampling_type = sampling_type
-		if sampling_type == 'dpm':
-			self.sample_fn = self.dpm_sampling
-		elif sampling_type == 'unipc':
-			self.sample_fn = self.unipc_sampling
+		self.resolution_schedule = [(float(scale), int(n)) for scale, n in resolution_schedule] if resolution_schedule is not None else []
+		if len(self.resolution_schedule) > 0:
+			assert denoiser.model.multi_resolution, "{} does not support resolution_schedule".format(denoiser.model.__class__.__name__)
+		self.num_perturbations = num_perturbations
+		self.sampler = get_sampler(sampling_type, **sampling_argv)
+		num_scheduled = sum(n for _, n in self.resolution_schedule)
+		assert num_scheduled < self.sampler.num_evaluations, \
+			"resolution_schedule ({} evaluations) leaves no full-resolution evaluation of the {} of the sampler".format(num_scheduled, self.sampler.num_evaluations)
+		self.adaptive_argv = adaptive_sampling
+		if adaptive_sampling is not None:
+			assert adaptive_sampling['coarse_steps'] < sampling_argv['steps'], "coarse_steps must be less than sampling_argv.steps"
+			coarse_argv = dict(sampling_argv, steps=adaptive_sampling['coarse_steps'])
+			if 'order' in coarse_argv:
+				coarse_argv['order'] = min(coarse_argv['order'], coarse_argv['steps'])
+			self.coarse_sampler = get_sampler(sampling_type, **coarse_argv)
+			self.sample_fn = self.adaptive_sampling
 		else:
-			raise NotImplementedError("sampling type must be 'dpm' or 'unipc'.")
+			self.sample_fn = self.sampling
 		self.x0_fn = denoiser
 		if isinstance(denoiser, RAFTDenoiser):
 			self.seq_loss = True
@@ -254,159 +343,135 @@ class Diffuser(nn.Module):
 		return x_t
 	
 	
-	@torch.inference_mode()
-	def dpm_sampling(self, x_T:torch.Tensor, x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Dict], return_intermediate:bool=False) -> torch.Tensor:
-		def model_fn(x_t:torch.Tensor, t:torch.Tensor, x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Dict]):
-			out = self.x0_fn(x_t, x_cond)
-			if self.seq_loss:
-				out = out[-1]
-			# If the model outputs both 'mean' and 'variance' (such as improved-DDPM and guided-diffusion),
-			# We only use the 'mean' output for DPM-Solver, because DPM-Solver is based on diffusion ODEs.
-			return out
-		self.x0_fn.clear_buffer()
-		self.x0_fn.restore_buffer(x_cond[:2])  # img, pcd, init_Tcl, camera_info
-		noise_schedule = NoiseScheduleVP(schedule='discrete', alphas_cumprod=self.gammas)
-		model_fn_continuous = model_wrapper(
-			model_fn,
-			noise_schedule,
-			model_kwargs={"x_cond":x_cond},
-			model_type='x_start',
-			guidance_type='uncond'
-		)
-		solver = DPM_Solver(
-			model_fn_continuous,
-			noise_schedule,
-			algorithm_type="dpmsolver++"
-		)
-		if return_intermediate:
-			x_0_hat, intermidates = solver.sample(
-				x_T,
-				**self.sampling_argv,
-				return_intermediate=True
-			)
+	def condition_schedule(self, x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Dict]) -> Callable[[], Tuple]:
+		"""condition of the k-th model evaluation following `resolution_schedule`, called once per evaluation.
+		The image features of each resolution are cached in a buffer of their own, encoded on first use.
+		Requires the full-resolution buffer to be restored already."""
+		if len(self.resolution_schedule) == 0:
+			return lambda: x_cond
+		levels = [(downscale_condition(x_cond, scale), n) for scale, n in self.resolution_schedule]
+		buffers = [dict() for _ in levels]
+		full_buffer = self.x0_fn.model.swap_buffer(buffers[0])
+		self.x0_fn.restore_buffer(levels[0][0][:2])
+		state = dict(nfe=0, level=0)
+		def get_condition():
+			nfe, level = state['nfe'], 0
+			state['nfe'] += 1
+			while level < len(levels) and nfe >= levels[level][1]:
+				nfe -= levels[level][1]
+				level += 1
+			if level != state['level']:
+				state['level'] = level
+				if level == len(levels):
+					self.x0_fn.model.swap_buffer(full_buffer)
+				else:
+					self.x0_fn.model.swap_buffer(buffers[level])
+					if len(buffers[level]) == 0:
+						self.x0_fn.restore_buffer(levels[level][0][:2])
+			return x_cond if level == len(levels) else levels[level][0]
+		return get_condition
+
+	def run_sampler(self, sampler:BaseSampler, x_T:torch.Tensor, x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Dict], return_intermediate:bool=False,
+			keep_buffer:bool=False, use_resolution_schedule:bool=True, **guidance_argv):
+		"""run any registered sampler; twists in, twists out regardless of the sampler space.
+		With `keep_buffer`, the caller has restored the buffer of x_cond and it is kept (at full resolution) afterwards.
+		Without `use_resolution_schedule`, every evaluation runs at full resolution."""
+		if not keep_buffer:
 			self.x0_fn.clear_buffer()
-			return x_0_hat, intermidates
+			self.x0_fn.restore_buffer(x_cond[:2])  # img, pcd, init_Tcl, camera_info
+		full_buffer = self.x0_fn.model.encoder.buffer
+		get_condition = self.condition_schedule(x_cond) if use_resolution_schedule else lambda: x_cond
+		noise_schedule = NoiseScheduleVP(schedule='discrete', alphas_cumprod=self.gammas)
+		if sampler.space == 'group':
+			def model_fn(H_t:torch.Tensor, t:torch.Tensor):
+				return self.x0_fn.forward_se3(H_t, get_condition())
+			out = sampler.sample(model_fn, se3.exp(x_T), noise_schedule, return_intermediate=return_intermediate, **guidance_argv)
+			if return_intermediate:
+				out = (se3.log(out[0]), [se3.log(H_t) for H_t in out[1]])
+			else:
+				out = se3.log(out)
+		else:
+			def model_fn(x_t:torch.Tensor, t:torch.Tensor):
+				out = self.x0_fn(x_t, get_condition())
+				if self.seq_loss:
+					out = out[-1]
+				# If the model outputs both 'mean' and 'variance' (such as improved-DDPM and guided-diffusion),
+				# We only use the 'mean' output for DPM-Solver, because DPM-Solver is based on diffusion ODEs.
+				return out
+			out = sampler.sample(model_fn, x_T, noise_schedule, return_intermediate=return_intermediate, **guidance_argv)
+		if keep_buffer:
+			self.x0_fn.model.swap_buffer(full_buffer)
 		else:
-			x_0_hat = solver.sample(
-				x_T,
-				**self.sampling_argv,
-				return_intermediate=False
-			)
 			self.x0_fn.clear_buffer()
-			return x_0_hat
+		return out
+
+	@torch.inference_mode()
+	def sampling(self, x_T:torch.Tensor, x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Dict], return_intermediate:bool=False) -> torch.Tensor:
+		return self.run_sampler(self.sampler, x_T, x_cond, return_intermediate)
+
+	@torch.inference_mode()
+	def adaptive_sampling(self, x_T:torch.Tensor, x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Dict], return_intermediate:bool=False) -> torch.Tensor:
+		"""a cheap pass with `coarse_steps` on the whole batch, then only the uncertain frames (see `trajectory_spread`)
+		are re-sampled with the full `sampling_argv` in a compacted batch. The image features are encoded once.
+		The coarse pass runs at full resolution (no `resolution_schedule`): its estimates are returned for the certain frames.
+		Intermediates of the frames that are not re-sampled are padded with their coarse estimate."""
+		argv = self.adaptive_argv
+		self.x0_fn.clear_buffer()
+		self.x0_fn.restore_buffer(x_cond[:2])
+		x0, x0_list = self.run_sampler(self.coarse_sampler, x_T, x_cond, return_intermediate=True, keep_buffer=True, use_resolution_schedule=False)
+		scale = torch.tensor(argv['scale']) if 'scale' in argv else None
+		spread = trajectory_spread(x0_list, argv.get('window', 3), scale)  # (B,)
+		index = torch.nonzero(spread > argv['threshold'], as_tuple=True)[0]
+		max_num = math.ceil(argv.get('max_ratio', 1.0) * len(spread))
+		if len(index) > max_num:  # the most uncertain ones
+			index = torch.topk(spread, max_num).indices
+		if len(index) > 0:
+			self.x0_fn.model.select_buffer(index)
+			fine_out = self.run_sampler(self.sampler, x_T.index_select(0, index), select_condition(x_cond, index), return_intermediate, keep_buffer=True)
+			x0 = x0.clone()
+			x0[index] = fine_out[0] if return_intermediate else fine_out
+		self.x0_fn.clear_buffer()
+		if not return_intermediate:
+			return x0
+		if len(index) > 0:
+			x0_list = [x0_i.clone() for x0_i in x0_list] + [x0_list[-1].clone() for _ in range(len(fine_out[1]) - len(x0_list))]
+			for x0_i, fine_i in zip(x0_list, fine_out[1]):
+				x0_i[index] = fine_i
+		return x0, x0_list
+
+	@torch.inference_mode()
+	def dpm_sampling(self, x_T:torch.Tensor, x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Dict], return_intermediate:bool=False) -> torch.Tensor:
+		return self.run_sampler(get_sampler('dpm', **self.sampling_argv), x_T, x_cond, return_intermediate)
 	
 	@torch.inference_mode()
 	def unipc_sampling(self, x_T:torch.Tensor, x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Dict], return_intermediate:bool=False) -> torch.Tensor:
-		def model_fn(x_t:torch.Tensor, t:torch.Tensor, x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Dict]):
-			out = self.x0_fn(x_t, x_cond)
-			if self.seq_loss:
-				out = out[-1]
-			# If the model outputs both 'mean' and 'variance' (such as improved-DDPM and guided-diffusion),
-			# We only use the 'mean' output for DPM-Solver, because DPM-Solver is based on diffusion ODEs.
-			return out
-		self.x0_fn.clear_buffer()
-		self.x0_fn.restore_buffer(x_cond[:2])  # img, pcd, init_Tcl, camera_info
-		noise_schedule = NoiseScheduleVP(schedule='discrete', alphas_cumprod=self.gammas)
-		model_fn_continuous = model_wrapper(
-			model_fn,
-			noise_schedule,
-			model_kwargs={"x_cond":x_cond},
-			model_type='x_start',
-			guidance_type='uncond'
-		)
-		solver = UniPC(
-			model_fn_continuous,
-			noise_schedule,
-			algorithm_type="data_prediction",
-			variant='bh1'
-		)
-		if return_intermediate:
-			x_0_hat, intermidates = solver.sample(
-				x_T,
-				**self.sampling_argv,
-				return_intermediate=True
-			)
-			self.x0_fn.clear_buffer()
-			return x_0_hat, intermidates
-		else:
-			x_0_hat = solver.sample(
-				x_T,
-				**self.sampling_argv,
-				return_intermediate=False
-			)
-			self.x0_fn.clear_buffer()
-			return x_0_hat
+		return self.run_sampler(get_sampler('unipc', **self.sampling_argv), x_T, x_cond, return_intermediate)
 
 
 	@torch.no_grad()
 	def dpm_sampling_guidance(self, x_T:torch.Tensor, x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Dict],
 			classifier_fn_argv:Dict, classifer_fn:Callable, return_intermediate:bool=False) -> torch.Tensor:
-		def model_fn(x_t:torch.Tensor, t:torch.Tensor, x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Dict]):
-			out = self.x0_fn(x_t, x_cond)
-			# If the model outputs both 'mean' and 'variance' (such as improved-DDPM and guided-diffusion),
-			# We only use the 'mean' output for DPM-Solver, because DPM-Solver is based on diffusion ODEs.
-			return out
 		def classifier_fn_wrapper(x_t:torch.Tensor, t:torch.Tensor, condition:torch.Tensor, x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Dict]):
 			log_prob = classifer_fn(x_cond[0],x_cond[1], se3.exp(x_t) @ x_cond[2], x_cond[3])
 			return log_prob
-		self.x0_fn.clear_buffer()
-		self.x0_fn.restore_buffer(x_cond[:2])  # img, pcd, init_Tcl, camera_info
-		noise_schedule = NoiseScheduleVP(schedule='discrete', alphas_cumprod=self.gammas)
-		model_fn_continuous = model_wrapper(
-			model_fn,
-			noise_schedule,
-			model_kwargs={"x_cond":x_cond},
-			model_type='x_start',
+		return self.run_sampler(get_sampler('dpm', **self.sampling_argv), x_T, x_cond, return_intermediate,
 			guidance_type='classifier',
 			classifier_fn=classifier_fn_wrapper,
 			classifier_kwargs=dict(x_cond=x_cond),
 			**classifier_fn_argv
 		)
-		solver = DPM_Solver(
-			model_fn_continuous,
-			noise_schedule,
-			algorithm_type="dpmsolver++"
-		)
-		if return_intermediate:
-			x_0_hat, intermidates = solver.sample(
-				x_T,
-				**self.sampling_argv,
-				return_intermediate=True
-			)
-			self.x0_fn.clear_buffer()
-			return x_0_hat, intermidates
-		else:
-			x_0_hat = solver.sample(
-				x_T,
-				**self.sampling_argv,
-				return_intermediate=False
-			)
-			self.x0_fn.clear_buffer()
-			return x_0_hat
 
 
 	@torch.no_grad()
 	def dpm_sampling_with_guidance(self, x_T:torch.Tensor, x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Dict], cba_data:Dict[str,np.ndarray], ca_data:Dict[str,np.ndarray], classifier_fn_argv:Dict, guidance_scale:float, classifier_t_threshold:float,
 			classifier_grad_place_holder:Optional[Iterable]=None, return_intermediate:bool=False) -> torch.Tensor:
 		# x_cond: img, pcd, Tcl, camera_info
-		def model_fn(x_t:torch.Tensor, t:torch.Tensor, x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Dict]):
-			out = self.x0_fn(x_t, x_cond)
-			# If the model outputs both 'mean' and 'variance' (such as improved-DDPM and guided-diffusion),
-			# We only use the 'mean' output for DPM-Solver, because DPM-Solver is based on diffusion ODEs.
-			return out
 		def classifier_fn_wrapper(x_t:torch.Tensor, t:torch.Tensor, condition:torch.Tensor, init_gt:torch.Tensor, camera_info:Dict):
 			loss = classifer_guidance.classifer_fn(x_t, init_gt, camera_info)
 			return loss
-		self.x0_fn.clear_buffer()
-		self.x0_fn.restore_buffer(x_cond[:2])  # img, pcd, init_Tcl, camera_info
-		noise_schedule = NoiseScheduleVP(schedule='discrete', alphas_cumprod=self.gammas)
 		classifer_guidance = GuidanceSampler(**classifier_fn_argv, cba_data=cba_data, ca_data=ca_data)
 		place_holder = torch.tensor(classifier_grad_place_holder, dtype=torch.bool) if classifier_grad_place_holder is not None else None
-		model_fn_continuous = model_wrapper(
-			model_fn,
-			noise_schedule,
-			model_kwargs={"x_cond":x_cond},
-			model_type='x_start',
+		return self.run_sampler(get_sampler('dpm', **self.sampling_argv), x_T, x_cond, return_intermediate,
 			guidance_type='classifier',
 			guidance_scale=guidance_scale,
 			classifier_fn=classifier_fn_wrapper,
@@ -414,27 +479,6 @@ class Diffuser(nn.Module):
 			classifier_t_threshold=classifier_t_threshold,
 			classifier_grad_place_holder=place_holder
 		)
-		solver = DPM_Solver(
-			model_fn_continuous,
-			noise_schedule,
-			algorithm_type="dpmsolver++"
-		)
-		if return_intermediate:
-			x_0_hat, intermidates = solver.sample(
-				x_T,
-				**self.sampling_argv,
-				return_intermediate=True
-			)
-			self.x0_fn.clear_buffer()
-			return x_0_hat, intermidates
-		else:
-			x_0_hat = solver.sample(
-				x_T,
-				**self.sampling_argv,
-				return_intermediate=False
-			)
-			self.x0_fn.clear_buffer()
-			return x_0_hat
 
 	def forward(self, x_0:torch.Tensor, x_cond:Tuple[torch.Tensor, torch.Tensor, Dict], noise=None) -> torch.Tensor:
 		"""Training `theta`(x_t, t) = `epsilon_0`
@@ -446,7 +490,15 @@ class Diffuser(nn.Module):
 
 		Returns:
 			loss: error between x0_hat and x0
+			x_0_hat: prediction, of the first noise level of each frame if num_perturbations > 1
 		"""
+		K = self.num_perturbations
+		if K > 1:  # K noise levels per frame: encode the images once and share the features
+			self.x0_fn.clear_buffer()
+			self.x0_fn.restore_buffer(x_cond[:2])
+			self.x0_fn.model.repeat_buffer(K)
+			x_0 = x_0.repeat_interleave(K, dim=0)
+			x_cond = repeat_condition(x_cond, K)
 		b = x_0.shape[0]
 		t = torch.randint(1, self.num_timesteps, (b,), device=x_0.device).long()  # (b,)
 		gamma_t1 = extract(self.gammas, t-1, x_shape=(1, 1))  # (b, 1, 1)
@@ -459,16 +511,27 @@ class Diffuser(nn.Module):
 		loss = self.loss_fn(x_0_hat, x_0)
 		if self.seq_loss:
 			x_0_hat = x_0_hat[-1]
+		if K > 1:
+			self.x0_fn.clear_buffer()
+			x_0_hat = x_0_hat[::K]
 		return loss, x_0_hat
 
 class SE3Diffuser(nn.Module):
-	def __init__(self, surrogate:Surrogate, train_scheduler_argv:Dict, val_scheduler_argv:Dict):
+	def __init__(self, surrogate:Surrogate, train_scheduler_argv:Dict, val_scheduler_argv:Dict,
+			sampling_type:Literal['nlsd','se3_multistep']='nlsd', sampling_argv:Optional[Dict]=None, num_perturbations:int=1):
 		super().__init__()
 		self.model = surrogate
+		self.num_perturbations = num_perturbations  # training perturbations per frame and step, see Diffuser
 		self.train_scheduler = DiffusionScheduler(train_scheduler_argv)
 		self.train_scheduler_argv = train_scheduler_argv
 		self.val_scheduler = DiffusionScheduler(val_scheduler_argv)
 		self.val_scheduler_argv = val_scheduler_argv
+		self.sampling_type = sampling_type
+		if sampling_type == 'nlsd':
+			self.sampler = get_sampler(sampling_type, scheduler_argv=val_scheduler_argv)
+		else:
+			sampling_argv = default(sampling_argv, dict(steps=val_scheduler_argv['n_diff_steps']))
+			self.sampler = get_sampler(sampling_type, **sampling_argv)
 		if isinstance(surrogate, LCCRAFT):
 			self.seq_loss = True
 		else:
@@ -481,36 +544,30 @@ class SE3Diffuser(nn.Module):
 	def sampling(self, x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Dict], return_intermediate:bool=False):
 		img, pcd, Tcl, camera_info = x_cond
 		B = img.shape[0]
-		H_t = torch.eye(4).unsqueeze(0).expand(B, -1, -1).to(Tcl)
-		H_t_list = [H_t.clone()]
-		self.model.restore_buffer(img, pcd)
-		for t in range(self.val_scheduler_argv['n_diff_steps']+1, 1, -1):  # [T, T-1, ..., 1]
+		H_T = torch.eye(4).unsqueeze(0).expand(B, -1, -1).to(Tcl)
+		def model_fn(H_t:torch.Tensor, t:torch.Tensor):
 			pred_x = self.model(img, pcd, H_t @ Tcl, camera_info)
 			if isinstance(pred_x, (tuple, list)):
 				pred_x = pred_x[-1]
-			delta_H_t = se3.exp(pred_x)  # (B, 4, 4) H_t_to_0
-			H_0 = delta_H_t @ H_t
-			gamma0 = self.val_scheduler.gamma0[t]
-			gamma1 = self.val_scheduler.gamma1[t]
-			H_t = se3.exp(gamma0 * se3.log(delta_H_t) + gamma1 * se3.log(H_t))
-			### noise
-			if self.val_scheduler_argv['add_noise'] and t > 1:
-				alpha_bar = self.val_scheduler.alpha_bars[t]
-				alpha_bar_ = self.val_scheduler.alpha_bars[t-1]
-				beta = self.val_scheduler.betas[t]
-				cc = ((1 - alpha_bar_) / (1.- alpha_bar)) * beta
-				scale = torch.cat([torch.ones(3) * self.val_scheduler_argv['sigma_r'], torch.ones(3) * self.val_scheduler_argv['sigma_t']])[None].to(Tcl)  # [1, 6]
-				noise = torch.sqrt(cc) * scale * torch.randn(B, 6).to(Tcl)  # [B, 6]
-				H_noise = se3.exp(noise)
-				H_t = H_noise @ H_t  # [B, 4, 4]
-			H_t_list.append(H_0.clone())
+			return se3.exp(pred_x) @ H_t  # (B, 4, 4) H_0
+		# the training interpolation H_t = exp((1 - sqrt(alpha_bar)) * log(H_0^-1)) @ H_0 is a VP path with x_T = I
+		noise_schedule = NoiseScheduleVP(schedule='discrete', alphas_cumprod=self.train_scheduler.alpha_bars[1:])
+		self.model.restore_buffer(img, pcd)
+		out = self.sampler.sample(model_fn, H_T, noise_schedule, return_intermediate=return_intermediate)
 		self.model.clear_buffer()
 		if return_intermediate:
-			return H_t_list
+			return out[1]
 		else:
-			return H_t
+			return out
 	
 	def forward(self, H_0:torch.Tensor, x_cond:Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Dict]):
+		K = self.num_perturbations
+		if K > 1:  # K noise levels per frame: encode the images once and share the features
+			self.model.clear_buffer()
+			self.model.restore_buffer(x_cond[0], x_cond[1])
+			self.model.repeat_buffer(K)
+			H_0 = H_0.repeat_interleave(K, dim=0)
+			x_cond = repeat_condition(x_cond, K)
 		img, pcd, Tcl, camera_info = x_cond
 		B = img.shape[0]
 		H_T = torch.eye(4).unsqueeze(0).expand(B, -1, -1).to(H_0)
@@ -532,6 +589,9 @@ class SE3Diffuser(nn.Module):
 			pred_x = pred_x[-1]
 		x0_hat = se3.log(se3.exp(pred_x) @ H_t_noise)
 		loss = self.loss_fn(x0_hat, x0)
+		if K > 1:
+			self.model.clear_buffer()
+			x0_hat = x0_hat[::K]
 		return loss, x0_hat
 
 class GuidanceSampler:
@@ -540,6 +600,8 @@ class GuidanceSampler:
 		self.ca_data = ca_data
 		self.cba_data.update(cba_argv)
 		self.ca_data.update(ca_argv)
+		if 'geometry' not in self.ca_data:  # normals and KD-tree of the frame are built once for all solver steps
+			self.ca_data['geometry'] = FrameGeometry(self.ca_data['pcd'], self.ca_data.get('normal_radius', 0.6), self.ca_data.get('noraml_knn', 10))
 		self.loss = loss_fn
 		self.pcd_tran = lambda x,dev: torch.from_numpy(x).to(dev).transpose(-1,-2).unsqueeze(0)
 
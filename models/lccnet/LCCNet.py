@@ -7,7 +7,6 @@ Modified version (LCCNet) by Xudong Lv
 
 import torch
 import numpy as np
-from torch.autograd import Variable
 # import torch.utils.model_zoo as model_zoo
 #from models.CMRNet.modules.attention import *
 import torch.nn as nn
@@ -25,8 +24,12 @@ from typing import Literal, Tuple, Dict
 
 # from .networks.submodules import *
 # from .networks.correlation_package.correlation import Correlation
-from .correlation_package.correlation import Correlation
+try:
+    from .correlation_package.correlation import Correlation
+except ImportError:  # correlation_cuda is not built (CPU-only or CUDA >= 12)
+    Correlation = None
 from ..tools.core import ResnetEncoder
+from ..tools.csrc import correlation2d
 
 # __all__ = [
 #     'calib_net'
@@ -184,15 +187,63 @@ def predict_flow(in_planes):
 def deconv(in_planes, out_planes, kernel_size=4, stride=2, padding=1):
     return nn.ConvTranspose2d(in_planes, out_planes, kernel_size, stride, padding, bias=True)
 
+class CostVolume(nn.Module):
+    def __init__(self, md:int):
+        """correlation of the csrc package, same output as `Correlation(pad_size=md, kernel_size=1, max_displacement=md, stride1=1, stride2=1)`:
+        channel (dy + md) * (2md + 1) + (dx + md) is the channel mean of input1 * input2 shifted by (dy, dx).
+        Runs the csrc CUDA kernel if it is built, otherwise a pure PyTorch loop (CPU or any CUDA version)."""
+        super().__init__()
+        self.md = md
+
+    def forward(self, input1:torch.Tensor, input2:torch.Tensor) -> torch.Tensor:
+        return correlation2d(input1, input2, self.md, cpp_impl=input1.is_cuda).to(input1.dtype)
+
+class FlowWarp(nn.Module):
+    def __init__(self):
+        """backward warping by optical flow. The normalized base grid of each feature size is cached,
+        and the validity mask is computed from the sampling coordinates instead of warping a tensor of ones."""
+        super().__init__()
+        self.grids = dict()
+
+    def base_grid(self, H:int, W:int, device:torch.device, dtype:torch.dtype) -> Tuple[torch.Tensor, torch.Tensor]:
+        """normalized grid (1,H,W,2) and the flow scale (2,) of the pixel -> [-1,1] mapping 2 * x / (W - 1) - 1"""
+        key = (H, W, device, dtype)
+        if key not in self.grids:
+            scale = torch.tensor([2.0 / max(W - 1, 1), 2.0 / max(H - 1, 1)], device=device, dtype=dtype)
+            yy, xx = torch.meshgrid(torch.arange(H, device=device, dtype=dtype), torch.arange(W, device=device, dtype=dtype), indexing='ij')
+            grid = torch.stack((xx, yy), dim=-1) * scale - 1.0
+            self.grids[key] = (grid.unsqueeze(0), scale)
+        return self.grids[key]
+
+    def forward(self, x:torch.Tensor, flo:torch.Tensor) -> torch.Tensor:
+        """
+        warp an image/tensor (im2) back to im1, according to the optical flow
+        x: [B, C, H, W] (im2)
+        flo: [B, 2, H, W] flow
+        """
+        B, C, H, W = x.size()
+        grid, scale = self.base_grid(H, W, x.device, flo.dtype)
+        vgrid = grid + flo.permute(0, 2, 3, 1) * scale
+        output = F.grid_sample(x, vgrid, align_corners=False)
+        # grid_sample(ones) == 1 iff both bilinear taps are inside, i.e. 0 <= (vgrid + 1) * size / 2 - 0.5 <= size - 1
+        size = torch.tensor([W, H], device=x.device, dtype=vgrid.dtype)
+        pix = (vgrid + 1.0) * size / 2 - 0.5
+        mask = torch.logical_and(pix >= 0, pix <= size - 1).all(dim=-1, keepdim=True)  # [B, H, W, 1]
+        return output * mask.permute(0, 3, 1, 2).to(output.dtype)
+
 class LCCNet(nn.Module):
     """
     Based on the PWC-DC net. add resnet encoder, dilation convolution and densenet connections
     """
 
     def __init__(self, resnet_argv:Dict, image_size:Tuple[int,int], use_feat_from=1, md=4, use_reflectance=False, dropout=0.0,
-                 Action_Func:Literal['leakyrelu','relu','elu']='leakyrelu', attention=False):
+                 Action_Func:Literal['leakyrelu','relu','elu']='leakyrelu', attention=False, dense_lidar=True,
+                 corr_backend:Literal['auto','lccnet','csrc']='auto'):
         """
         input: md --- maximum displacement (for correlation. default: 4), after warpping
+        dense_lidar --- build the lidar-image resnet, set False if the lidar features are given to forward (e.g. by a sparse encoder)
+        corr_backend --- 'lccnet': the original correlation_cuda package, 'csrc': CostVolume (no external package, also on CPU),
+            'auto': correlation_cuda if it is installed, otherwise csrc. The outputs are the same, so the weights are interchangeable.
         """
         super(LCCNet, self).__init__()
         input_lidar = 1
@@ -230,18 +281,29 @@ class LCCNet(nn.Module):
                 block = BasicBlock
 
         # lidar_image
-        self.inplanes = 64
-        self.conv1_lidar = nn.Conv2d(input_lidar, 64, kernel_size=7, stride=2, padding=3)
-        self.elu_lidar = nn.ELU()
-        self.leakyRELU_lidar = nn.LeakyReLU(0.1)
-        self.relu_lidar = nn.ReLU()
-        self.maxpool_lidar = nn.MaxPool2d(kernel_size=3, stride=2, padding=1)
-        self.layer1_lidar = self._make_layer(block, 64, layers[0])
-        self.layer2_lidar = self._make_layer(block, 128, layers[1], stride=2)
-        self.layer3_lidar = self._make_layer(block, 256, layers[2], stride=2)
-        self.layer4_lidar = self._make_layer(block, 512, layers[3], stride=2)
-
-        self.corr = Correlation(pad_size=md, kernel_size=1, max_displacement=md, stride1=1, stride2=1, corr_multiply=1)
+        self.dense_lidar = dense_lidar
+        self.lidar_chans = [64] + [planes * block.expansion for planes in (64, 128, 256, 512)]  # c22, c23, c24, c25, c26
+        self.lidar_strides = [2, 4, 8, 16, 32]
+        if dense_lidar:
+            self.inplanes = 64
+            self.conv1_lidar = nn.Conv2d(input_lidar, 64, kernel_size=7, stride=2, padding=3)
+            self.elu_lidar = nn.ELU()
+            self.leakyRELU_lidar = nn.LeakyReLU(0.1)
+            self.relu_lidar = nn.ReLU()
+            self.maxpool_lidar = nn.MaxPool2d(kernel_size=3, stride=2, padding=1)
+            self.layer1_lidar = self._make_layer(block, 64, layers[0])
+            self.layer2_lidar = self._make_layer(block, 128, layers[1], stride=2)
+            self.layer3_lidar = self._make_layer(block, 256, layers[2], stride=2)
+            self.layer4_lidar = self._make_layer(block, 512, layers[3], stride=2)
+
+        if corr_backend == 'auto':
+            corr_backend = 'lccnet' if Correlation is not None else 'csrc'
+        if corr_backend == 'lccnet':
+            assert Correlation is not None, "correlation_cuda is not installed, use corr_backend='csrc'"
+            self.corr = Correlation(pad_size=md, kernel_size=1, max_displacement=md, stride1=1, stride2=1, corr_multiply=1)
+        else:
+            self.corr = CostVolume(md)
+        self.warp = FlowWarp()
         self.leakyRELU = nn.LeakyReLU(0.1)
 
         nd = (2 * md + 1) ** 2
@@ -370,44 +432,6 @@ class LCCNet(nn.Module):
 
         return nn.Sequential(*layers)
 
-
-    def warp(self, x, flo):
-        """
-        warp an image/tensor (im2) back to im1, according to the optical flow
-        x: [B, C, H, W] (im2)
-        flo: [B, 2, H, W] flow
-        """
-        B, C, H, W = x.size()
-        # mesh grid
-        xx = torch.arange(0, W).view(1, -1).repeat(H, 1)
-        yy = torch.arange(0, H).view(-1, 1).repeat(1, W)
-        xx = xx.view(1, 1, H, W).repeat(B, 1, 1, 1)
-        yy = yy.view(1, 1, H, W).repeat(B, 1, 1, 1)
-        grid = torch.cat((xx, yy), 1).float()
-
-        if x.is_cuda:
-            grid = grid.cuda()
-        vgrid = Variable(grid) + flo
-
-        # scale grid to [-1,1]
-        vgrid[:, 0, :, :] = 2.0 * vgrid[:, 0, :, :].clone() / max(W - 1, 1) - 1.0
-        vgrid[:, 1, :, :] = 2.0 * vgrid[:, 1, :, :].clone() / max(H - 1, 1) - 1.0
-
-        vgrid = vgrid.permute(0, 2, 3, 1)
-        output = nn.functional.grid_sample(x, vgrid, align_corners=False)
-        mask = torch.autograd.Variable(torch.ones(x.size())).cuda()
-        mask = nn.functional.grid_sample(mask, vgrid, align_corners=False)
-
-        # if W==128:
-        # np.save('mask.npy', mask.cpu().data.numpy())
-        # np.save('warp.npy', output.cpu().data.numpy())
-
-        # mask[mask<0.9999] = 0.0
-        # mask[mask>0] = 1.0
-        mask = torch.floor(torch.clamp(mask, 0, 1))
-
-        return output * mask
-
     def img_encoding(self, rgb:torch.Tensor):
         features1 = self.net_encoder(rgb)
         c12 = features1[0]  # 2
@@ -431,7 +455,16 @@ class LCCNet(nn.Module):
     def clear_buffer(self):
         self.buffer.clear()
 
-    def forward(self, rgb, lidar):
+    def lidar_encoding(self, lidar:torch.Tensor):
+        x2 = self.conv1_lidar(lidar)
+        c22 = self.activate_func(x2)
+        c23 = self.layer1_lidar(self.maxpool_lidar(c22))  # 4
+        c24 = self.layer2_lidar(c23)  # 8
+        c25 = self.layer3_lidar(c24)  # 16
+        c26 = self.layer4_lidar(c25)  # 32
+        return c22, c23, c24, c25, c26
+
+    def forward(self, rgb, lidar, lidar_feats=None):
         # H, W = rgb.shape[2:4]
         #encoder
         if len(self.buffer.keys()) == 0:
@@ -439,13 +472,11 @@ class LCCNet(nn.Module):
         else:
             c12, c13, c14, c15, c16 = self.get_buffer()
 
-        # lidar_image
-        x2 = self.conv1_lidar(lidar)
-        c22 = self.activate_func(x2)
-        c23 = self.layer1_lidar(self.maxpool_lidar(c22))  # 4
-        c24 = self.layer2_lidar(c23)  # 8
-        c25 = self.layer3_lidar(c24)  # 16
-        c26 = self.layer4_lidar(c25)  # 32
+        # lidar_image, lidar_feats: (c22, c23, c24, c25, c26), levels unused by use_feat_from can be None
+        if lidar_feats is None:
+            c22, c23, c24, c25, c26 = self.lidar_encoding(lidar)
+        else:
+            c22, c23, c24, c25, c26 = lidar_feats
 
         corr6 = self.corr(c16, c26) #[1, 81, 8, 16]
         corr6 = self.leakyRELU(corr6)
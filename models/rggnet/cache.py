@@ -0,0 +1,96 @@
+import os
+import torch
+from typing import Dict, List, Optional, Tuple
+from ..tools.core import DepthImgGenerator
+from ..util import se3
+from .vae import VanillaVAE
+
+def frame_keys(group_idx:List[int], sub_idx:List[int]) -> List[str]:
+    """cache keys of the frames of a batch ('group_idx', 'sub_idx' of the collated batch)"""
+    return ["{}_{}".format(group, sub) for group, sub in zip(group_idx, sub_idx)]
+
+def to_sparse(depth:torch.Tensor) -> Dict[str, torch.Tensor]:
+    """(1,H,W) depth image -> flat indices (int32) and values of its non-empty pixels"""
+    flat = depth.reshape(-1)
+    index = torch.nonzero(flat, as_tuple=True)[0]
+    return dict(index=index.to(torch.int32).cpu(), value=flat[index].cpu(), shape=torch.tensor(depth.shape))
+
+def to_dense(sparse:Dict[str, torch.Tensor], device:torch.device) -> torch.Tensor:
+    depth = torch.zeros(sparse['shape'].prod().item(), dtype=sparse['value'].dtype, device=device)
+    depth[sparse['index'].to(device, torch.long)] = sparse['value'].to(device)
+    return depth.view(*sparse['shape'].tolist())
+
+class GTDepthCache:
+    def __init__(self, cache_dir:str, depth_generator:DepthImgGenerator, cache_vae_stats:bool=False, in_memory:bool=True):
+        """per-frame cache of the depth image projected with the ground-truth extrinsic (sparse, one file per frame)
+        and optionally of the statistics (mu, log_var) of a frozen VAE encoder on (rgb, depth).
+        Entries are computed the first time a frame is seen and reused in later epochs and runs;
+        the point subset drawn by the dataset resampler in that first pass is kept.
+
+        Args:
+            cache_dir (str): one directory per dataset split, frames are keyed by (group_idx, sub_idx)
+            depth_generator (DepthImgGenerator): projection of the cached depth
+            cache_vae_stats (bool, optional): also cache the VAE encoder statistics, only valid while the VAE is frozen. Defaults to False.
+            in_memory (bool, optional): keep loaded entries in memory as well. Defaults to True.
+        """
+        self.cache_dir = cache_dir
+        self.depth_generator = depth_generator
+        self.cache_vae_stats = cache_vae_stats
+        self.in_memory = in_memory
+        self.entries:Dict[str, Dict[str, torch.Tensor]] = dict()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def file(self, key:str) -> str:
+        return os.path.join(self.cache_dir, "{}.pt".format(key))
+
+    def get(self, key:str) -> Optional[Dict[str, torch.Tensor]]:
+        if key in self.entries:
+            return self.entries[key]
+        if not os.path.isfile(self.file(key)):
+            return None
+        entry = torch.load(self.file(key), map_location='cpu')
+        if self.in_memory:
+            self.entries[key] = entry
+        return entry
+
+    def put(self, key:str, entry:Dict[str, torch.Tensor]):
+        tmp_file = self.file(key) + '.tmp'
+        torch.save(entry, tmp_file)
+        os.replace(tmp_file, self.file(key))  # concurrent runs never read a partial file
+        if self.in_memory:
+            self.entries[key] = entry
+
+    @torch.no_grad()
+    def depth(self, keys:List[str], pcd:torch.Tensor, gt_extran:torch.Tensor, camera_info:Dict) -> torch.Tensor:
+        """ground-truth depth images (B,1,H,W), projected only if a frame of the batch is not cached yet
+
+        Args:
+            keys (List[str]): frame keys, see `frame_keys`
+            pcd (torch.Tensor): (B,3,N) LiDAR points
+            gt_extran (torch.Tensor): (B,4,4) ground-truth extrinsic
+            camera_info (Dict): project information
+        """
+        entries = [self.get(key) for key in keys]
+        if any(entry is None for entry in entries):
+            depth = self.depth_generator.project(se3.transform(gt_extran, pcd), camera_info)
+            for i, (key, entry) in enumerate(zip(keys, entries)):
+                if entry is None:
+                    entries[i] = dict(depth=to_sparse(depth[i]))
+                    self.put(key, entries[i])
+            return depth
+        return torch.stack([to_dense(entry['depth'], pcd.device) for entry in entries])
+
+    @torch.no_grad()
+    def vae_stats(self, keys:List[str], vae:VanillaVAE, rgb:torch.Tensor, depth:torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """(mu, log_var) of the VAE encoder on (rgb, depth), computed only if a frame of the batch is not cached yet"""
+        entries = [self.get(key) for key in keys]
+        if not self.cache_vae_stats or any(entry is None or 'mu' not in entry for entry in entries):
+            mu, log_var = vae.encode(torch.cat([rgb, depth], dim=1))
+            if self.cache_vae_stats:
+                for i, (key, entry) in enumerate(zip(keys, entries)):
+                    if entry is None or 'mu' not in entry:
+                        self.put(key, dict(entry or dict(), mu=mu[i].cpu(), log_var=log_var[i].cpu()))
+            return mu, log_var
+        mu = torch.stack([entry['mu'] for entry in entries]).to(rgb.device)
+        log_var = torch.stack([entry['log_var'] for entry in entries]).to(rgb.device)
+        return mu, log_var
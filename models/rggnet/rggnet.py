@@ -6,6 +6,7 @@ from ..Modules import resnet18 as custom_resnet18
 from ..tools.core import MLPNet, get_activation_func
 from .vae import VanillaVAE as VAE
 from ..tools.core import ResnetEncoder
+from ..util.weights import load_model_state
 
 class RGGNet(nn.Module):
     def __init__(self,
@@ -19,7 +20,7 @@ class RGGNet(nn.Module):
         super().__init__()
         self.vae = VAE(**vae_argv)
         self.vae_img_size = vae_argv.get('img_size')
-        self.vae.load_state_dict(torch.load(vae_path, map_location='cpu')['model'])
+        self.vae.load_state_dict(load_model_state(vae_path))  # .pth checkpoint or .weights file
         self.vae.requires_grad_(False)
         activation_fn = get_activation_func(activation, inplace)
         self.img_encoder = ResnetEncoder(**resnet_argv)
@@ -53,6 +54,12 @@ class RGGNet(nn.Module):
         ELBO = self.vae.loss_function(depth, x_est, mu, log_var, kld_weight)
         return ELBO
 
+    def compute_ELBO_from_stats(self, depth:torch.Tensor, mu:torch.Tensor, log_var:torch.Tensor, kld_weight:float):
+        """ELBO with given (e.g. cached) encoder statistics, only the decoder runs"""
+        x_est = self.vae.decode(self.vae.reparameterize(mu, log_var))
+        ELBO = self.vae.loss_function(depth, x_est, mu, log_var, kld_weight)
+        return ELBO
+
     def img_encoding(self, rgb:torch.Tensor):
         x1 = self.img_encoder(rgb)[-1]
         return x1
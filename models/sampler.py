@@ -0,0 +1,262 @@
+"""Sampler registry shared by `Diffuser` and `SE3Diffuser`.
+
+Two kinds of samplers are registered:
+
+* ``space = 'twist'``: solvers acting on the flat 6-D twist around `x_T = 0` (DPM-Solver++, UniPC).
+  The model function is ``model_fn(x_t, t_input) -> x0`` with twists of shape (B, 6).
+* ``space = 'group'``: solvers acting directly on SE(3). The model function is
+  ``model_fn(H_t, t_input) -> H0`` with poses of shape (B, 4, 4).
+"""
+import torch
+from abc import abstractmethod
+from typing import Callable, Dict, List, Literal, Optional, Union
+from .util import se3
+from .util.transform import inv_pose
+from .diffusion_scheduler import DiffusionScheduler
+from .dpm import NoiseScheduleVP, DPM_Solver, model_wrapper
+from .unipc import UniPC
+
+class SamplingPlan:
+    def __init__(self, noise_schedule:NoiseScheduleVP, steps:int, skip_type:Literal['logSNR','time_uniform','time_quadratic']='logSNR',
+            t_start:Optional[float]=None, t_end:Optional[float]=None, device:torch.device=torch.device('cpu')):
+        """Time grid and per-step VP coefficients of a sampling trajectory
+
+        Args:
+            noise_schedule (NoiseScheduleVP): VP noise schedule
+            steps (int): number of solver steps (NFE of multistep solvers)
+            skip_type (str, optional): spacing of the time steps. Defaults to 'logSNR'.
+            t_start (float, optional): starting time. Defaults to noise_schedule.T.
+            t_end (float, optional): ending time. Defaults to 1 / noise_schedule.total_N.
+            device (torch.device, optional): Defaults to cpu.
+        """
+        self.noise_schedule = noise_schedule
+        self.steps = steps
+        t_0 = 1. / noise_schedule.total_N if t_end is None else t_end
+        t_T = noise_schedule.T if t_start is None else t_start
+        assert t_0 > 0 and t_T > 0, "Time range needs to be greater than 0."
+        self.timesteps = self.get_time_steps(noise_schedule, skip_type, t_T, t_0, steps, device)  # (steps + 1,)
+        self.alphas = noise_schedule.marginal_alpha(self.timesteps)
+        self.sigmas = noise_schedule.marginal_std(self.timesteps)
+        self.lambdas = noise_schedule.marginal_lambda(self.timesteps)
+
+    def __len__(self):
+        return self.steps
+
+    @staticmethod
+    def get_time_steps(noise_schedule:NoiseScheduleVP, skip_type:str, t_T:float, t_0:float, N:int, device:torch.device) -> torch.Tensor:
+        if skip_type == 'logSNR':
+            lambda_T = noise_schedule.marginal_lambda(torch.tensor(t_T).to(device))
+            lambda_0 = noise_schedule.marginal_lambda(torch.tensor(t_0).to(device))
+            logSNR_steps = torch.linspace(lambda_T.cpu().item(), lambda_0.cpu().item(), N + 1).to(device)
+            return noise_schedule.inverse_lambda(logSNR_steps)
+        elif skip_type == 'time_uniform':
+            return torch.linspace(t_T, t_0, N + 1).to(device)
+        elif skip_type == 'time_quadratic':
+            return torch.linspace(t_T**0.5, t_0**0.5, N + 1).pow(2).to(device)
+        else:
+            raise ValueError("Unsupported skip_type {}, need to be 'logSNR' or 'time_uniform' or 'time_quadratic'".format(skip_type))
+
+    def model_time(self, step:int, batch_size:int) -> torch.Tensor:
+        """discrete time label fed to the model (same convention as `model_wrapper`)"""
+        t = self.timesteps[step]
+        if self.noise_schedule.schedule == 'discrete':
+            t = (t - 1. / self.noise_schedule.total_N) * 1000.
+        return t.expand(batch_size)
+
+
+class BaseSampler:
+    space:Literal['twist','group'] = 'twist'
+
+    @property
+    @abstractmethod
+    def num_evaluations(self) -> int:
+        """model evaluations (NFE) of one `sample` call"""
+        pass
+
+    @abstractmethod
+    def sample(self, model_fn:Callable, x_T:torch.Tensor, noise_schedule:Optional[NoiseScheduleVP], return_intermediate:bool=False, **guidance_argv):
+        pass
+
+
+class DPMSampler(BaseSampler):
+    space = 'twist'
+    default_order = 2  # of DPM_Solver.sample
+    def __init__(self, algorithm_type:Literal['dpmsolver','dpmsolver++']='dpmsolver++', **sampling_argv):
+        """DPM-Solver(++) in the twist space. `sampling_argv` is forwarded to `DPM_Solver.sample`."""
+        self.algorithm_type = algorithm_type
+        self.sampling_argv = sampling_argv
+
+    @property
+    def num_evaluations(self) -> int:
+        steps = self.sampling_argv.get('steps', 20)
+        if self.sampling_argv.get('method', 'multistep') == 'singlestep_fixed':
+            order = self.sampling_argv.get('order', self.default_order)
+            steps = steps // order * order
+        return steps + int(self.sampling_argv.get('denoise_to_zero', False))
+
+    def build_solver(self, model_fn_continuous:Callable, noise_schedule:NoiseScheduleVP):
+        return DPM_Solver(model_fn_continuous, noise_schedule, algorithm_type=self.algorithm_type)
+
+    def sample(self, model_fn:Callable, x_T:torch.Tensor, noise_schedule:NoiseScheduleVP, return_intermediate:bool=False, **guidance_argv):
+        guidance_argv.setdefault('guidance_type', 'uncond')
+        model_fn_continuous = model_wrapper(
+            model_fn,
+            noise_schedule,
+            model_type='x_start',
+            **guidance_argv
+        )
+        solver = self.build_solver(model_fn_continuous, noise_schedule)
+        return solver.sample(x_T, **self.sampling_argv, return_intermediate=return_intermediate)
+
+
+class UniPCSampler(DPMSampler):
+    space = 'twist'
+    default_order = 3  # of UniPC.sample
+    def __init__(self, variant:Literal['bh1','bh2','vary_coeff']='bh1', **sampling_argv):
+        """UniPC in the twist space. `sampling_argv` is forwarded to `UniPC.sample`."""
+        self.variant = variant
+        self.sampling_argv = sampling_argv
+
+    def build_solver(self, model_fn_continuous:Callable, noise_schedule:NoiseScheduleVP):
+        return UniPC(model_fn_continuous, noise_schedule, algorithm_type="data_prediction", variant=self.variant)
+
+
+class SE3DDPMSampler(BaseSampler):
+    space = 'group'
+    def __init__(self, scheduler_argv:Dict):
+        """First-order stochastic update of SE3Diffuser (nlsd), driven by its own `DiffusionScheduler`
+
+        Args:
+            scheduler_argv (Dict): n_diff_steps, schedule_type, beta_1, beta_T, sigma_r, sigma_t, add_noise
+        """
+        self.scheduler_argv = scheduler_argv
+        self.scheduler = DiffusionScheduler(scheduler_argv)
+
+    @property
+    def num_evaluations(self) -> int:
+        return self.scheduler_argv['n_diff_steps']
+
+    def sample(self, model_fn:Callable, x_T:torch.Tensor, noise_schedule:Optional[NoiseScheduleVP]=None, return_intermediate:bool=False, **guidance_argv):
+        """intermediates are [H_T, H0_hat(T), H0_hat(T-1), ...] as in the original SE3Diffuser.sampling"""
+        assert len(guidance_argv) == 0, "{} does not support guidance".format(self.__class__.__name__)
+        B = x_T.shape[0]
+        H_t = x_T
+        H_t_list = [H_t.clone()]
+        for t in range(self.scheduler_argv['n_diff_steps']+1, 1, -1):  # [T, T-1, ..., 1]
+            H_0 = model_fn(H_t, torch.full((B,), t, dtype=torch.long, device=H_t.device))
+            delta_H_t = H_0 @ inv_pose(H_t)  # H_t_to_0
+            gamma0 = self.scheduler.gamma0[t]
+            gamma1 = self.scheduler.gamma1[t]
+            H_t = se3.exp(gamma0 * se3.log(delta_H_t) + gamma1 * se3.log(H_t))
+            ### noise
+            if self.scheduler_argv['add_noise'] and t > 1:
+                alpha_bar = self.scheduler.alpha_bars[t]
+                alpha_bar_ = self.scheduler.alpha_bars[t-1]
+                beta = self.scheduler.betas[t]
+                cc = ((1 - alpha_bar_) / (1.- alpha_bar)) * beta
+                scale = torch.cat([torch.ones(3) * self.scheduler_argv['sigma_r'], torch.ones(3) * self.scheduler_argv['sigma_t']])[None].to(H_t)  # [1, 6]
+                noise = torch.sqrt(cc) * scale * torch.randn(B, 6).to(H_t)  # [B, 6]
+                H_noise = se3.exp(noise)
+                H_t = H_noise @ H_t  # [B, 4, 4]
+            H_t_list.append(H_0.clone())
+        if return_intermediate:
+            return H_t, H_t_list
+        return H_t
+
+
+class SE3MultistepSampler(BaseSampler):
+    space = 'group'
+    def __init__(self, steps:int=10, order:int=2, skip_type:Literal['logSNR','time_uniform','time_quadratic']='logSNR',
+            method:Literal['multistep']='multistep', lower_order_final:bool=True, denoise_to_zero:bool=False,
+            t_start:Optional[float]=None, t_end:Optional[float]=None):
+        """Multistep DPM-Solver++ (order 1-3) solved on the Lie group with exp-map extrapolation
+
+        The flat data-prediction update `x_t = a * x_s + b * D` is applied as a geodesic step at the current pose,
+        `H_t = exp(b * log(D @ H_s^-1) + (1 - a - b) * log(H_s^-1)) @ H_s`, where the anchor `x_T = 0` is the identity.
+        The high-order estimate `D` is extrapolated from previous predictions in the tangent space of the latest one,
+        so no state ever leaves the group. Reduces to DPM-Solver++ when all poses commute.
+        """
+        assert method == 'multistep', "{} only supports method='multistep'".format(self.__class__.__name__)
+        assert 1 <= order <= 3, "order must be 1, 2 or 3, got {}".format(order)
+        assert steps >= order, "steps ({}) must not be less than order ({})".format(steps, order)
+        self.steps = steps
+        self.order = order
+        self.skip_type = skip_type
+        self.lower_order_final = lower_order_final
+        self.denoise_to_zero = denoise_to_zero
+        self.t_start = t_start
+        self.t_end = t_end
+
+    @property
+    def num_evaluations(self) -> int:
+        return self.steps + int(self.denoise_to_zero)
+
+    @staticmethod
+    def geodesic_step(H_s:torch.Tensor, D:torch.Tensor, a:torch.Tensor, b:torch.Tensor) -> torch.Tensor:
+        xi_pred = se3.log(D @ inv_pose(H_s))  # (B, 6) towards the data estimate
+        xi_anchor = se3.log(inv_pose(H_s))  # (B, 6) towards x_T = I
+        return se3.exp(b * xi_pred + (1. - a - b) * xi_anchor) @ H_s
+
+    def multistep_update(self, H_s:torch.Tensor, model_prev_list:List[torch.Tensor], plan:SamplingPlan, step:int, order:int) -> torch.Tensor:
+        s, t = step - 1, step
+        lambdas = plan.lambdas
+        h = lambdas[t] - lambdas[s]
+        a = plan.sigmas[t] / plan.sigmas[s]
+        phi_1 = torch.expm1(-h)
+        b = -plan.alphas[t] * phi_1
+        M0 = model_prev_list[-1]
+        if order == 1:
+            D = M0
+        elif order == 2:
+            r0 = (lambdas[s] - lambdas[s-1]) / h
+            d1 = se3.log(model_prev_list[-2] @ inv_pose(M0))  # M1 - M0 in the tangent space of M0
+            D1_0 = -d1 / r0
+            D = se3.exp(0.5 * D1_0) @ M0
+        else:
+            r0 = (lambdas[s] - lambdas[s-1]) / h
+            r1 = (lambdas[s-1] - lambdas[s-2]) / h
+            iM0 = inv_pose(M0)
+            d1 = se3.log(model_prev_list[-2] @ iM0)
+            d2 = se3.log(model_prev_list[-3] @ iM0)
+            D1_0 = -d1 / r0
+            D1_1 = (d1 - d2) / r1
+            D1 = D1_0 + (r0 / (r0 + r1)) * (D1_0 - D1_1)
+            D2 = (D1_0 - D1_1) / (r0 + r1)
+            phi_2 = phi_1 / h + 1.
+            phi_3 = phi_2 / h - 0.5
+            correction = plan.alphas[t] * (phi_2 * D1 - phi_3 * D2) / b
+            D = se3.exp(correction) @ M0
+        return self.geodesic_step(H_s, D, a, b)
+
+    def sample(self, model_fn:Callable, x_T:torch.Tensor, noise_schedule:NoiseScheduleVP, return_intermediate:bool=False, **guidance_argv):
+        """intermediates are the states [H_T, H_t1, ..., H_t0] (same convention as DPM_Solver.sample)"""
+        assert len(guidance_argv) == 0, "{} does not support guidance".format(self.__class__.__name__)
+        B = x_T.shape[0]
+        plan = SamplingPlan(noise_schedule, self.steps, self.skip_type, self.t_start, self.t_end, device=x_T.device)
+        H = x_T
+        intermediates = [H]
+        model_prev_list = [model_fn(H, plan.model_time(0, B))]
+        for step in range(1, self.steps + 1):
+            step_order = min(self.order, step)
+            if self.lower_order_final:
+                step_order = min(step_order, self.steps + 1 - step)
+            H = self.multistep_update(H, model_prev_list, plan, step, step_order)
+            intermediates.append(H)
+            # We do not need to evaluate the final model value.
+            if step < self.steps:
+                model_prev_list.append(model_fn(H, plan.model_time(step, B)))
+                model_prev_list = model_prev_list[-self.order:]
+        if self.denoise_to_zero:
+            H = model_fn(H, plan.model_time(self.steps, B))
+            intermediates.append(H)
+        if return_intermediate:
+            return H, intermediates
+        return H
+
+
+__classdict__ = {'dpm':DPMSampler, 'unipc':UniPCSampler, 'nlsd':SE3DDPMSampler, 'se3_multistep':SE3MultistepSampler}
+
+def get_sampler(sampling_type:str, **argv) -> Union[DPMSampler, UniPCSampler, SE3DDPMSampler, SE3MultistepSampler]:
+    if sampling_type not in __classdict__:
+        raise NotImplementedError("sampling type must be one of {}, got '{}'.".format(list(__classdict__.keys()), sampling_type))
+    return __classdict__[sampling_type](**argv)
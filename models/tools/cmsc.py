@@ -1,6 +1,6 @@
 import numpy as np
 from scipy.spatial import KDTree
-from typing import Tuple, Iterable, List, Dict
+from typing import Tuple, Iterable, List, Dict, Optional
 from scipy.spatial.transform import Rotation
 import open3d as o3d
 from scipy.spatial import KDTree, cKDTree
@@ -212,6 +212,47 @@ def estimate_normal(pcd_arr:np.ndarray, radius:float=0.6, knn:int=15):
     pcd.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(radius, knn))
     return np.array(pcd.normals)
 
+class FrameGeometry:
+    def __init__(self, pcd:np.ndarray, normal_radius:float=0.6, normal_knn:int=10):
+        """geometry of one LiDAR frame that does not change across guidance steps: points, normals and KD-tree
+
+        Args:
+            pcd (np.ndarray): (N, 3)
+            normal_radius (float, optional): radius of normal estimation. Defaults to 0.6.
+            normal_knn (int, optional): max neighbors of normal estimation. Defaults to 10.
+        """
+        self.pcd = pcd
+        self.normal = estimate_normal(pcd, normal_radius, normal_knn)
+        self.tree = cKDTree(pcd, leafsize=100)
+        self._planarity = dict()  # knn -> (N,) mean point-to-plane deviation of each point's neighborhood
+
+    def query(self, points:np.ndarray, k:int) -> Tuple[np.ndarray, np.ndarray]:
+        """k nearest neighbors of points (M, 3), returns dist (M, k), ii (M, k)"""
+        dist, ii = self.tree.query(points, k=k, workers=-1)
+        if k == 1:
+            dist, ii = dist[:,None], ii[:,None]
+        return dist, ii
+
+    def planarity(self, knn:int) -> np.ndarray:
+        """mean |(p - p_nn) . n_p| over the knn neighbors of every point, computed once per knn"""
+        if knn not in self._planarity:
+            _, ii = self.query(self.pcd, knn)
+            pcd_nn = self.pcd[ii]  # (N, k, 3)
+            norm_reg = np.abs(np.sum((self.pcd[:,None,:] - pcd_nn) * self.normal[:,None,:], axis=-1))  # (N, k)
+            self._planarity[knn] = np.mean(norm_reg, axis=1)
+        return self._planarity[knn]
+
+    def neighbor_planarity(self, ii:np.ndarray) -> np.ndarray:
+        """planarity test of CABatchCorr: deviation of the query's neighbors ii (n, k) from the plane of ii[:,0]"""
+        pcd_xyz_top1 = self.pcd[ii[:,0]]  # (n, 3)
+        pcd_norm_top1 = self.normal[ii[:,0]]  # (n, 3)
+        norm_reg = np.sum(np.abs((pcd_xyz_top1[:,None,:] - self.pcd[ii]) * pcd_norm_top1[:,None,:]), axis=-1)  # (n, k)
+        return np.mean(norm_reg, axis=1)
+
+    def point_to_plane(self, points:np.ndarray, idx:np.ndarray) -> np.ndarray:
+        """|(points - pcd[idx]) . normal[idx]| for points (n, 3) matched to idx (n,)"""
+        return np.abs(np.sum((points - self.pcd[idx]) * self.normal[idx], axis=-1))
+
 def dist2pt(pcd_arr:np.ndarray, pcd_norm:np.ndarray, pcd_tree:cKDTree, mappoint:np.ndarray, k:int=10, max_pt_err:float=0.5, max_norm_err:float=0.04, min_cnt:int=30):
     dist, ii = pcd_tree.query(mappoint, k=k, workers=-1)
     dist_rev = dist[:,0] < max_pt_err ** 2
@@ -289,13 +330,20 @@ def CBABatchCorr(src_pcd:np.ndarray, src_kpt:np.ndarray,
     raw_src_pcd = nptran(src_pcd, Tcl)  # camera coordinate (source frame)
     corr_data = []
     inv_src_extran = inv_pose(src_extran)
+    if not proj_constraint:
+        # the source projection does not depend on the target frame: one KD-tree and one query for all targets
+        src_proj, src_proj_rev = npproj(raw_src_pcd, np.eye(4), intran, img_hw)
+        src_dist, src_ii = KDTree(src_proj, leafsize=10).query(src_kpt, k=1)
     for match, tgt_kpt, tgt_extran in zip(match_list, tgt_kpt_list, tgt_extran_list):
         relpose = tgt_extran @ inv_src_extran  # Tc1,w x Tw,c2
         relpose[:3,3] *= scale
-        tgt_pcd = nptran(raw_src_pcd, relpose)
-        src_proj, _, src_proj_rev = proj_func(raw_src_pcd, tgt_pcd, np.eye(4), intran, img_hw, return_indices=True)
-        tree = KDTree(src_proj, leafsize=10)
-        dist, ii = tree.query(src_kpt[match[:,0], :], k=1)  # len of src_kpt
+        if proj_constraint:
+            tgt_pcd = nptran(raw_src_pcd, relpose)
+            src_proj, _, src_proj_rev = proj_func(raw_src_pcd, tgt_pcd, np.eye(4), intran, img_hw, return_indices=True)
+            tree = KDTree(src_proj, leafsize=10)
+            dist, ii = tree.query(src_kpt[match[:,0], :], k=1)  # len of src_kpt
+        else:
+            dist, ii = src_dist[match[:,0]], src_ii[match[:,0]]
         dist_rev = dist < max_dist ** 2
         if dist_rev.sum() == 0:
             continue  # skip this data
@@ -308,23 +356,30 @@ def CBABatchCorr(src_pcd:np.ndarray, src_kpt:np.ndarray,
 
 def CABatchCorr(cam_mappoint:np.ndarray, pcd:np.ndarray,
                  Tcl:np.ndarray, scale:float, max_dist:float,
-                 normal_radius:float=0.6, noraml_knn:int=10, ca_knn:int = 10, norm_reg_err:float = 0.04):
+                 normal_radius:float=0.6, noraml_knn:int=10, ca_knn:int = 10, norm_reg_err:float = 0.04,
+                 geometry:Optional[FrameGeometry]=None, point_planarity:bool=False):
+    """Compute CA Correspondences
+
+    Pass a FrameGeometry of `pcd` to reuse its normals and KD-tree across calls.
+    With `point_planarity`, the plane test uses the cached neighborhood of the nearest LiDAR point
+    instead of the neighborhood of each map point, so only the nearest neighbor is queried.
+    """
+    if geometry is None:
+        geometry = FrameGeometry(pcd, normal_radius, noraml_knn)
     transformed_mappoint = nptran(cam_mappoint * scale, inv_pose_np(Tcl))
-    pcd_norm = estimate_normal(pcd, normal_radius, noraml_knn)
-    pcd_tree = KDTree(pcd, leafsize=100)
-    dist, ii = pcd_tree.query(transformed_mappoint, k=ca_knn)
+    dist, ii = geometry.query(transformed_mappoint, 1 if point_planarity else ca_knn)
     dist_rev = dist[:,0] < max_dist ** 2
-    dist = dist[dist_rev]
     ii = ii[dist_rev]
-    pcd_xyz_top1 = pcd[ii[:,0]]  # (n, 3)
-    pcd_norm_top1 = pcd_norm[ii[:,0]] # (n, 3)
-    pcd_nn = pcd[ii.reshape(-1)].reshape(ii.shape[0], ii.shape[1], 3)  # (n, k, 3)
-    norm_reg = np.sum(np.abs((pcd_xyz_top1[:,None,:] - pcd_nn) * pcd_norm_top1[:,None,:]), axis=-1)  # (n, k)
-    plane_rev = np.mean(norm_reg, axis=1) < norm_reg_err
+    pcd_xyz_top1 = geometry.pcd[ii[:,0]]  # (n, 3)
+    pcd_norm_top1 = geometry.normal[ii[:,0]] # (n, 3)
+    if point_planarity:
+        plane_rev = geometry.planarity(ca_knn)[ii[:,0]] < norm_reg_err
+    else:
+        plane_rev = geometry.neighbor_planarity(ii) < norm_reg_err
     corr_data = dict()
     corr_data['src_pt_pcd'] = pcd_xyz_top1[~plane_rev]
     corr_data['src_pt_campt'] = cam_mappoint[dist_rev][~plane_rev] * scale  # scaled camera mappoints
     corr_data['src_pl_pcd'] = pcd_xyz_top1[plane_rev]
     corr_data['src_pl_norm'] = pcd_norm_top1[plane_rev]
     corr_data['src_pl_campt'] = cam_mappoint[dist_rev][plane_rev] * scale  # scaled camera mappoints
-    return corr_data
\ No newline at end of file
+    return corr_data
@@ -7,14 +7,14 @@ from torch.nn import functional as F
 # import logging
 from .point_conv import PointConv
 from .mlp import MLP1d
-from .utils import project_pc2image, build_pc_pyramid_single, se3_transform
-from .csrc import correlation2d
+from .utils import project_pc2image, project_ragged_pc2image, ragged_batch_index, build_pc_pyramid_single, se3_transform
+from .csrc import correlation2d, furthest_point_sampling, k_nearest_neighbor
 from .clfm import FusionAwareInterp
 from ..Modules import resnet18 as custom_resnet
 from ..Modules import BottleneckBlock, ResidualBlock, FeatureEncoder
 # from .embedding import PoseEmbedding
 # from mmdet.models.backbones import ResNet
-from typing import Literal, List, Dict, Tuple
+from typing import Literal, List, Dict, Tuple, Optional
 from functools import partial
 
 
@@ -39,60 +39,69 @@ class DepthImgGenerator:
         self.max_depth = max_depth
         # InTran (3,4) or (4,4)
 
+    @staticmethod
+    def scatter_points(pcd:torch.Tensor, value:torch.Tensor, camera_info:Dict, offsets:Optional[torch.Tensor]=None)->torch.Tensor:
+        """scatter point values to the image plane in one indexing op over the whole batch
+
+        Args:
+            pcd (torch.Tensor): (B, 3, N), or ragged (3, M) with `offsets`
+            value (torch.Tensor): (B, N) or (M,) value of each point
+            camera_info (Dict): project information
+            offsets (Optional[torch.Tensor]): (B+1,) start of each cloud for ragged input. Defaults to None.
+
+        Returns:
+            torch.Tensor: image (B, 1, H, W)
+        """
+        H, W = camera_info['sensor_h'], camera_info['sensor_w']
+        if offsets is None:
+            B, N = pcd.shape[0], pcd.shape[-1]
+            uv = project_pc2image(pcd, camera_info)  # (B, 2, N)
+            batch_idx = torch.arange(B, device=pcd.device)[:, None].expand(B, N).reshape(-1)
+            uv = uv.transpose(0, 1).reshape(2, -1)  # (2, B*N)
+            z = pcd[:, 2, :].reshape(-1)
+            value = value.reshape(-1)
+        else:
+            B = len(offsets) - 1
+            batch_idx = ragged_batch_index(offsets.to(pcd.device))
+            uv = project_ragged_pc2image(pcd, batch_idx, camera_info)  # (2, M)
+            z = pcd[2, :]
+        proj_x = uv[0].type(torch.long)
+        proj_y = uv[1].type(torch.long)
+        rev = (proj_x>=0)*(proj_x<W)*(proj_y>=0)*(proj_y<H)*(z>0)
+        batch_img = torch.zeros(B,H,W,dtype=torch.float32).to(pcd.device)  # [B,H,W]
+        batch_img[batch_idx[rev],proj_y[rev],proj_x[rev]] = value[rev].to(batch_img)
+        return batch_img.unsqueeze(1)   # (B,1,H,W)
+
     @torch.no_grad()
-    def project(self, pcd:torch.Tensor, camera_info:Dict)->torch.Tensor:
+    def project(self, pcd:torch.Tensor, camera_info:Dict, offsets:Optional[torch.Tensor]=None)->torch.Tensor:
         """transform point cloud to image
 
         Args:
-            pcd (torch.Tensor): (B, 3, N)
-            pcd_norm (torch.Tensor): (B, N) distance of each point from the original point
+            pcd (torch.Tensor): (B, 3, N), or ragged (3, M) with `offsets`
             camera_info (Dict): project information
+            offsets (Optional[torch.Tensor]): (B+1,) start of each cloud for ragged input. Defaults to None.
 
         Returns:
             torch.Tensor: depth image (B, 1, H, W)
         """
-        B = pcd.shape[0]
-        uv = project_pc2image(pcd, camera_info)
-        proj_x = uv[:,0,:].type(torch.long)
-        proj_y = uv[:,1,:].type(torch.long)
-        H, W = camera_info['sensor_h'], camera_info['sensor_w']
-        rev = ((proj_x>=0)*(proj_x<W)*(proj_y>=0)*(proj_y<H)*(pcd[:,2,:]>0)).type(torch.bool)  # [B,N]
-        batch_depth_img = torch.zeros(B,H,W,dtype=torch.float32).to(pcd.device)  # [B,H,W]
-        # size of rev_i is not constant so that a batch-formed operdation cannot be applied
-        for bi in range(B):
-            rev_i = rev[bi,:]  # (N,)
-            proj_xrev = proj_x[bi,rev_i]
-            proj_yrev = proj_y[bi,rev_i]
-            batch_depth_img[bi*torch.ones_like(proj_xrev),proj_yrev,proj_xrev] = pcd[bi, 2, rev_i] / self.max_depth # z
-        return batch_depth_img.unsqueeze(1)   # (B,1,H,W)
+        z = pcd[:, 2, :] if offsets is None else pcd[2, :]
+        return self.scatter_points(pcd, z / self.max_depth, camera_info, offsets)
     
     @staticmethod
     @torch.no_grad()
-    def binary_project(pcd:torch.Tensor, camera_info:Dict)->torch.Tensor:
+    def binary_project(pcd:torch.Tensor, camera_info:Dict, offsets:Optional[torch.Tensor]=None)->torch.Tensor:
         """transform point cloud to image
 
         Args:
-            pcd (torch.Tensor): (B, 3, N)
-            pcd_norm (torch.Tensor): (B, N) distance of each point from the original point
+            pcd (torch.Tensor): (B, 3, N), or ragged (3, M) with `offsets`
             camera_info (Dict): project information
+            offsets (Optional[torch.Tensor]): (B+1,) start of each cloud for ragged input. Defaults to None.
 
         Returns:
-            torch.Tensor: depth image (B, 1, H, W)
+            torch.Tensor: mask image (B, 1, H, W)
         """
-        B = pcd.shape[0]
-        uv = project_pc2image(pcd, camera_info)
-        proj_x = uv[:,0,:].type(torch.long)
-        proj_y = uv[:,1,:].type(torch.long)
-        H, W = camera_info['sensor_h'], camera_info['sensor_w']
-        rev = ((proj_x>=0)*(proj_x<W)*(proj_y>=0)*(proj_y<H)*(pcd[:,2,:]>0)).type(torch.bool)  # [B,N]
-        batch_mask_img = torch.zeros(B,H,W,dtype=torch.float32).to(pcd.device)  # [B,H,W]
-        # size of rev_i is not constant so that a batch-formed operdation cannot be applied
-        for bi in range(B):
-            rev_i = rev[bi,:]  # (N,)
-            proj_xrev = proj_x[bi,rev_i]
-            proj_yrev = proj_y[bi,rev_i]
-            batch_mask_img[bi*torch.ones_like(proj_xrev),proj_yrev,proj_xrev] = 1 # z
-        return batch_mask_img.unsqueeze(1)   # (B,1,H,W)
+        ones = torch.ones_like(pcd[:, 2, :] if offsets is None else pcd[2, :])
+        return DepthImgGenerator.scatter_points(pcd, ones, camera_info, offsets)
 
 class BasicBlock(nn.Module):
     def __init__(self, inplanes, planes, stride=1, padding=1,
@@ -213,6 +222,9 @@ class Encoder3D(nn.Module):
         super().__init__()
         assert len(pcd_pyramid)  == len(n_channels), "length of n_channels ({}) != length of pcd_pyramid ({})".format(len(n_channels), len(pcd_pyramid))
         self.pyramid_func = partial(build_pc_pyramid_single, n_samples_list=pcd_pyramid)
+        self.pcd_pyramid = pcd_pyramid
+        self.k = k
+        self.buffer = dict()
         in_chan = 4 if embed_norm else 3
         self.embed_norm = embed_norm
         self.level0_mlp = MLP1d(in_chan, [n_channels[0], n_channels[0]])
@@ -223,16 +235,38 @@ class Encoder3D(nn.Module):
             self.mlps.append(MLP1d(n_channels[i], [n_channels[i], n_channels[i + 1]]))
             self.convs.append(PointConv(n_channels[i + 1], n_channels[i + 1], norm=norm, k=k))
 
+    @torch.no_grad()
+    def restore_buffer(self, pcd:torch.Tensor):
+        """cache the FPS indices and the KNN indices of every level.
+        Both only depend on pairwise distances, so they stay valid for any rigid transform of `pcd`
+        and `forward` gathers the pyramid of the transformed cloud instead of searching again.
+
+        Args:
+            pcd (torch.Tensor): B, 3, N
+        """
+        sample_index = furthest_point_sampling(pcd.transpose(1, 2), max(self.pcd_pyramid))
+        xyzs, _ = self.pyramid_func(pcd, sample_index=sample_index)
+        self.buffer['sample_index'] = sample_index
+        self.buffer['knn_indices'] = [k_nearest_neighbor(xyzs[i], xyzs[i + 1], self.k) for i in range(1, len(xyzs) - 1)]
+
+    def clear_buffer(self):
+        self.buffer.clear()
+
     def forward(self, pcd:torch.Tensor) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
         """pcd hierchical encoding
 
         Args:
-            pcd (torch.Tensor): B, 3, N
+            pcd (torch.Tensor): B, 3, N. If the buffer is restored, a rigid transform of the cloud passed to `restore_buffer`
 
         Returns:
             Tuple[List[torch.Tensor], List[torch.Tensor]]: feats, xyzs
         """
-        xyzs, _ = self.pyramid_func(pcd)
+        if len(self.buffer.keys()) == 0:
+            sample_index, knn_indices = None, [None] * (len(self.pcd_pyramid) - 1)
+        else:
+            sample_index, knn_indices = self.buffer['sample_index'], self.buffer['knn_indices']
+            assert sample_index.shape[0] == pcd.shape[0], "batch size {} != {} of the restored buffer".format(pcd.shape[0], sample_index.shape[0])
+        xyzs, _ = self.pyramid_func(pcd, sample_index=sample_index)
         inputs = xyzs[1]  # [bs, 3, n_points]
         if self.embed_norm:
             norm = torch.linalg.norm(inputs, dim=1, keepdim=True)
@@ -241,7 +275,7 @@ class Encoder3D(nn.Module):
 
         for i in range(1,len(xyzs) - 1):
             feat = self.mlps[i-1](feats[-1])
-            feat = self.convs[i-1](xyzs[i], feat, xyzs[i + 1])
+            feat = self.convs[i-1](xyzs[i], feat, xyzs[i + 1], knn_indices=knn_indices[i-1])
             feats.append(feat)
         return feats, xyzs  
 
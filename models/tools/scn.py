@@ -2,10 +2,11 @@ import spconv.pytorch as spconv
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from typing import Iterable, Union, List, Optional, Tuple, Callable
+from typing import Iterable, Union, List, Optional, Tuple, Callable, Dict
 from timm.layers import trunc_normal_
 from collections import OrderedDict
 from functools import partial
+from .utils import project_pc2image, project_ragged_pc2image
 
 # def scn_input_wrapper(coords: Iterable[torch.Tensor], features: Iterable[torch.Tensor], scale:Union[float, Iterable[float]], bias:float, device=None) -> Tuple[torch.Tensor, torch.Tensor, int]:
 #     assert len(coords) == len(features)
@@ -386,7 +387,7 @@ class SInputHead(nn.Module):
     def forward(self, coord:torch.Tensor, feat:torch.Tensor, batch_size:int):
         amax = torch.amax(coord[:,1:], dim=0)
         amin = torch.amin(coord[:,1:], dim=0)
-        drange = amax - amin
+        drange = amax - amin + 1  # number of voxels along each axis
         coord[:, 1:] -= amin[None, :]
         drange_bias = torch.zeros_like(drange)
         drange_bias[drange % 2 ==0] = 1 # spatial shape is odd
@@ -624,4 +625,107 @@ class SparseCorrBlock(nn.Module):  # can use extrinsic to constrain flows (extri
         M = fmap1.shape[1]
         B, C, H, W = fmap2.shape
         corr = torch.bmm(fmap1, fmap2.reshape(B, C, H*W))  # B, M, H*W
-        return corr.unsqueeze(2).view(B, M, 1, H, W)  # (B, M, H*W) -> (B, M, 1, H*W) -> (B, M, 1, H, W)
\ No newline at end of file
+        return corr.unsqueeze(2).view(B, M, 1, H, W)  # (B, M, H*W) -> (B, M, 1, H*W) -> (B, M, 1, H, W)
+
+def feature_grid_size(size:Tuple[int,int], stride:int) -> Tuple[int,int]:
+    """(h, w) of a feature map downsampled `stride` times by stride-2 convs/poolings (each one rounds up)"""
+    h, w = size
+    while stride > 1:
+        h, w = (h + 1) // 2, (w + 1) // 2
+        stride //= 2
+    return h, w
+
+class SparseDepthEncoder(nn.Module):
+    def __init__(self, out_chans:Iterable[int], voxel_size:float=0.1, max_depth:float=50.0, layers=(64, 64, 96, 128, 256), strides=(2, 1, 2, 2)):
+        """sparse-convolution replacement of the dense depth-image branch.
+        Points inside the camera frustum are voxelized and encoded by `SparseFeatureEncoder`,
+        then the features of the output voxels are splatted (averaged) into image feature grids,
+        so the cost scales with the number of points instead of the image area.
+
+        Args:
+            out_chans (Iterable[int]): channels of each output feature grid (one linear head per grid)
+            voxel_size (float, optional): voxel edge length (m). Defaults to 0.1.
+            max_depth (float, optional): depth normalization of the input feature, same as `DepthImgGenerator`. Defaults to 50.0.
+            layers (tuple, optional): channels of `SparseFeatureEncoder`. Defaults to (64, 64, 96, 128, 256).
+            strides (tuple, optional): strides of `SparseFeatureEncoder`. Defaults to (2, 1, 2, 2).
+        """
+        super().__init__()
+        self.voxel_size = voxel_size
+        self.max_depth = max_depth
+        self.encoder = SparseFeatureEncoder(in_chan=1, layers=layers, strides=strides)
+        self.heads = nn.ModuleList([nn.Sequential(nn.Linear(layers[-1], chan), nn.ReLU()) for chan in out_chans])
+
+    def voxelize(self, pcd:torch.Tensor, camera_info:Dict) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """keep the points projected inside the image and average their normalized depth in each voxel
+
+        Args:
+            pcd (torch.Tensor): (B, 3, N) in the camera frame
+            camera_info (Dict): batched camera info
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor, torch.Tensor]: coords (V, 4) int32 [batch, x, y, z] shifted to start at 0, feats (V, 1), origin (3,) voxel index of coord 0
+        """
+        B, _, N = pcd.shape
+        H, W = camera_info['sensor_h'], camera_info['sensor_w']
+        uv = project_pc2image(pcd, camera_info)  # (B, 2, N)
+        z = pcd[:, 2, :]
+        rev = (uv[:, 0] >= 0) * (uv[:, 0] < W) * (uv[:, 1] >= 0) * (uv[:, 1] < H) * (z > 0)  # same visibility as DepthImgGenerator
+        batch_idx = torch.arange(B, device=pcd.device)[:, None].expand(B, N)[rev]
+        xyz = pcd.transpose(1, 2)[rev]  # (M, 3)
+        voxel = torch.floor(xyz / self.voxel_size).to(torch.int32)
+        coords, inverse = torch.unique(torch.cat([batch_idx[:, None].to(torch.int32), voxel], dim=1), dim=0, return_inverse=True)
+        feats = torch.zeros(len(coords), 1, dtype=pcd.dtype, device=pcd.device).index_add_(0, inverse, z[rev][:, None] / self.max_depth)
+        counts = torch.zeros(len(coords), 1, dtype=pcd.dtype, device=pcd.device).index_add_(0, inverse, torch.ones_like(feats[inverse]))
+        origin = coords[:, 1:].amin(dim=0)
+        coords[:, 1:] -= origin[None, :]
+        return coords.contiguous(), feats / counts, origin
+
+    def splat(self, centers:torch.Tensor, batch_idx:torch.Tensor, feats:torch.Tensor, camera_info:Dict, batch_size:int, stride:int) -> torch.Tensor:
+        """average voxel features into the (h, w) grid of an image feature map with the given stride
+
+        Args:
+            centers (torch.Tensor): (3, V) voxel centers in the camera frame
+            batch_idx (torch.Tensor): (V,)
+            feats (torch.Tensor): (V, C)
+            camera_info (Dict): batched camera info
+            batch_size (int): B
+            stride (int): downsample factor of the feature map w.r.t. the image
+
+        Returns:
+            torch.Tensor: (B, C, h, w)
+        """
+        h, w = feature_grid_size((camera_info['sensor_h'], camera_info['sensor_w']), stride)
+        uv = project_ragged_pc2image(centers, batch_idx, camera_info)  # (2, V)
+        gx = torch.floor(uv[0] / stride).to(torch.long)
+        gy = torch.floor(uv[1] / stride).to(torch.long)
+        rev = (gx >= 0) * (gx < w) * (gy >= 0) * (gy < h) * (centers[2] > 0)
+        flat_idx = (batch_idx[rev] * h + gy[rev]) * w + gx[rev]
+        C = feats.shape[1]
+        grid = torch.zeros(batch_size * h * w, C, dtype=feats.dtype, device=feats.device).index_add_(0, flat_idx, feats[rev])
+        counts = torch.zeros(batch_size * h * w, 1, dtype=feats.dtype, device=feats.device).index_add_(0, flat_idx, torch.ones_like(feats[rev, :1]))
+        grid = grid / counts.clamp(min=1)
+        return grid.view(batch_size, h, w, C).permute(0, 3, 1, 2).contiguous()
+
+    def forward(self, pcd:torch.Tensor, camera_info:Dict, feat_strides:Iterable[int]) -> List[torch.Tensor]:
+        """encode the transformed point cloud
+
+        Args:
+            pcd (torch.Tensor): (B, 3, N) in the camera frame
+            camera_info (Dict): batched camera info
+            feat_strides (Iterable[int]): stride of each output grid, in the order of `out_chans`
+
+        Returns:
+            List[torch.Tensor]: (B, C_k, h_k, w_k) feature grids aligned with the dense image features
+        """
+        batch_size = pcd.shape[0]
+        coords, feats, origin = self.voxelize(pcd, camera_info)
+        in_shape = coords[:, 1:].amax(dim=0) + 1
+        in_shape = (in_shape + (in_shape % 2 == 0).to(in_shape)).to(pcd.dtype)  # odd spatial shape, see SInputHead
+        x = self.encoder([coords, feats.to(torch.float32), batch_size])[-1]  # SparseConvTensor
+        # an output voxel covers `in_shape / out_shape` input voxels along each axis
+        scale = in_shape / torch.tensor(x.spatial_shape, dtype=pcd.dtype, device=pcd.device).clamp(min=1)
+        out_idx = x.indices.to(pcd.dtype)
+        centers = ((out_idx[:, 1:] + 0.5) * scale[None, :] + origin[None, :].to(pcd.dtype)) * self.voxel_size  # (V, 3)
+        batch_idx = x.indices[:, 0].to(torch.long)
+        return [self.splat(centers.T, batch_idx, head(x.features), camera_info, batch_size, stride)
+            for head, stride in zip(self.heads, feat_strides)]
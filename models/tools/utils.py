@@ -1,7 +1,7 @@
 import time
 import torch
 from torch.nn.functional import grid_sample, interpolate, pad, softmax, unfold
-from typing import List
+from typing import List, Optional
 from .csrc import k_nearest_neighbor, furthest_point_sampling
 
 
@@ -133,11 +133,20 @@ def build_pc_pyramid(pc1:torch.Tensor, pc2:torch.Tensor, n_samples_list:List[int
 
     return xyzs1, xyzs2, sample_indices1, sample_indices2
 
-def build_pc_pyramid_single(pc1:torch.Tensor, n_samples_list:List[int]):
+def build_pc_pyramid_single(pc1:torch.Tensor, n_samples_list:List[int], sample_index:Optional[torch.Tensor]=None):
+    """point cloud pyramid by furthest point sampling
+
+    Args:
+        pc1 (torch.Tensor): [batch_size, 3, n_points]
+        n_samples_list (List[int]): number of points of each level
+        sample_index (Optional[torch.Tensor], optional): [batch_size, max(n_samples_list)] FPS indices of a rigidly transformed copy of pc1.
+            FPS only depends on pairwise distances, so they can be reused instead of sampling again. Defaults to None.
+    """
     batch_size, _, n_points = pc1.shape
 
     # sub-sampling point cloud
-    sample_index = furthest_point_sampling(pc1.transpose(1, 2), max(n_samples_list))  # 1/4
+    if sample_index is None:
+        sample_index = furthest_point_sampling(pc1.transpose(1, 2), max(n_samples_list))  # 1/4
     # build point cloud pyramid
     lv0_index = torch.arange(n_points, device=pc1.device)
     lv0_index = lv0_index[None, :].expand(batch_size, n_points)
@@ -297,6 +306,78 @@ def project_pc2image(pc:torch.Tensor, camera_info):
     ], dim=-2)  # (B, 2, N) or (B, K, 2, N)
 
 
+def ragged_batch_index(offsets:torch.Tensor) -> torch.Tensor:
+    """batch index of each point of a ragged point cloud
+
+    Args:
+        offsets (torch.Tensor): (B+1,) start of each cloud in the concatenated points, offsets[-1] = M
+
+    Returns:
+        torch.Tensor: (M,) long
+    """
+    lengths = offsets[1:] - offsets[:-1]
+    return torch.repeat_interleave(torch.arange(len(lengths), device=offsets.device), lengths)
+
+
+def ragged_to_padded(points:torch.Tensor, offsets:torch.Tensor, num:int=None) -> torch.Tensor:
+    """resample a ragged point cloud to a dense batch on its device (same rule as dataset.Resampler:
+    random subset without replacement, random duplicates only for clouds with less than `num` points)
+
+    Args:
+        points (torch.Tensor): (3, M) concatenated points
+        offsets (torch.Tensor): (B+1,) start of each cloud, offsets[-1] = M
+        num (int, optional): number of points per cloud. Defaults to the largest cloud.
+
+    Returns:
+        torch.Tensor: (B, 3, num)
+    """
+    offsets = offsets.to(points.device)
+    lengths = offsets[1:] - offsets[:-1]  # (B,)
+    B = len(lengths)
+    max_len = int(lengths.max().item())
+    if num is None:
+        num = max_len
+    arange = torch.arange(max(max_len, num), device=points.device)
+    keys = torch.rand(B, max_len, device=points.device)
+    keys[arange[None, :max_len] >= lengths[:, None]] = 2.0  # padded slots are sorted to the end
+    perm = torch.argsort(keys, dim=1)  # (B, max_len), the first lengths[b] entries are a permutation
+    if num > max_len:
+        perm = torch.cat([perm, perm.new_zeros(B, num - max_len)], dim=1)
+    perm = perm[:, :num]
+    dup = (torch.rand(B, num, device=points.device) * lengths[:, None]).long()  # with replacement
+    local_idx = torch.where(arange[None, :num] < lengths[:, None], perm, dup)
+    return points[:, local_idx + offsets[:-1, None]].transpose(0, 1)  # (3, B, num) -> (B, 3, num)
+
+
+def project_ragged_pc2image(points:torch.Tensor, batch_idx:torch.Tensor, camera_info):
+    """project_pc2image for a ragged point cloud
+
+    Args:
+        points (torch.Tensor): (3, M)
+        batch_idx (torch.Tensor): (M,) from ragged_batch_index
+        camera_info (Dict): batched camera info
+
+    Returns:
+        torch.Tensor: (2, M)
+    """
+    def point_param(key):
+        value = camera_info[key]
+        if isinstance(value, torch.Tensor):
+            return value.to(points)[batch_idx]
+        return value
+    cx, cy = point_param('cx'), point_param('cy')
+    if camera_info['projection_mode'] == 'perspective':
+        fx, fy = point_param('fx'), point_param('fy')
+        image_x = cx + (fx / points[2]) * points[0]
+        image_y = cy + (fy / points[2]) * points[1]
+    elif camera_info['projection_mode'] == 'parallel':
+        image_x = points[0] + cx
+        image_y = points[1] + cy
+    else:
+        raise NotImplementedError
+    return torch.stack([image_x, image_y], dim=0)
+
+
 @torch.cuda.amp.autocast(enabled=False)
 def grid_sample_wrapper(feat_2d, uv):
     image_h, image_w = feat_2d.shape[2:]
@@ -19,6 +19,7 @@ class BatchedCameraInfoDict(CameraInfoDict):
     fy: torch.Tensor
     cx: torch.Tensor
     cy: torch.Tensor
+    intrinsic: torch.Tensor  # (B,4) [fx, fy, cx, cy]
 
 class BaseDatasetOutput(TypedDict):
     img: torch.Tensor
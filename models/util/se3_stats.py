@@ -0,0 +1,121 @@
+""" batched statistics of SE(3) samples: Karcher mean, geodesic (Weiszfeld) median, trimmed mean and tangent covariance.
+Samples are (*, N, 4, 4) matrices, every leading index * is an independent set of N poses.
+Residuals are the twists log(mu^-1 @ H) in the tangent space at the estimate mu. """
+import torch
+from typing import Optional, Tuple
+from . import se3
+
+def tangent_residuals(H:torch.Tensor, mu:torch.Tensor) -> torch.Tensor:
+    """twists of the samples H (*, N, 4, 4) at mu (*, 4, 4): log(mu^-1 @ H), (*, N, 6)"""
+    return se3.log(se3.inverse(mu).unsqueeze(-3) @ H)
+
+def geodesic_distance(H:torch.Tensor, mu:torch.Tensor, scale:Optional[torch.Tensor]=None) -> torch.Tensor:
+    """distances (*, N) between the samples H (*, N, 4, 4) and mu (*, 4, 4)
+
+    Args:
+        H (torch.Tensor): (*, N, 4, 4)
+        mu (torch.Tensor): (*, 4, 4)
+        scale (Optional[torch.Tensor], optional): (6,) weights of the twist components (rad, m) in the metric. Defaults to None (all ones).
+    """
+    xi = tangent_residuals(H, mu)
+    if scale is not None:
+        xi = xi * scale.to(xi)
+    return torch.linalg.norm(xi, dim=-1)
+
+def _normalize(weights:Optional[torch.Tensor], H:torch.Tensor) -> torch.Tensor:
+    if weights is None:
+        weights = torch.ones(H.shape[:-2], dtype=H.dtype, device=H.device)
+    return weights / weights.sum(dim=-1, keepdim=True).clamp_min(torch.finfo(H.dtype).tiny)
+
+def karcher_mean(H:torch.Tensor, weights:Optional[torch.Tensor]=None, init:Optional[torch.Tensor]=None,
+        max_iter:int=20, tol:float=1e-7) -> torch.Tensor:
+    """(weighted) Fréchet mean by Gauss-Newton iterations mu <- mu @ exp(sum_i w_i log(mu^-1 @ H_i))
+
+    Args:
+        H (torch.Tensor): (*, N, 4, 4) samples
+        weights (Optional[torch.Tensor], optional): (*, N) non-negative weights. Defaults to None (uniform).
+        init (Optional[torch.Tensor], optional): (*, 4, 4) initial estimate. Defaults to None (first sample).
+        max_iter (int, optional): maximum number of iterations. Defaults to 20.
+        tol (float, optional): stop once the largest update twist is below tol. Defaults to 1e-7.
+
+    Returns:
+        torch.Tensor: (*, 4, 4) mean
+    """
+    weights = _normalize(weights, H)
+    mu = H[..., 0, :, :] if init is None else init
+    for _ in range(max_iter):
+        delta = torch.sum(weights.unsqueeze(-1) * tangent_residuals(H, mu), dim=-2)  # (*, 6)
+        mu = mu @ se3.exp(delta)
+        if delta.abs().max().item() < tol:
+            break
+    return mu
+
+def geodesic_median(H:torch.Tensor, weights:Optional[torch.Tensor]=None, init:Optional[torch.Tensor]=None, scale:Optional[torch.Tensor]=None,
+        max_iter:int=50, tol:float=1e-7, eps:float=1e-9) -> torch.Tensor:
+    """(weighted) geometric median by the Riemannian Weiszfeld algorithm, robust to outlier samples:
+    mu <- mu @ exp(sum_i (w_i / d_i) log(mu^-1 @ H_i) / sum_i (w_i / d_i)), d_i the geodesic distance to H_i
+
+    Args:
+        H (torch.Tensor): (*, N, 4, 4) samples
+        weights (Optional[torch.Tensor], optional): (*, N) non-negative weights. Defaults to None (uniform).
+        init (Optional[torch.Tensor], optional): (*, 4, 4) initial estimate. Defaults to None (Karcher mean).
+        scale (Optional[torch.Tensor], optional): (6,) weights of the twist components in the distance. Defaults to None (all ones).
+        max_iter (int, optional): maximum number of iterations. Defaults to 50.
+        tol (float, optional): stop once the largest update twist is below tol. Defaults to 1e-7.
+        eps (float, optional): lower bound of the distances, avoids the singularity at a sample. Defaults to 1e-9.
+
+    Returns:
+        torch.Tensor: (*, 4, 4) median
+    """
+    weights = _normalize(weights, H)
+    mu = karcher_mean(H, weights) if init is None else init
+    for _ in range(max_iter):
+        xi = tangent_residuals(H, mu)  # (*, N, 6)
+        dist = torch.linalg.norm(xi if scale is None else xi * scale.to(xi), dim=-1).clamp_min(eps)
+        w = weights / dist
+        delta = torch.sum(w.unsqueeze(-1) * xi, dim=-2) / w.sum(dim=-1, keepdim=True)
+        mu = mu @ se3.exp(delta)
+        if delta.abs().max().item() < tol:
+            break
+    return mu
+
+def trimmed_mean(H:torch.Tensor, trim:float=0.1, weights:Optional[torch.Tensor]=None, scale:Optional[torch.Tensor]=None,
+        max_iter:int=20, tol:float=1e-7) -> torch.Tensor:
+    """Karcher mean of the samples closest to the geodesic median, the `trim` fraction of farthest samples is discarded
+
+    Args:
+        H (torch.Tensor): (*, N, 4, 4) samples
+        trim (float, optional): fraction of samples to discard, in [0, 1). Defaults to 0.1.
+        weights (Optional[torch.Tensor], optional): (*, N) non-negative weights. Defaults to None (uniform).
+        scale (Optional[torch.Tensor], optional): (6,) weights of the twist components in the distance. Defaults to None (all ones).
+
+    Returns:
+        torch.Tensor: (*, 4, 4) trimmed mean
+    """
+    assert 0 <= trim < 1, "trim must be in [0, 1), got {}".format(trim)
+    N = H.shape[-3]
+    keep = max(1, N - int(trim * N))
+    weights = _normalize(weights, H)
+    median = geodesic_median(H, weights, scale=scale)
+    dist = geodesic_distance(H, median, scale)
+    index = torch.topk(dist, keep, dim=-1, largest=False).indices
+    mask = torch.zeros_like(weights).scatter_(-1, index, 1.0)
+    return karcher_mean(H, weights * mask, init=median, max_iter=max_iter, tol=tol)
+
+def tangent_covariance(H:torch.Tensor, mu:Optional[torch.Tensor]=None, weights:Optional[torch.Tensor]=None) -> Tuple[torch.Tensor, torch.Tensor]:
+    """covariance of the twists log(mu^-1 @ H_i) in the tangent space at mu
+
+    Args:
+        H (torch.Tensor): (*, N, 4, 4) samples
+        mu (Optional[torch.Tensor], optional): (*, 4, 4) center. Defaults to None (Karcher mean).
+        weights (Optional[torch.Tensor], optional): (*, N) non-negative weights. Defaults to None (uniform).
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: mu (*, 4, 4), covariance (*, 6, 6)
+    """
+    weights = _normalize(weights, H)
+    if mu is None:
+        mu = karcher_mean(H, weights)
+    xi = tangent_residuals(H, mu)  # (*, N, 6)
+    cov = (weights.unsqueeze(-1) * xi).transpose(-1, -2) @ xi  # (*, 6, 6)
+    return mu, cov
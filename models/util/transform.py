@@ -3,6 +3,7 @@ import torch
 import numpy as np
 from math import pi as PI
 from collections.abc import Iterable
+from typing import Optional
 
 def inv_pose(pose_mat:torch.Tensor):
     inv_pose_mat = pose_mat.clone()
@@ -21,6 +22,11 @@ def nptran(pcd:np.ndarray, rigdtran:np.ndarray) -> np.ndarray:
     pcd_ = rigdtran[:3, :3] @ pcd_ + rigdtran[:3, [3]]
     return pcd_.T
 
+def compose_se3(R:torch.Tensor, t:torch.Tensor) -> torch.Tensor:
+    """(N,3,3) rotations and (N,3) translations -> (N,4,4) matrices"""
+    bottom = torch.tensor([0., 0., 0., 1.], dtype=R.dtype, device=R.device).expand(R.shape[0], 1, 4)
+    return torch.cat([torch.cat([R, t.unsqueeze(-1)], dim=-1), bottom], dim=-2)
+
 class RandomTransformSE3:
     """ rigid motion """
     def __init__(self, max_deg, max_tran, mag_randomly=True, concat=False):
@@ -31,28 +37,24 @@ class RandomTransformSE3:
         self.gt = None
         self.igt = None
 
-    def generate_transform(self):
-        # return: a twist-vector
+    def generate_transform(self, num:int=1, return_se3:bool=False, device:Optional[torch.device]=None):
+        # return: twist vectors [num, 6], or matrices [num, 4, 4] if return_se3, drawn on `device`
         if self.randomly:
-            deg = torch.rand(1).item()*self.max_deg
-            tran = torch.rand(1).item()*self.max_tran
+            deg = torch.rand(num, 1, device=device)*self.max_deg
+            tran = torch.rand(num, 1, device=device)*self.max_tran
         else:
-            deg = self.max_deg
-            tran = self.max_tran
+            deg = self.max_deg * torch.ones(num, 1, device=device)
+            tran = self.max_tran * torch.ones(num, 1, device=device)
         amp = deg * PI / 180.0  # deg to rad
-        w = torch.randn(1, 3)
+        w = torch.randn(num, 3, device=device)
         w = w / w.norm(p=2, dim=1, keepdim=True) * amp
-        t = torch.rand(1, 3) * tran
+        t = torch.rand(num, 3, device=device) * tran
 
         # the output: twist vectors.
-        R = so3.exp(w) # (N, 3) --> (N, 3, 3)
-        G = torch.zeros(1, 4, 4)
-        G[:, 3, 3] = 1
-        G[:, 0:3, 0:3] = R
-        G[:, 0:3, 3] = t
-
-        x = se3.log(G) # --> (N, 6)
-        return x # [1, 6]
+        G = compose_se3(so3.exp(w), t)  # (N, 3) --> (N, 4, 4)
+        if return_se3:
+            return G
+        return se3.log(G) # --> (N, 6)
 
     def apply_transform(self, p0, x):
         # p0: [3,N] or [6,N]
@@ -83,24 +85,50 @@ class UniformTransformSE3:
         self.gt = None
         self.igt = None
 
-    def generate_transform(self, num:int=1, return_se3:bool=False):
-        # return: a twist-vector
+    def generate_transform(self, num:int=1, return_se3:bool=False, device:Optional[torch.device]=None):
+        # return: twist vectors [num, 6], or matrices [num, 4, 4] if return_se3, drawn on `device`
+        if self.randomly:
+            deg = torch.rand(num, 1, device=device)*self.max_deg
+            tran = torch.rand(num, 1, device=device)*self.max_tran
+        else:
+            deg = self.max_deg * torch.ones(num, 1, device=device)
+            tran = self.max_tran * torch.ones(num, 1, device=device)
+        return self.compose_transform(deg, tran, torch.rand(num, 3, device=device), torch.rand(num, 3, device=device), return_se3)
+
+    def generate_indexed_transform(self, indices:Iterable[int], seed:int, epoch:int=0, return_se3:bool=False):
+        """counter-based generation: the perturbation of each index only depends on (seed, epoch, index),
+        so that it is identical across dataloader workers and ranks and can be regenerated at any index
+
+        Args:
+            indices (Iterable[int]): global indices of the samples
+            seed (int): key of the Philox generator
+            epoch (int, optional): counter offset to draw new perturbations in each epoch. Defaults to 0.
+            return_se3 (bool, optional): return (N,4,4) matrices instead of (N,6) twists. Defaults to False.
+        """
+        indices = list(indices)
+        rand = np.empty([len(indices), 8], dtype=np.float32)
+        for i, index in enumerate(indices):
+            # the 2nd/3rd counter words hold (index, epoch), the 1st word is left for the 8 draws of this index
+            rng = np.random.Generator(np.random.Philox(key=seed, counter=[0, index, epoch, 0]))
+            rand[i] = rng.random(8, dtype=np.float32)
+        rand = torch.from_numpy(rand)
         if self.randomly:
-            deg = torch.rand(num, 1)*self.max_deg
-            tran = torch.rand(num, 1)*self.max_tran
+            deg = rand[:, [0]]*self.max_deg
+            tran = rand[:, [1]]*self.max_tran
         else:
-            deg = self.max_deg * torch.ones(num, 1)
-            tran = self.max_tran * torch.ones(num, 1)
+            deg = self.max_deg * torch.ones(len(indices), 1)
+            tran = self.max_tran * torch.ones(len(indices), 1)
+        return self.compose_transform(deg, tran, rand[:, 2:5], rand[:, 5:8], return_se3)
+
+    @staticmethod
+    def compose_transform(deg:torch.Tensor, tran:torch.Tensor, w_rand:torch.Tensor, t_rand:torch.Tensor, return_se3:bool=False):
+        # deg, tran: (N,1); w_rand, t_rand: (N,3) uniform samples in [0,1)
         amp = deg * PI / 180.0  # deg to rad
-        w = (2*torch.rand(num, 3)-1) * amp
-        t = (2*torch.rand(num, 3)-1) * tran
+        w = (2*w_rand-1) * amp
+        t = (2*t_rand-1) * tran
 
         # the output: twist vectors.
-        R = so3.exp(w) # (N, 3) --> (N, 3, 3)
-        G = torch.zeros(num, 4, 4)
-        G[:, 3, 3] = 1
-        G[:, 0:3, 0:3] = R
-        G[:, 0:3, 3] = t
+        G = compose_se3(so3.exp(w), t)  # (N, 3) --> (N, 4, 4)
         if return_se3:
             return G  # (N, 4, 4)
         else:
@@ -0,0 +1,84 @@
+import os
+import json
+import struct
+import torch
+from collections import OrderedDict
+from typing import Dict, Union
+
+WEIGHTS_SUFFIX = '.weights'
+ALIGNMENT = 64  # every tensor starts at a multiple of 64 bytes, so it can be viewed in place
+DTYPES = {str(dtype).replace('torch.', ''):dtype for dtype in (torch.float64, torch.float32, torch.float16, torch.bfloat16,
+    torch.int64, torch.int32, torch.int16, torch.int8, torch.uint8, torch.bool)}
+
+def _aligned(nbytes:int) -> int:
+    return (nbytes + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def save_weights(file:str, state_dict:Dict[str, torch.Tensor], half:bool=False):
+    """save a state dict as flat tensors with a json index (safetensors-style):
+    8-byte little-endian header length | json header {name: dtype, shape, offset, nbytes} | aligned tensor data
+
+    Args:
+        file (str): output file, usually ends with WEIGHTS_SUFFIX
+        state_dict (Dict[str, torch.Tensor]): model weights
+        half (bool, optional): store floating tensors as float16, `load_state_dict` casts them back. Defaults to False.
+    """
+    header = OrderedDict()
+    tensors = []
+    offset = 0
+    for name, tensor in state_dict.items():
+        tensor = tensor.detach().cpu().contiguous()
+        if half and tensor.is_floating_point():
+            tensor = tensor.to(torch.float16)
+        nbytes = tensor.numel() * tensor.element_size()
+        header[name] = dict(dtype=str(tensor.dtype).replace('torch.', ''), shape=list(tensor.shape), offset=offset, nbytes=nbytes)
+        tensors.append(tensor)
+        offset += _aligned(nbytes)
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * (_aligned(8 + len(header_bytes)) - 8 - len(header_bytes))  # data section starts aligned
+    tmp_file = file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for tensor in tensors:
+            raw = tensor.reshape(-1).view(torch.uint8).numpy().tobytes()
+            f.write(raw)
+            f.write(b'\x00' * (_aligned(len(raw)) - len(raw)))
+    os.replace(tmp_file, file)
+
+def load_weights(file:str, device:Union[str, torch.device]='cpu', mmap:bool=True) -> Dict[str, torch.Tensor]:
+    """load a file written by `save_weights`
+
+    Args:
+        file (str): weights file
+        device (Union[str, torch.device], optional): if not cpu, tensors are copied from the mapped pages to the device one by one. Defaults to 'cpu'.
+        mmap (bool, optional): map the file copy-on-write instead of reading it, pages are only read when touched
+            and are shared by all processes loading the same file. Defaults to True.
+
+    Returns:
+        Dict[str, torch.Tensor]: state dict, cpu tensors are read-only views of the mapping
+    """
+    with open(file, 'rb') as f:
+        header_len = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    data_start = 8 + header_len
+    if mmap:
+        raw = torch.from_file(file, shared=False, size=os.path.getsize(file), dtype=torch.uint8)
+    else:
+        with open(file, 'rb') as f:
+            raw = torch.frombuffer(bytearray(f.read()), dtype=torch.uint8)
+    state_dict = OrderedDict()
+    for name, meta in header.items():
+        start = data_start + meta['offset']
+        tensor = raw[start:start + meta['nbytes']].view(DTYPES[meta['dtype']]).reshape(meta['shape'])
+        state_dict[name] = tensor if torch.device(device).type == 'cpu' else tensor.to(device)
+    return state_dict
+
+def load_model_state(file:str, device:Union[str, torch.device]='cpu') -> Dict[str, torch.Tensor]:
+    """model weights of a training checkpoint (dict with 'model') or of a weight-only file"""
+    if file.endswith(WEIGHTS_SUFFIX):
+        return load_weights(file, device)
+    try:  # torch >= 2.1: only the pages of the model weights are read, not the optimizer state
+        chkpt = torch.load(file, map_location=device, mmap=True)
+    except (TypeError, RuntimeError):  # older torch or legacy (non-zip) checkpoints
+        chkpt = torch.load(file, map_location=device)
+    return chkpt['model']
@@ -0,0 +1,116 @@
+"""calibration server: single frames are queued and sampled in dynamic batches.
+POST /calibrate with an npz body:
+    img: (H,W,3) uint8 image, or (3,H,W) float32 image already normalized like the datasets
+    pcd: (N,3) float32 LiDAR points, filtered like the datasets (any N, resampled to --num_points on device)
+    extran: (4,4) initial extrinsic (LiDAR -> camera)
+    intrinsic: (4,) fx, fy, cx, cy of the image
+returns {"extran": calibrated (4,4) extrinsic}. GET /metrics returns throughput, queue depth and latency quantiles.
+uint8 images of any size are resized on the device to the `resize_size` of the test dataset config (the training input size)
+and the intrinsics are scaled with them; float images must already have that size."""
+import argparse
+import json
+import numpy as np
+import torch
+import yaml
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+from dataset import collate_camera_info, collate_img, img_to_device
+from models.denoiser import Denoiser, RAFTDenoiser, Surrogate, __classdict__ as DenoiserDict
+from models.diffuser import Diffuser
+from models.util import se3
+from models.tools.utils import ragged_to_padded
+from core.serving import DynamicBatcher, build_http_server
+from core.tools import load_checkpoint_model_only
+
+def config_resize_size(dataset_argv:Dict) -> Optional[Tuple[int,int]]:
+    """`resize_size` (H, W) of the test dataset config, None if the images are not resized"""
+    argv = dataset_argv['dataset'][0] if isinstance(dataset_argv['dataset'], list) else dataset_argv['dataset']
+    resize_size = argv['base'].get('resize_size', None)
+    return tuple(resize_size) if resize_size is not None else None
+
+def parse_request(arrays:Dict[str, np.ndarray], resize_size:Optional[Tuple[int,int]]=None) -> Tuple[Dict, Tuple]:
+    """npz arrays -> (request, batching key); camera_info describes the image at the model input size `resize_size`"""
+    img = torch.from_numpy(arrays['img'])
+    if img.dtype == torch.uint8:
+        assert img.ndim == 3 and img.shape[-1] == 3, "uint8 img must be (H,W,3), got {}".format(tuple(img.shape))
+        img = img.permute(2, 0, 1)  # normalized on device
+    else:
+        assert img.ndim == 3 and img.shape[0] == 3, "float img must be (3,H,W), got {}".format(tuple(img.shape))
+        img = img.float()
+    pcd = torch.from_numpy(arrays['pcd']).float()
+    assert pcd.ndim == 2 and pcd.shape[1] == 3, "pcd must be (N,3), got {}".format(tuple(pcd.shape))
+    extran = torch.from_numpy(arrays['extran']).float().reshape(4, 4)
+    fx, fy, cx, cy = np.asarray(arrays['intrinsic'], dtype=np.float64).reshape(4).tolist()
+    H, W = img.shape[1:]
+    RH, RW = resize_size if resize_size is not None else (H, W)
+    if (RH, RW) != (H, W):
+        assert img.dtype == torch.uint8, "float img must have the model input size {}, got {}".format(resize_size, (H, W))
+    kx, ky = RW / W, RH / H  # same intrinsic scaling as the datasets, img is resized by img_to_device
+    camera_info = dict(fx=fx * kx, fy=fy * ky, cx=cx * kx, cy=cy * ky, sensor_h=RH, sensor_w=RW, projection_mode='perspective')
+    if img.dtype == torch.uint8:  # frames of any raw size are batched, see collate_img
+        return dict(img=img, pcd=pcd, extran=extran, camera_info=camera_info), (camera_info['sensor_h'], camera_info['sensor_w'], img.dtype)
+    return dict(img=img, pcd=pcd, extran=extran, camera_info=camera_info), (H, W, img.dtype)
+
+class BatchRunner:
+    def __init__(self, diffuser:Diffuser, device:torch.device, num_points:int=None):
+        """runs one batch of requests of the same image size through `diffuser.sample_fn`"""
+        self.diffuser = diffuser
+        self.device = device
+        self.num_points = num_points
+
+    @torch.inference_mode()
+    def __call__(self, requests:List[Dict]) -> List[Dict]:
+        camera_info = collate_camera_info([request['camera_info'] for request in requests])
+        img = img_to_device(dict(collate_img([request['img'] for request in requests]), camera_info=camera_info), self.device)
+        lengths = torch.tensor([0] + [len(request['pcd']) for request in requests])
+        points = torch.cat([request['pcd'] for request in requests], dim=0).to(self.device).T  # (3, M)
+        pcd = ragged_to_padded(points, torch.cumsum(lengths, dim=0), self.num_points)  # (B, 3, num_points)
+        init_extran = torch.stack([request['extran'] for request in requests]).to(self.device)
+        x0 = self.diffuser.sample_fn(torch.zeros(len(requests), 6, device=self.device), (img, pcd, init_extran, camera_info))
+        extran = (se3.exp(x0) @ init_extran).cpu().numpy()
+        return [dict(extran=extran_i.tolist()) for extran_i in extran]
+
+def main(config:Dict, args:argparse.Namespace):
+    torch.manual_seed(config['seed'])
+    device = config['device']
+    surrogate_model:Surrogate = DenoiserDict[config['surrogate']['type']](**config['surrogate']['argv']).to(device)
+    denoiser_class = RAFTDenoiser if config['surrogate']['type'] == 'LCCRAFT' else Denoiser
+    diffuser = Diffuser(denoiser_class(surrogate_model), **config['diffuser'])
+    diffuser.set_new_noise_schedule(device)
+    if config['path']['pretrain'] is None:
+        raise FileNotFoundError("'pretrain' cannot be set to 'None' during serving")
+    load_checkpoint_model_only(config['path']['pretrain'], surrogate_model)
+    surrogate_model.eval()
+    batcher = DynamicBatcher(BatchRunner(diffuser, device, args.num_points), args.max_batch_size, args.max_wait_ms / 1000)
+    resize_size = tuple(args.resize_size) if args.resize_size is not None else config_resize_size(config['dataset']['test'])
+    server = build_http_server(batcher, partial(parse_request, resize_size=resize_size), args.host, args.port, args.unix_socket)
+    print("serving {} on {}".format(config['path']['pretrain'], args.unix_socket if args.unix_socket is not None else "{}:{}".format(args.host, args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.stop()
+        print(json.dumps(batcher.metrics(), indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default="experiments/kitti/lsd/calibnet/log/kitti_lsd_calibnet.yml", type=str)
+    parser.add_argument("--pretrain",type=str,default=None,help='override path.pretrain')
+    parser.add_argument("--device",type=str,default=None,help='override device')
+    parser.add_argument("--host",type=str,default='127.0.0.1')
+    parser.add_argument("--port",type=int,default=8000)
+    parser.add_argument("--unix_socket",type=str,default=None,help='serve on this unix socket instead of host:port')
+    parser.add_argument("--max_batch_size",type=int,default=16)
+    parser.add_argument("--max_wait_ms",type=float,default=20.0,help='a batch is closed once its oldest frame has waited this long')
+    parser.add_argument("--resize_size",type=int,nargs=2,default=None,help='model input size (H W), defaults to resize_size of the test dataset config')
+    parser.add_argument("--num_points",type=int,default=None,help='points per frame fed to the model, defaults to the largest cloud of the batch')
+    args = parser.parse_args()
+    config = yaml.load(open(args.config,'r'), yaml.SafeLoader)
+    if args.pretrain is not None:
+        config['path']['pretrain'] = args.pretrain
+    if args.device is not None:
+        config['device'] = args.device
+    main(config, args)
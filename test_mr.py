@@ -5,20 +5,24 @@ import argparse
 # from torchinfo import summary
 import torch
 from torch.utils.data import DataLoader
-from dataset import PerturbDataset
+from dataset import PerturbDataset, build_dataloader, img_to_device
 from dataset import __classdict__ as DatasetDict
 from models.denoiser import Surrogate, __classdict__ as DenoiserDict
+from models.cascade import SurrogateCascade
 from models.loss import se3_err
 from tqdm import tqdm
 import yaml
 from models.util import se3
+from models.tools.utils import ragged_to_padded
 from core.logger import LogTracker, fmt_time
 from core.tools import load_checkpoint_model_only
 import logging
 from pathlib import Path
-from typing import Dict, Iterable, List
+from typing import Dict, Iterable, List, Optional
 from core.tools import Timer
 
+TEST_QUANTILES = {'R':[0.95], 't':[0.95], 'time':[0.5, 0.95]}
+
 def get_dataloader(test_dataset_argv:Iterable[Dict], test_dataloader_argv:Dict, dataset_type:str):
     name_list = []
     dataloader_list = []
@@ -29,7 +33,7 @@ def get_dataloader(test_dataset_argv:Iterable[Dict], test_dataloader_argv:Dict,
         dataset = PerturbDataset(base_dataset, **dataset_argv['main'])
         if hasattr(dataset, 'collate_fn'):
             test_dataloader_argv['collate_fn'] = getattr(dataset, 'collate_fn')
-        dataloader = DataLoader(dataset, **test_dataloader_argv)
+        dataloader = build_dataloader(dataset, test_dataloader_argv)
         dataloader_list.append(dataloader)
     return name_list, dataloader_list
 
@@ -38,40 +42,38 @@ def to_npy(x0:torch.Tensor) -> np.ndarray:
 
 
 @torch.inference_mode()
-def test_multirange(test_loader:DataLoader, name:str, model_list:List[Surrogate], logger:logging.Logger,
+def test_multirange(test_loader:DataLoader, name:str, cascade:SurrogateCascade, logger:logging.Logger,
         device:torch.device, log_per_iter:int, res_dir:Path):
-    for model in model_list:
+    for model in cascade.model_list:
         model.eval()
     logger.info("Test:")
     iterator = tqdm(test_loader, desc=name)
-    tracker = LogTracker('Rx','Ry','Rz','tx','ty','tz','R','t','3d3c','5d5c','time')
+    stage_keys = ['time_s{}'.format(k) for k in range(len(cascade.model_list))]
+    tracker = LogTracker('Rx','Ry','Rz','tx','ty','tz','R','t','3d3c','5d5c','time', *stage_keys, quantiles=TEST_QUANTILES)
     cnt = 0
     with iterator:
         N_valid = len(test_loader)
         for i, batch in enumerate(test_loader):
-            img = batch['img'].to(device)
+            img = img_to_device(batch, device)
             pcd = batch['pcd'].to(device)
+            if 'pcd_offsets' in batch:  # ragged batch, resampled on device
+                pcd = ragged_to_padded(pcd, batch['pcd_offsets'])
             init_extran = batch['extran'].to(device)
             gt_se3 = batch['gt'].to(device)  # transform uncalibrated_pcd to calibrated_pcd
             batch_n = len(gt_se3)
             camera_info = batch['camera_info']
-            H0 = torch.eye(4).unsqueeze(0).to(gt_se3)
-            x0_list = []
             with Timer() as timer:
-                for model in model_list:
-                    delta_x = model.forward(img, pcd, H0 @ init_extran, camera_info)
-                    if not isinstance(delta_x, torch.Tensor):
-                        delta_x = delta_x[-1]
-                    H0 = se3.exp(delta_x) @ H0
-                    save_x = to_npy(se3.log(H0 @ init_extran))  # (6,)
-                    x0_list.append(save_x)
+                H0_list = cascade(img, pcd, init_extran, camera_info)
+                x0_list = [to_npy(se3.log(H0 @ init_extran)) for H0 in H0_list]  # (B, 6) per stage
+            H0 = H0_list[-1]
             dt = timer.elapsed_time
             tracker.update('time', dt, batch_n)
+            for key, stage_dt in zip(stage_keys, cascade.stage_time):
+                tracker.update(key, stage_dt, batch_n)
             batched_x0_list = np.stack(x0_list, axis=1)  # (B, K, 6)
             for x0 in batched_x0_list:
                 np.savetxt(res_dir.joinpath("%06d.txt"%cnt), x0)
                 cnt += 1
-            model.clear_buffer()
             R_err, t_err = se3_err(H0, gt_se3)
             R_err = torch.rad2deg(R_err)  # log degree
             if torch.isnan(R_err).sum() + torch.isnan(t_err).sum() > 0:
@@ -86,8 +88,8 @@ def test_multirange(test_loader:DataLoader, name:str, model_list:List[Surrogate]
             tracker.update('tz',torch.mean(t_err[:,2].abs()).item(), batch_n)
             R_rmse = torch.linalg.norm(R_err, dim=1)
             t_rmse = torch.linalg.norm(t_err, dim=1)
-            tracker.update('R',R_rmse.mean().item(), batch_n)
-            tracker.update('t',t_rmse.mean().item(), batch_n)
+            tracker.observe('R', R_rmse.cpu().numpy())  # per-frame errors also feed the p95 estimators
+            tracker.observe('t', t_rmse.cpu().numpy())
             tracker.update('3d3c', torch.sum(torch.logical_and(R_rmse < 3, t_rmse < 0.03)).item() / batch_n, batch_n)
             tracker.update('5d5c', torch.sum(torch.logical_and(R_rmse < 5, t_rmse < 0.05)).item() / batch_n, batch_n)
             iterator.set_postfix(tracker.result())
@@ -97,7 +99,7 @@ def test_multirange(test_loader:DataLoader, name:str, model_list:List[Surrogate]
     assert N_valid > 0, "Fatal Error, no valid batch!"
     return tracker.result(), N_valid / len(test_loader)
 
-def main(config:Dict):
+def main(config:Dict, micro_batch_size:Optional[int]=None):
     np.random.seed(config['seed'])
     torch.manual_seed(config['seed'])
     device = config['device']
@@ -136,6 +138,8 @@ def main(config:Dict):
         load_checkpoint_model_only(pretrained_path, surrogate_model)
         model_list.append(surrogate_model)
         logger.info("Loaded checkpoint from {}".format(pretrained_path))
+    cascade = SurrogateCascade(model_list, micro_batch_size)
+    logger.info("{} stages, {} image encoding(s) per batch".format(len(model_list), cascade.num_groups))
     # summary(surrogate_model)  # print the volume of model parameters
     # exit(0)
     name_list, dataloader_list = get_dataloader(dataset_argv['dataset'], dataset_argv['dataloader'], dataset_type)
@@ -144,7 +148,7 @@ def main(config:Dict):
     for name, dataloader in zip(name_list, dataloader_list):
         sub_res_dir = res_dir.joinpath(name)
         sub_res_dir.mkdir()
-        record, valid_ratio = test_multirange(dataloader,name, model_list, logger, device, run_argv['log_per_iter'], sub_res_dir)
+        record, valid_ratio = test_multirange(dataloader,name, cascade, logger, device, run_argv['log_per_iter'], sub_res_dir)
         logger.info("{}: {} | valid: {:.2%}".format(name, record, valid_ratio))
         record_list.append([name, record, valid_ratio])
     logger.info("Summary:")  # view in the bottom
@@ -155,6 +159,7 @@ def main(config:Dict):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', type=str, default="experiments/kitti/mr_3/calibnet/log/kitti_mr_3_calibnet.yml")
+    parser.add_argument('--micro_batch_size', type=int, default=None, help='pipeline the stages over micro-batches of this size')
     args = parser.parse_args()
     config = yaml.safe_load(open(args.config, 'r'))
-    main(config)
\ No newline at end of file
+    main(config, args.micro_batch_size)
\ No newline at end of file
@@ -4,7 +4,7 @@ import numpy as np
 import argparse
 import torch
 from torch.utils.data import DataLoader
-from dataset import PerturbDataset
+from dataset import PerturbDataset, SceneSplitLoader, build_dataloader, img_to_device
 from dataset import __classdict__ as DatasetDict, DATASET_TYPE
 from models.denoiser import Surrogate, __classdict__ as DenoiserDict
 from models.diffuser import SE3Diffuser
@@ -13,41 +13,47 @@ from models.util.constant import BatchedPerturbDatasetOutput
 from tqdm import tqdm
 import yaml
 from models.util import se3
+from models.tools.utils import ragged_to_padded
 from core.logger import LogTracker, fmt_time
 from core.tools import load_checkpoint_model_only
 import logging
 from pathlib import Path
-from typing import Dict, Iterable, List, Tuple, Generator
+from typing import Dict, Iterable, List, Tuple, Generator, Optional
 from core.tools import Timer
 from copy import deepcopy
 
+TEST_QUANTILES = {'R':[0.95], 't':[0.95], 'time':[0.5, 0.95]}
+
 def get_dataloader(test_dataset_argv:Iterable[Dict],
-        test_dataloader_argv:Dict, dataset_type:str) -> Tuple[List[str], List[Generator[BatchedPerturbDatasetOutput, None, None]]]:
+        test_dataloader_argv:Dict, dataset_type:str, names:Optional[List[str]]=None) -> Tuple[List[str], List[Generator[BatchedPerturbDatasetOutput, None, None]]]:
     name_list = []
     dataloader_list = []
     data_class:DATASET_TYPE = DatasetDict[dataset_type]
     if isinstance(test_dataset_argv, list):
         for dataset_argv in test_dataset_argv:
+            if names is not None and dataset_argv['name'] not in names:
+                continue
             name_list.append(dataset_argv['name'])
             base_dataset = data_class(**dataset_argv['base'])
             dataset = PerturbDataset(base_dataset, **dataset_argv['main'])
             if hasattr(dataset, 'collate_fn'):
                 test_dataloader_argv['collate_fn'] = getattr(dataset, 'collate_fn')
-            dataloader = DataLoader(dataset, **test_dataloader_argv)
+            dataloader = build_dataloader(dataset, test_dataloader_argv)
             dataloader_list.append(dataloader)
     else:
         assert hasattr(data_class, 'split_dataset'), '{} must has the function \"split_dataset\"'.format(data_class.__class__.__name__)
         root_dataset:DATASET_TYPE = data_class(**test_dataset_argv['base'])
+        dataset_list = []
         for base_dataset, name in root_dataset.split_dataset():
+            if names is not None and name not in names:
+                continue
             main_args = deepcopy(test_dataset_argv['main'])
             if 'file' in main_args:
                 main_args['file'] = main_args['file'].format(name=name)
-            dataset = PerturbDataset(base_dataset, **main_args)
-            if hasattr(dataset, 'collate_fn'):
-                test_dataloader_argv['collate_fn'] = getattr(dataset, 'collate_fn')
-            dataloader = DataLoader(dataset, **test_dataloader_argv)
-            dataloader_list.append(dataloader)
+            dataset_list.append(PerturbDataset(base_dataset, **main_args))
             name_list.append(name)
+        # one loader shared by all scenes, the workers are not re-forked at every scene boundary
+        dataloader_list = SceneSplitLoader(dataset_list, test_dataloader_argv).scenes()
     return name_list, dataloader_list
 
 
@@ -59,13 +65,15 @@ def test_diffuser(test_loader:DataLoader, name:str, diffuser:SE3Diffuser, logger
     diffuser.model.eval()
     logger.info("Test:")
     iterator = tqdm(test_loader, desc=name)
-    tracker = LogTracker('Rx','Ry','Rz','tx','ty','tz','R','t','3d3c','5d5c','time')
+    tracker = LogTracker('Rx','Ry','Rz','tx','ty','tz','R','t','3d3c','5d5c','time', quantiles=TEST_QUANTILES)
     cnt = 0
     with iterator:
         N_valid = len(test_loader)
         for i, batch in enumerate(test_loader):
-            img = batch['img'].to(device)
+            img = img_to_device(batch, device)
             pcd = batch['pcd'].to(device)
+            if 'pcd_offsets' in batch:  # ragged batch, resampled on device
+                pcd = ragged_to_padded(pcd, batch['pcd_offsets'])
             init_extran = batch['extran'].to(device)
             gt_se3 = batch['gt'].to(device)  # transform uncalibrated_pcd to calibrated_pcd
             batch_n = len(gt_se3)
@@ -94,8 +102,8 @@ def test_diffuser(test_loader:DataLoader, name:str, diffuser:SE3Diffuser, logger
             tracker.update('tz',torch.mean(t_err[:,2].abs()).item(), batch_n)
             R_rmse = torch.linalg.norm(R_err, dim=1)
             t_rmse = torch.linalg.norm(t_err, dim=1)
-            tracker.update('R',R_rmse.mean().item(), batch_n)
-            tracker.update('t',t_rmse.mean().item(), batch_n)
+            tracker.observe('R', R_rmse.cpu().numpy())  # per-frame errors also feed the p95 estimators
+            tracker.observe('t', t_rmse.cpu().numpy())
             tracker.update('3d3c', torch.sum(torch.logical_and(R_rmse < 3, t_rmse < 0.03)).item() / batch_n, batch_n)
             tracker.update('5d5c', torch.sum(torch.logical_and(R_rmse < 5, t_rmse < 0.05)).item() / batch_n, batch_n)
             iterator.set_postfix(tracker.result())
@@ -105,15 +113,16 @@ def test_diffuser(test_loader:DataLoader, name:str, diffuser:SE3Diffuser, logger
     assert N_valid > 0, "Fatal Error, no valid batch!"
     return tracker.result(), N_valid / len(test_loader)
 
-def main(config:Dict, model_type:str):
+def main(config:Dict, model_type:str, names:Optional[List[str]]=None, given_res_dir:Optional[str]=None):
     np.random.seed(config['seed'])
     torch.manual_seed(config['seed'])
     device = config['device']
     surrogate_model:Surrogate = DenoiserDict[config['surrogate']['type']](**config['surrogate']['argv']).to(device)
     dataset_argv = config['dataset']['test']
     dataset_type = config['dataset']['type']
-    name_list, dataloader_list = get_dataloader(dataset_argv['dataset'], dataset_argv['dataloader'], dataset_type)
-    diffuser = SE3Diffuser(surrogate_model, config['diffuser']['train'], config['diffuser']['val'])
+    name_list, dataloader_list = get_dataloader(dataset_argv['dataset'], dataset_argv['dataloader'], dataset_type, names)
+    diffuser = SE3Diffuser(surrogate_model, config['diffuser']['train'], config['diffuser']['val'],
+        config['diffuser'].get('sampling_type', 'nlsd'), config['diffuser'].get('sampling_argv', None))
     loss_func = get_loss(config['loss']['type'], **config['loss']['args'])
     diffuser.set_loss(loss_func)
     run_argv = config['run']
@@ -132,10 +141,15 @@ def main(config:Dict, model_type:str):
     steps = config['diffuser']['val']['n_diff_steps']
     name = "{}_{}_{}".format(model_type, steps, fmt_time())
     res_dir = experiment_dir.joinpath(path_argv['results']).joinpath(name)
-    if res_dir.exists():
+    if given_res_dir is not None:  # shared by parallel jobs, only this job's sub-dirs are reset
+        res_dir = Path(given_res_dir)
+    elif res_dir.exists():
         shutil.rmtree(str(res_dir))
     res_dir.mkdir(exist_ok=True,parents=True)
-    file_handler = logging.FileHandler(str(log_dir) + '/test_{}_{}.log'.format(model_type, steps), mode=logger_mode)
+    log_name = 'test_{}_{}'.format(model_type, steps)
+    if names is not None:  # parallel jobs write their own log files
+        log_name = "{}_{}".format(log_name, '_'.join(names))
+    file_handler = logging.FileHandler(str(log_dir) + '/{}.log'.format(log_name), mode=logger_mode)
     file_handler.setLevel(logging.INFO)
     file_handler.setFormatter(formatter)
     logger.addHandler(file_handler)
@@ -152,6 +166,8 @@ def main(config:Dict, model_type:str):
     for name, dataloader in zip(name_list, dataloader_list):
         surrogate_model.train()
         sub_res_dir = res_dir.joinpath(name)
+        if sub_res_dir.exists():
+            shutil.rmtree(str(sub_res_dir))
         sub_res_dir.mkdir()
         record, valid_ratio = test_diffuser(dataloader, name, diffuser, logger, device, run_argv['log_per_iter'], sub_res_dir)
         logger.info("{}: {} | valid: {:.2%}".format(name, record, valid_ratio))
@@ -165,6 +181,17 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', default="experiments/kitti/nlsd/calibnet/log/kitti_nlsd_calibnet.yml", type=str)
     parser.add_argument('--model_type',type=str, default='nlsd')
+    parser.add_argument("--sampling_type",type=str,default=None,help='override diffuser.sampling_type, e.g. nlsd, se3_multistep')
+    parser.add_argument("--names",type=str,nargs='+',default=None,help='only test the sequences/scenes with these names')
+    parser.add_argument("--res_dir",type=str,default=None,help='write results to this directory instead of a timestamped one')
+    parser.add_argument("--pretrain",type=str,default=None,help='override path.pretrain')
+    parser.add_argument("--device",type=str,default=None,help='override device')
     args = parser.parse_args()
     config = yaml.load(open(args.config,'r'), yaml.SafeLoader)
-    main(config, args.model_type)
\ No newline at end of file
+    if args.sampling_type is not None:
+        config['diffuser']['sampling_type'] = args.sampling_type
+    if args.pretrain is not None:
+        config['path']['pretrain'] = args.pretrain
+    if args.device is not None:
+        config['device'] = args.device
+    main(config, args.model_type, args.names, args.res_dir)
\ No newline at end of file
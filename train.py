@@ -6,14 +6,16 @@ import torch
 import torch.nn as nn
 from torch.utils.data import DataLoader
 from dataset import __classdict__ as DatasetDict
-from dataset import PerturbDataset, SeqBatchSampler
+from dataset import PerturbDataset, perturb_batch, SeqBatchSampler, build_dataloader, img_to_device
 from models.denoiser import Surrogate, Denoiser, RGGDenoiser, RAFTDenoiser, __classdict__ as DenoiserDict
 from models.diffuser import Diffuser
+from models.rggnet.cache import GTDepthCache, frame_keys
 from models.lr_scheduler import get_lr_scheduler, get_optimizer
 from models.loss import get_loss, geodesic_loss
 from tqdm import tqdm
 import yaml
 from models.util import se3
+from models.tools.utils import ragged_to_padded
 from core.logger import LogTracker, fmt_time, print_warning
 from core.tools import load_checkpoint, save_checkpoint
 import logging
@@ -37,8 +39,8 @@ def get_dataloader(dataset_type:str, train_base_dataset_argv:Dict, train_dataset
         train_dataloader_argv['collate_fn'] = getattr(train_dataset, 'collate_fn')
     if hasattr(val_dataset, 'collate_fn'):
         val_dataloader_argv['collate_fn'] = getattr(val_dataset, 'collate_fn')
-    train_dataloader = DataLoader(train_dataset, **train_dataloader_argv)
-    val_dataloader = DataLoader(val_dataset, **val_dataloader_argv)
+    train_dataloader = build_dataloader(train_dataset, train_dataloader_argv)
+    val_dataloader = build_dataloader(val_dataset, val_dataloader_argv)
     return train_dataloader, val_dataloader
 
 @torch.inference_mode()
@@ -51,8 +53,11 @@ def val_epoch(val_loader:DataLoader, diffuser:Diffuser, logger:logging.Logger, d
     with iterator:
         N_valid = len(val_loader)
         for i, batch in enumerate(val_loader):
-            img = batch['img'].to(device)
+            batch = perturb_batch(batch, device)  # no-op unless PerturbDataset(on_device=True)
+            img = img_to_device(batch, device)
             pcd = batch['pcd'].to(device)
+            if 'pcd_offsets' in batch:  # ragged batch, resampled on device
+                pcd = ragged_to_padded(pcd, batch['pcd_offsets'])
             init_extran = batch['extran'].to(device)
             gt_se3 = batch['gt'].to(device)  # transform uncalibrated_pcd to calibrated_pcd
             gt_x = se3.log(gt_se3)
@@ -109,6 +114,10 @@ def main(config:Dict, config_filename:str):
         denoiser_class = Denoiser
     denoiser = denoiser_class(surrogate_model)
     diffuser = Diffuser(denoiser, **config['diffuser'])
+    elbo_cache = None
+    if denoiser_class is RGGDenoiser and config['surrogate'].get('elbo_cache', None) is not None:  # {dir, vae_stats}
+        elbo_cache_argv = config['surrogate']['elbo_cache']
+        elbo_cache = GTDepthCache(elbo_cache_argv['dir'], surrogate_model.pcd2depth, elbo_cache_argv.get('vae_stats', True))
     dataset_argv = config['dataset']['train']
     dataset_type = config['dataset']['type']
     train_dataloader, val_dataloader = get_dataloader(dataset_type, dataset_argv['dataset']['train']['base'], dataset_argv['dataset']['train']['main'],
@@ -143,14 +152,18 @@ def main(config:Dict, config_filename:str):
         logger.info("Start from scratch")
     ## training
     for epoch_idx in range(start_epoch, run_argv['n_epoch']+1):
+        train_dataloader.dataset.set_epoch(epoch_idx)
         diffuser.x0_fn.model.train()
         iterator = tqdm(train_dataloader, desc='train')
         tracker = LogTracker('R','T','loss')
         with iterator:
             for i, batch in enumerate(train_dataloader):
+                batch = perturb_batch(batch, device)  # no-op unless PerturbDataset(on_device=True)
                 # model prediction
-                img = batch['img'].to(device)
+                img = img_to_device(batch, device)
                 pcd = batch['pcd'].to(device)
+                if 'pcd_offsets' in batch:  # ragged batch, resampled on device
+                    pcd = ragged_to_padded(pcd, batch['pcd_offsets'])
                 init_extran = batch['extran'].to(device)
                 gt_se3 = batch['gt'].to(device)  # transform uncalibrated_pcd to calibrated_pcd
                 camera_info = batch['camera_info']
@@ -167,7 +180,11 @@ def main(config:Dict, config_filename:str):
                     continue
                 if isinstance(diffuser.x0_fn, RGGDenoiser):
                     with torch.enable_grad():
-                        ELBO = diffuser.x0_fn.loss(x0_hat, (img, pcd, init_extran, camera_info))
+                        if elbo_cache is not None:
+                            ELBO = diffuser.x0_fn.cached_loss((img, pcd, init_extran, camera_info), gt_se3 @ init_extran,
+                                frame_keys(batch['group_idx'], batch['sub_idx']), elbo_cache)
+                        else:
+                            ELBO = diffuser.x0_fn.loss(x0_hat, (img, pcd, init_extran, camera_info))
                     loss = loss + ELBO
                 loss.backward()
                 try:
@@ -6,7 +6,7 @@ import torch
 import torch.nn as nn
 import torch.utils
 from torch.utils.data import DataLoader
-from dataset import PerturbDataset, SeqBatchSampler, __classdict__ as DatasetDict, DATASET_TYPE
+from dataset import PerturbDataset, perturb_batch, SeqBatchSampler, build_dataloader, img_to_device, __classdict__ as DatasetDict, DATASET_TYPE
 from models.denoiser import __classdict__ as DenoiserDict, SURROGATE_TYPE
 from models.diffuser import SE3Diffuser
 from models.lr_scheduler import get_lr_scheduler, get_optimizer
@@ -14,6 +14,7 @@ from models.loss import geodesic_loss, get_loss
 from tqdm import tqdm
 import yaml
 from models.util import se3
+from models.tools.utils import ragged_to_padded
 from core.logger import LogTracker, fmt_time, print_warning
 from core.tools import load_checkpoint, save_checkpoint
 import logging
@@ -35,8 +36,8 @@ def get_dataloader(dataset_type:str, train_base_dataset_argv:Dict, train_dataset
         train_dataloader_argv['collate_fn'] = getattr(train_dataset, 'collate_fn')
     if hasattr(val_dataset, 'collate_fn'):
         val_dataloader_argv['collate_fn'] = getattr(val_dataset, 'collate_fn')
-    train_dataloader = DataLoader(train_dataset, **train_dataloader_argv)
-    val_dataloader = DataLoader(val_dataset, **val_dataloader_argv)
+    train_dataloader = build_dataloader(train_dataset, train_dataloader_argv)
+    val_dataloader = build_dataloader(val_dataset, val_dataloader_argv)
     return train_dataloader, val_dataloader
 
 @torch.inference_mode()
@@ -49,8 +50,11 @@ def val_epoch(val_loader:DataLoader, diffuser:SE3Diffuser, logger:logging.Logger
     with iterator:
         N_valid = len(val_loader)
         for i, batch in enumerate(val_loader):
-            img = batch['img'].to(device)
+            batch = perturb_batch(batch, device)  # no-op unless PerturbDataset(on_device=True)
+            img = img_to_device(batch, device)
             pcd = batch['pcd'].to(device)
+            if 'pcd_offsets' in batch:  # ragged batch, resampled on device
+                pcd = ragged_to_padded(pcd, batch['pcd_offsets'])
             init_extran = batch['extran'].to(device)
             gt_se3 = batch['gt'].to(device)  # transform uncalibrated_pcd to calibrated_pcd
             camera_info = batch['camera_info']
@@ -95,7 +99,7 @@ def main(config:Dict, config_path:str):
     # torch.backends.cudnn.enabled = False
     surrogate_model:SURROGATE_TYPE = DenoiserDict[config['surrogate']['type']](**config['surrogate']['argv']).to(device)
     scheduler_argv = config['diffuser']
-    diffuser = SE3Diffuser(surrogate_model, scheduler_argv['train'], scheduler_argv['val'])
+    diffuser = SE3Diffuser(surrogate_model, scheduler_argv['train'], scheduler_argv['val'], num_perturbations=scheduler_argv.get('num_perturbations', 1))
     loss_func = get_loss(config['loss']['type'], **config['loss']['args'])
     diffuser.set_loss(loss_func)
     dataset_argv = config['dataset']['train']
@@ -127,14 +131,18 @@ def main(config:Dict, config_path:str):
         logger.info("Start from scratch")
     ## training
     for epoch_idx in range(start_epoch, run_argv['n_epoch']):
+        train_dataloader.dataset.set_epoch(epoch_idx)
         surrogate_model.train()
         iterator = tqdm(train_dataloader, desc='train')
         tracker = LogTracker('R','t','loss')
         with iterator:
             for i, batch in enumerate(train_dataloader):
+                batch = perturb_batch(batch, device)  # no-op unless PerturbDataset(on_device=True)
                 # model prediction
-                img = batch['img'].to(device)
+                img = img_to_device(batch, device)
                 pcd = batch['pcd'].to(device)
+                if 'pcd_offsets' in batch:  # ragged batch, resampled on device
+                    pcd = ragged_to_padded(pcd, batch['pcd_offsets'])
                 init_extran = batch['extran'].to(device)
                 gt_se3 = batch['gt'].to(device)  # transform uncalibrated_pcd to calibrated_pcd
                 camera_info = batch['camera_info']
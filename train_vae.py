@@ -10,18 +10,20 @@ import torch.nn as nn
 import torch.utils
 from torch.utils.data import DataLoader
 from dataset import __classdict__ as DatasetDict
-from dataset import SeqBatchSampler
+from dataset import SeqBatchSampler, build_dataloader, img_to_device
 from models.rggnet.vae import VanillaVAE as VAE
 from models.tools.core import DepthImgGenerator
+from models.rggnet.cache import GTDepthCache, frame_keys
 from models.lr_scheduler import get_lr_scheduler
 from tqdm import tqdm
 import yaml
 from models.util import se3
+from models.tools.utils import ragged_to_padded
 from core.logger import LogTracker, fmt_time, print_warning
 from core.tools import load_checkpoint, save_checkpoint
 import logging
 from pathlib import Path
-from typing import Dict, Union, Iterable
+from typing import Dict, Union, Iterable, Optional
 
 # torch.backends.cudnn.benchmark = False
 # torch.backends.cudnn.deterministic = True
@@ -38,12 +40,13 @@ def get_dataloader(dataset_type:str, train_base_dataset_argv:Dict,
         train_dataloader_argv['collate_fn'] = getattr(train_base_dataset, 'collate_fn')
     if hasattr(val_base_dataset, 'collate_fn'):
         val_dataloader_argv['collate_fn'] = getattr(val_base_dataset, 'collate_fn')
-    train_dataloader = DataLoader(train_base_dataset, **train_dataloader_argv)
-    val_dataloader = DataLoader(val_base_dataset, **val_dataloader_argv)
+    train_dataloader = build_dataloader(train_base_dataset, train_dataloader_argv)
+    val_dataloader = build_dataloader(val_base_dataset, val_dataloader_argv)
     return train_dataloader, val_dataloader
 
 @torch.inference_mode()
-def val_epoch(val_loader:DataLoader, vae:VAE, depthgen_argv:Dict, vae_kld_weight:float, logger:logging.Logger, device, log_per_iter:int):
+def val_epoch(val_loader:DataLoader, vae:VAE, depthgen_argv:Dict, vae_kld_weight:float, logger:logging.Logger, device, log_per_iter:int,
+        depth_cache:Optional[GTDepthCache]=None):
     vae.eval()
     total_loss = 0
     logger.info("Validation:")
@@ -53,12 +56,17 @@ def val_epoch(val_loader:DataLoader, vae:VAE, depthgen_argv:Dict, vae_kld_weight
     with iterator:
         N_valid = len(val_loader)
         for i, batch in enumerate(val_loader):
-            img = batch['img'].to(device)
+            img = img_to_device(batch, device)
             pcd = batch['pcd'].to(device)
+            if 'pcd_offsets' in batch:  # ragged batch, resampled on device
+                pcd = ragged_to_padded(pcd, batch['pcd_offsets'])
             extran = batch['extran'].to(device)
             camera_info = batch['camera_info']
-            pcd_tf = se3.transform(extran, pcd)
-            depth = depth_generator.project(pcd_tf, camera_info)
+            if depth_cache is not None:
+                depth = depth_cache.depth(frame_keys(batch['group_idx'], batch['sub_idx']), pcd, extran, camera_info)
+            else:
+                pcd_tf = se3.transform(extran, pcd)
+                depth = depth_generator.project(pcd_tf, camera_info)
             x_img = torch.cat([img, depth], dim=1)  # (B, 4, H, W)
             x_est, mu, log_var = vae.forward(x_img)
             recon_loss = vae.reconstruction_loss(x_est, depth)
@@ -123,6 +131,10 @@ def main(config:Dict, config_filename:str):
         best_loss = float('inf')
         logger.info("Start from scratch")
     depth_generator = DepthImgGenerator(**depthgen_argv)
+    train_depth_cache, val_depth_cache = None, None
+    if config['vae'].get('depth_cache_dir', None) is not None:  # ground-truth depth images stored per frame, see models.rggnet.cache
+        train_depth_cache = GTDepthCache(os.path.join(config['vae']['depth_cache_dir'], 'train'), depth_generator)
+        val_depth_cache = GTDepthCache(os.path.join(config['vae']['depth_cache_dir'], 'val'), depth_generator)
     ## training
     for epoch_idx in range(start_epoch, run_argv['n_epoch']+1):
         vae.train()
@@ -131,12 +143,17 @@ def main(config:Dict, config_filename:str):
         with iterator:
             for i, batch in enumerate(train_dataloader):
                 # model prediction
-                img = batch['img'].to(device)
+                img = img_to_device(batch, device)
                 pcd = batch['pcd'].to(device)
+                if 'pcd_offsets' in batch:  # ragged batch, resampled on device
+                    pcd = ragged_to_padded(pcd, batch['pcd_offsets'])
                 extran = batch['extran'].to(device)
                 camera_info = batch['camera_info']
-                pcd_tf = se3.transform(extran, pcd)
-                depth = depth_generator.project(pcd_tf, camera_info)
+                if train_depth_cache is not None:
+                    depth = train_depth_cache.depth(frame_keys(batch['group_idx'], batch['sub_idx']), pcd, extran, camera_info)
+                else:
+                    pcd_tf = se3.transform(extran, pcd)
+                    depth = depth_generator.project(pcd_tf, camera_info)
                 x_img = torch.cat([img, depth], dim=1)  # (B, 4, H, W)
                 x_est, mu, log_var = vae.forward(x_img)
                 optimizer.zero_grad()
@@ -164,7 +181,7 @@ def main(config:Dict, config_filename:str):
             scheduler.step()
             save_checkpoint(str(checkpoints_dir.joinpath('last_model.pth')), epoch_idx, best_loss, vae, optimizer, scheduler)
         if epoch_idx % run_argv['val_per_epoch'] == 0:
-            val_loss = val_epoch(val_dataloader, vae, depthgen_argv, vae_kld_weight, logger, device, run_argv['log_per_iter'])
+            val_loss = val_epoch(val_dataloader, vae, depthgen_argv, vae_kld_weight, logger, device, run_argv['log_per_iter'], val_depth_cache)
             if val_loss < best_loss:
                 logger.info("Find Best Model at Epoch {} prev | curr best loss: {} | {}".format(epoch_idx, best_loss, val_loss))
                 best_loss = val_loss